@@ -0,0 +1,81 @@
+"""
+bench_cardiac_attributes.py
+
+Micro-benchmark of the per-sample attribute lookup of CardiacCustomDataset:
+pandas .loc lookups (previous implementation) vs. the pre-indexed NumPy arrays.
+
+python benchmarks/bench_cardiac_attributes.py --nr_samples 30000 --nr_items 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, './')
+from data.cardiac_loader_2D import CardiacCustomDataset
+
+ATTRIBUTES_IDX = ('LVEDV', 'RVEDV', 'MYOEDV', 'LVESV', 'RVESV', 'MYOESV')
+
+
+def loc_lookup(dataset, idx):
+    """ Per-sample lookup as done before the columnar attribute table """
+    label = dataset.csv_attributes.loc[idx]['label']
+    if dataset.binary_label and label > 1:
+        label = 1
+    pid = dataset.csv_attributes.loc[idx]['pid']
+    attributes = [dataset.csv_attributes.loc[idx][attr] for attr in dataset.attributes_idx]
+    full_attributes = dataset.csv_attributes.loc[idx, dataset.attributes_dict].values
+    return label, pid, torch.Tensor(attributes), torch.Tensor(full_attributes.tolist())
+
+
+def array_lookup(dataset, idx):
+    """ Per-sample lookup used by CardiacCustomDataset.__getitem__ """
+    attributes, full_attributes = dataset.get_attributes(idx)
+    return dataset.labels[idx], dataset.pids[idx], attributes, full_attributes
+
+
+def items_per_second(fn, dataset, indices):
+    start = time()
+    for idx in indices:
+        fn(dataset, idx)
+    return len(indices) / (time() - start)
+
+
+def main(args):
+    rng = np.random.default_rng(2109)
+    columns = list(ATTRIBUTES_IDX) + [f'extra_{i}' for i in range(args.nr_extra)]
+    df = pd.DataFrame(rng.random((args.nr_samples, len(columns))) * 100, columns=columns)
+    df.insert(0, 'pid', [str(1000000 + i) for i in range(args.nr_samples)])
+    df.insert(0, 'label', rng.integers(0, 3, args.nr_samples))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'full_info.csv')
+        df.to_csv(csv_path, index=False)
+        # the h5 file is only opened on the first image read, it is not needed here
+        dataset = CardiacCustomDataset(os.path.join(tmp_dir, 'unused.h5'), ATTRIBUTES_IDX, csv_path,
+                                       binary_label=True, moment='all')
+
+    indices = rng.integers(0, args.nr_samples, args.nr_items)
+    for idx in indices[:100]:
+        ref, new = loc_lookup(dataset, idx), array_lookup(dataset, idx)
+        assert ref[0] == new[0] and ref[1] == new[1]
+        assert torch.equal(ref[2], new[2]) and torch.equal(ref[3], new[3])
+
+    before = items_per_second(loc_lookup, dataset, indices)
+    after = items_per_second(array_lookup, dataset, indices)
+    print(f'pandas .loc lookups: {before:10.1f} items/s')
+    print(f'numpy arrays:        {after:10.1f} items/s')
+    print(f'speed-up:            {after / before:10.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CardiacCustomDataset attribute lookup benchmark')
+    parser.add_argument('--nr_samples', type=int, default=30000, help='number of rows in full_info.csv')
+    parser.add_argument('--nr_extra', type=int, default=20, help='number of attributes besides attributes_idx')
+    parser.add_argument('--nr_items', type=int, default=5000, help='number of timed lookups')
+    main(parser.parse_args())
@@ -0,0 +1,90 @@
+"""
+bench_compile.py
+
+CPU latency of training steps with eager vs. compiled (net_utils.compile.compile_model) encoder / decoder:
+- sivae: PTrainer._train_step of the Soft-Intro VAE (see bench_sivae_step.py)
+- betavae: forward / backward / Adam step of BetaVAE_H with the beta-VAE loss terms
+The compilation time (first steps) is reported separately from the steady-state step time.
+
+python benchmarks/bench_compile.py --model sivae --batch_size 16 --image_size 64 --nr_steps 10
+python benchmarks/bench_compile.py --model betavae --batch_size 32 --image_size 128
+"""
+import argparse
+import copy
+import sys
+from time import time
+
+import torch
+
+sys.path.insert(0, './')
+sys.path.insert(0, './benchmarks')
+from bench_sivae_step import get_batch, make_trainer
+from model_zoo.beta_vae_higgings import BetaVAE_H
+from model_zoo.soft_intro_vae_daniel import SoftIntroVAE, calc_kl, calc_reconstruction_loss
+from net_utils.compile import compile_model
+
+
+def get_betavae_step(model, args):
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    real_batch = torch.rand(args.batch_size, args.nc, args.image_size, args.image_size)
+
+    def step(*_):
+        x_recon, f_result = model(real_batch)
+        loss = calc_reconstruction_loss(real_batch, x_recon, reduction='mean') + \
+            calc_kl(f_result['z_logvar'], f_result['z_mu'], reduce='mean')
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return step
+
+
+def time_steps(step, args):
+    real_batch, attributes = get_batch(args)
+    start = time()
+    for _ in range(args.nr_warmup):
+        step(real_batch, attributes)
+    warmup_time = time() - start
+    start = time()
+    for _ in range(args.nr_steps):
+        step(real_batch, attributes)
+    return warmup_time, (time() - start) / args.nr_steps
+
+
+def add_args(parser):
+    parser.add_argument('--model', type=str, default='sivae', choices=['sivae', 'betavae'])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--nc', type=int, default=2)
+    parser.add_argument('--zdim', type=int, default=128)
+    parser.add_argument('--channels', type=int, nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('--loss_type', type=str, default='mse', choices=['mse', 'l1'])
+    parser.add_argument('--mode', type=str, default='default', help='torch.compile mode')
+    parser.add_argument('--nr_warmup', type=int, default=3)
+    parser.add_argument('--nr_steps', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.set_defaults(amp=None)
+    return parser
+
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='Eager vs. compiled training step benchmark')).parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    if args.model == 'sivae':
+        model = SoftIntroVAE(nc=args.nc, zdim=args.zdim, channels=tuple(args.channels), image_size=args.image_size)
+    else:
+        model = BetaVAE_H(z_dim=args.zdim, nc=args.nc, additional_layer=args.image_size >= 128)
+
+    for name in ['eager', 'compiled']:
+        variant = copy.deepcopy(model)
+        if name == 'compiled':
+            compile_model(variant, {'enabled': True, 'mode': args.mode})
+        if args.model == 'sivae':
+            step = make_trainer(args, variant)._train_step
+        else:
+            step = get_betavae_step(variant, args)
+        warmup_time, step_time = time_steps(step, args)
+        print(f'{name:>9}: {1000 * step_time:8.1f} ms/step (first {args.nr_warmup} steps incl. compilation: '
+              f'{warmup_time:.1f} s)')
@@ -0,0 +1,72 @@
+"""
+bench_inference.py
+
+CPU latency of SoftIntroVAE evaluation passes (model(x, deterministic=True) under no_grad, as in the latent export of
+PDownstreamEvaluator) with the model in eval mode vs. SoftIntroVAE.optimize_for_inference (BatchNorm folding, with and
+without channels_last). The outputs of the optimized models are compared to the eval model.
+
+python benchmarks/bench_inference.py --batch_size 64 --image_size 128 --nr_steps 10
+"""
+import argparse
+import copy
+import sys
+from time import time
+
+import torch
+
+sys.path.insert(0, './')
+from model_zoo.soft_intro_vae_daniel import SoftIntroVAE
+
+
+def get_variants(model):
+    model = model.eval()
+    return {'eval': model,
+            'fused': copy.deepcopy(model).optimize_for_inference(channels_last=False),
+            'fused_channels_last': copy.deepcopy(model).optimize_for_inference(channels_last=True)}
+
+
+def time_forward(model, x, args):
+    with torch.no_grad():
+        for _ in range(args.nr_warmup):
+            model(x, deterministic=True)
+        start = time()
+        for _ in range(args.nr_steps):
+            model(x, deterministic=True)
+    return (time() - start) / args.nr_steps
+
+
+def add_args(parser):
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--nc', type=int, default=2)
+    parser.add_argument('--zdim', type=int, default=128)
+    parser.add_argument('--channels', type=int, nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('--nr_warmup', type=int, default=2)
+    parser.add_argument('--nr_steps', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    return parser
+
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='Soft-Intro VAE inference benchmark')).parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    model = SoftIntroVAE(nc=args.nc, zdim=args.zdim, channels=tuple(args.channels), image_size=args.image_size)
+    # non-trivial running statistics, as after training
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.rand(args.batch_size, args.nc, args.image_size, args.image_size))
+    x = torch.rand(args.batch_size, args.nc, args.image_size, args.image_size)
+
+    variants = get_variants(model)
+    with torch.no_grad():
+        reference, reference_z = variants['eval'](x, deterministic=True)
+    for name, variant in variants.items():
+        step_time = time_forward(variant, x, args)
+        with torch.no_grad():
+            y, f_result = variant(x, deterministic=True)
+        diff = max((y - reference).abs().max().item(), (f_result['z'] - reference_z['z']).abs().max().item())
+        print(f'{name:>20}: {1000 * step_time:8.1f} ms/batch (max abs. difference to eval: {diff:.2e})')
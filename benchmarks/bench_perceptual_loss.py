@@ -0,0 +1,110 @@
+"""
+bench_perceptual_loss.py
+
+CPU latency of the perceptual losses of one Soft-Intro VAE training step with loss_type: pl (forward and backward):
+the previous PerceptualLoss (one VGG forward per channel, for input and target separately) vs. PerceptualLoss
+(channels folded into the batch, one VGG forward for the images with gradient and one without graph for the
+others), with the features cached over the step (cache()) and with detach_target. The calls are the ones of PTrainer._train_step: (rec, real), (rec_rec, rec), (rec_fake, fake.detach())
+in the encoder phase and (rec_rec, rec), (rec_fake, fake) in the decoder phase. The losses and gradients are
+compared to the previous loss (detach_target changes the gradients by design).
+
+python benchmarks/bench_perceptual_loss.py --batch_size 16 --image_size 64 --nr_steps 5
+"""
+import argparse
+from time import time
+
+import torch
+import torch.nn.functional as F
+
+import sys
+sys.path.insert(0, './')
+from optim.losses.image_losses import PerceptualLoss
+
+
+def loop_perceptual_loss(loss_network, input, target):
+    """ PerceptualLoss.forward before batching the channels """
+    loss_pl = 0
+    for i in range(input.size(1)):
+        input_features = loss_network(input[:, i:i + 1, :, :].repeat(1, 3, 1, 1))
+        output_features = loss_network(target[:, i:i + 1, :, :].repeat(1, 3, 1, 1))
+        for output_feature, input_feature in zip(output_features, input_features):
+            loss_pl += F.mse_loss(output_feature, input_feature)
+    return loss_pl
+
+
+def get_inputs(args):
+    torch.manual_seed(0)
+    shape = (args.batch_size, args.nc, args.image_size, args.image_size)
+    real = torch.rand(shape)
+    # decoder outputs (leaves here), with gradients
+    rec, fake, rec_rec, rec_fake, rec_rec_d, rec_fake_d = [torch.rand(shape, requires_grad=True) for _ in range(6)]
+    return real, rec, fake, rec_rec, rec_fake, rec_rec_d, rec_fake_d
+
+
+def step_losses(loss_fn, inputs):
+    """ Perceptual losses of one training step """
+    real, rec, fake, rec_rec, rec_fake, rec_rec_d, rec_fake_d = inputs
+    loss_e = loss_fn(rec, real) + loss_fn(rec_rec, rec) + loss_fn(rec_fake, fake.detach())
+    loss_d = loss_fn(rec_rec_d, rec) + loss_fn(rec_fake_d, fake)
+    return loss_e + loss_d
+
+
+def get_variants(criterion):
+    def cached(inputs):
+        with criterion.cache():
+            return step_losses(criterion, inputs)
+    return {'loop': lambda inputs: step_losses(lambda x, y: loop_perceptual_loss(criterion.loss_network, x, y),
+                                               inputs),
+            'batched': lambda inputs: step_losses(criterion, inputs),
+            'cached': cached}
+
+
+def time_variant(variant, inputs, args):
+    def step():
+        loss = variant(inputs)
+        loss.backward()
+        for x in inputs:
+            x.grad = None
+    for _ in range(args.nr_warmup):
+        step()
+    start = time()
+    for _ in range(args.nr_steps):
+        step()
+    return (time() - start) / args.nr_steps
+
+
+def add_args(parser):
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--nc', type=int, default=2)
+    parser.add_argument('--nr_warmup', type=int, default=1)
+    parser.add_argument('--nr_steps', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    return parser
+
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='Perceptual loss benchmark')).parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    inputs = get_inputs(args)
+    grad_inputs = [x for x in inputs if x.requires_grad]
+    criterion = PerceptualLoss(device='cpu')
+    detached = PerceptualLoss(device='cpu', detach_target=True)
+    variants = get_variants(criterion)
+    variants['cached_detach'] = get_variants(detached)['cached']
+    results = {}
+    for name, variant in variants.items():
+        loss = variant(inputs)
+        # with detach_target, fake is a target only and has no gradient
+        grads = torch.autograd.grad(loss, grad_inputs, allow_unused=True)
+        results[name] = (loss.detach(), [torch.zeros_like(x) if grad is None else grad
+                                         for x, grad in zip(grad_inputs, grads)])
+        print(f'{name:>14}: {1000 * time_variant(variant, inputs, args):9.1f} ms/step (forward + backward)')
+    loop_loss, loop_grads = results['loop']
+    for name, (loss, grads) in results.items():
+        if name != 'loop':
+            diff = max((grad - loop_grad).abs().max().item() for grad, loop_grad in zip(grads, loop_grads))
+            print(f'{name:>14}: loss {loss.item():.6f} (loop {loop_loss.item():.6f}), '
+                  f'max abs. gradient difference to loop: {diff:.2e}')
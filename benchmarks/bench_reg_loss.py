@@ -0,0 +1,135 @@
+"""
+bench_reg_loss.py
+
+CPU latency of the attribute regularization (forward and backward w.r.t. the latent codes): the previous loop over
+the attribute dimensions with reg_loss_sign (N x N matrices per dimension) vs. compute_reg_loss (all dimensions at
+once, pairs i < j only) vs. compute_reg_loss with tile_size (TiledRegLoss, blocks of rows) vs. the estimators of
+estimate_reg_loss (--nr_pairs: sampled, --window: window). The losses and gradients are compared to the loop, for the
+estimators together with their error bound. With --memory, each variant runs in its own process and reports its peak
+resident memory.
+
+python benchmarks/bench_reg_loss.py --batch_size 128 --reg_dim 6 --nr_steps 200
+python benchmarks/bench_reg_loss.py --batch_size 4096 --tile_size 256 --nr_steps 2 --memory
+python benchmarks/bench_reg_loss.py --batch_size 4096 --tile_size 256 --nr_pairs 32 --window 64 --nr_steps 2
+"""
+import argparse
+import json
+import math
+import resource
+import subprocess
+import sys
+from time import time
+
+import torch
+
+sys.path.insert(0, './')
+from optim.losses.image_losses import compute_reg_loss, reg_loss_sign
+
+
+def loop_reg_loss(z, attr, factor):
+    """ compute_reg_loss before vectorization """
+    reg_loss = 0.0
+    for dim in range(attr.size()[1]):
+        reg_loss += reg_loss_sign(z[:, dim], attr[:, dim], factor)
+    return reg_loss
+
+
+def get_variants(args):
+    variants = {'loop': loop_reg_loss, 'vectorized': compute_reg_loss}
+    if args.tile_size is not None:
+        variants['tiled'] = lambda z, attr, factor: compute_reg_loss(z, attr, factor, tile_size=args.tile_size)
+    if args.nr_pairs is not None:
+        variants['sampled'] = lambda z, attr, factor: compute_reg_loss(
+            z, attr, factor, estimator={'mode': 'sampled', 'nr_pairs': args.nr_pairs})
+    if args.window is not None:
+        variants['window'] = lambda z, attr, factor: compute_reg_loss(
+            z, attr, factor, estimator={'mode': 'window', 'window': args.window})
+    return variants
+
+
+def get_error_bound(name, args, delta=0.01):
+    """ Error bound of the estimators of estimate_reg_loss (with probability 1 - delta for sampled) """
+    n, reg_dim = args.batch_size, args.reg_dim
+    if name == 'sampled':
+        return reg_dim * math.sqrt(2 * math.log(2 * reg_dim / delta) / (n * args.nr_pairs))
+    if name == 'window':
+        window = min(args.window, n - 1)
+        nr_window_pairs = window * n - window * (window + 1) // 2
+        return 2 * reg_dim * (1 - 1 / n) * (1 - nr_window_pairs / (n * (n - 1) / 2))
+    return None
+
+
+def get_inputs(args):
+    torch.manual_seed(0)
+    z = torch.randn(args.batch_size, args.zdim, requires_grad=True)
+    # attribute values with ties, as the volumes of the data sets
+    attr = torch.randint(0, 20, (args.batch_size, args.reg_dim)).float()
+    return z, attr
+
+
+def time_loss(loss_fn, z, attr, args):
+    def step():
+        loss = loss_fn(z, attr, args.factor)
+        loss.backward()
+        z.grad = None
+    for _ in range(args.nr_warmup):
+        step()
+    start = time()
+    for _ in range(args.nr_steps):
+        step()
+    return (time() - start) / args.nr_steps
+
+
+def run_variant(args):
+    """ Peak resident memory of one variant (own process) """
+    z, attr = get_inputs(args)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    step_time = time_loss(get_variants(args)[args.variant], z, attr, args)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'step_ms': 1000 * step_time, 'peak_rss_increase_mb': (rss - rss_before) / 1024}))
+
+
+def add_args(parser):
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--reg_dim', type=int, default=6)
+    parser.add_argument('--zdim', type=int, default=128)
+    parser.add_argument('--factor', type=float, default=10.0)
+    parser.add_argument('--tile_size', type=int, default=None, help='also run the tiled loss')
+    parser.add_argument('--nr_pairs', type=int, default=None, help='also run the sampled estimator')
+    parser.add_argument('--window', type=int, default=None, help='also run the window estimator')
+    parser.add_argument('--memory', action='store_true', help='peak memory of each variant (own process)')
+    parser.add_argument('--variant', type=str, default=None, help='run a single variant (used by --memory)')
+    parser.add_argument('--nr_warmup', type=int, default=10)
+    parser.add_argument('--nr_steps', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    return parser
+
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='Attribute regularization benchmark')).parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.variant is not None:
+        run_variant(args)
+    elif args.memory:
+        for name in get_variants(args).keys():
+            out = subprocess.run([sys.executable, __file__, '--variant', name, '--nr_warmup', '0'] + sys.argv[1:],
+                                 capture_output=True, text=True, check=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{name:>10}: {result['step_ms']:10.1f} ms/step, peak RSS +{result['peak_rss_increase_mb']:.0f} MB")
+    else:
+        z, attr = get_inputs(args)
+        results = {}
+        for name, loss_fn in get_variants(args).items():
+            loss = loss_fn(z, attr, args.factor)
+            grad, = torch.autograd.grad(loss, z)
+            results[name] = (loss.detach(), grad)
+            print(f'{name:>10}: {1000 * time_loss(loss_fn, z, attr, args):8.3f} ms/step (forward + backward)')
+        loop_loss, loop_grad = results['loop']
+        for name, (loss, grad) in results.items():
+            if name != 'loop':
+                bound = get_error_bound(name, args)
+                print(f'{name:>10}: loss {loss.item():.8f} (loop {loop_loss.item():.8f}), '
+                      f'max abs. gradient difference to loop: {(grad - loop_grad).abs().max().item():.2e}'
+                      + (f', error bound {bound:.4f}' if bound is not None else ''))
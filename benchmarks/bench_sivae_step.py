@@ -0,0 +1,208 @@
+"""
+bench_sivae_step.py
+
+CPU benchmark of one Soft-Intro VAE training step (encoder + decoder update) of SIVAETrainer.PTrainer:
+the previous two-phase step (requires_grad switching, decoder recomputed in the decoder phase) vs.
+PTrainer._train_step, with separate or concatenated rec/fake forward passes.
+Each variant runs in its own process so that the peak resident memory (ru_maxrss) is not shared.
+
+python benchmarks/bench_sivae_step.py --batch_size 32 --image_size 64 --nr_steps 10
+python benchmarks/bench_sivae_step.py --check  # legacy and fused steps give the same weights
+python benchmarks/bench_sivae_step.py --amp bfloat16  # fused steps under CPU bfloat16 autocast
+"""
+import argparse
+import copy
+import json
+import resource
+import subprocess
+import sys
+from time import time
+
+import torch
+
+sys.path.insert(0, './')
+from torch.optim.adam import Adam
+from model_zoo.soft_intro_vae_daniel import SoftIntroVAE, calc_kl, calc_reconstruction_loss, reparameterize
+from optim.losses.image_losses import PerceptualLoss, compute_reg_loss
+from core.Trainer import StepProfiler
+from projects.interp_rep.SIVAETrainer import PTrainer
+
+MODES = ['legacy', 'fused', 'fused_concat']
+
+
+def legacy_step(self, real_batch, attributes):
+    """ Training step of PTrainer.train before _train_step (mse / l1 losses) """
+    b = real_batch.shape[0]
+    noise_batch = torch.randn(size=(b, self.model.zdim)).to(self.device)
+
+    for param in self.model.encoder.parameters():
+        param.requires_grad = True
+    for param in self.model.decoder.parameters():
+        param.requires_grad = False
+
+    fake = self.model.sample(noise_batch)
+    real_mu, real_logvar = self.model.encode(real_batch)
+    z = reparameterize(real_mu, real_logvar)
+    rec = self.model.decoder(z)
+    loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type=self.loss_type, reduction="mean")
+    lossE_real_kl = calc_kl(real_logvar, real_mu, reduce="mean")
+
+    rec_rec, z_dict = self.model(rec.detach(), deterministic=False)
+    rec_mu, rec_logvar = z_dict['z_mu'], z_dict['z_logvar']
+    rec_fake, z_dict_fake = self.model(fake.detach(), deterministic=False)
+    fake_mu, fake_logvar = z_dict_fake['z_mu'], z_dict_fake['z_logvar']
+    kl_rec = calc_kl(rec_logvar, rec_mu, reduce="none")
+    kl_fake = calc_kl(fake_logvar, fake_mu, reduce="none")
+
+    loss_rec_rec_e = calc_reconstruction_loss(rec, rec_rec, loss_type=self.loss_type, reduction="none")
+    while len(loss_rec_rec_e.shape) > 1:
+        loss_rec_rec_e = loss_rec_rec_e.sum(-1)
+    loss_rec_fake_e = calc_reconstruction_loss(fake, rec_fake, loss_type=self.loss_type, reduction="none")
+    while len(loss_rec_fake_e.shape) > 1:
+        loss_rec_fake_e = loss_rec_fake_e.sum(-1)
+
+    expelbo_rec = (-2 * self.scale * (self.beta_rec * loss_rec_rec_e + self.beta_neg * kl_rec)).exp().mean()
+    expelbo_fake = (-2 * self.scale * (self.beta_rec * loss_rec_fake_e + self.beta_neg * kl_fake)).exp().mean()
+    lossE_fake = 0.25 * (expelbo_rec + expelbo_fake)
+    lossE_real = self.scale * (self.beta_rec * loss_rec + self.beta_kl * lossE_real_kl)
+    loss_reg = self.reg_loss * compute_reg_loss(z, attributes, self.factor)
+    lossE = lossE_real + lossE_fake + loss_reg
+
+    self.optimizer_e.zero_grad()
+    lossE.backward()
+    self.optimizer_e.step()
+
+    for param in self.model.encoder.parameters():
+        param.requires_grad = False
+    for param in self.model.decoder.parameters():
+        param.requires_grad = True
+
+    fake = self.model.sample(noise_batch)
+    rec = self.model.decoder(z.detach())
+    loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type=self.loss_type, reduction="mean")
+    rec_mu, rec_logvar = self.model.encode(rec)
+    z_rec = reparameterize(rec_mu, rec_logvar)
+    fake_mu, fake_logvar = self.model.encode(fake)
+    z_fake = reparameterize(fake_mu, fake_logvar)
+    rec_rec = self.model.decode(z_rec.detach())
+    rec_fake = self.model.decode(z_fake.detach())
+    loss_rec_rec = calc_reconstruction_loss(rec.detach(), rec_rec, loss_type=self.loss_type, reduction="mean")
+    loss_fake_rec = calc_reconstruction_loss(fake.detach(), rec_fake, loss_type=self.loss_type, reduction="mean")
+    lossD_rec_kl = calc_kl(rec_logvar, rec_mu, reduce="mean")
+    lossD_fake_kl = calc_kl(fake_logvar, fake_mu, reduce="mean")
+    lossD = self.scale * (loss_rec * self.beta_rec + (
+            lossD_rec_kl + lossD_fake_kl) * 0.5 * self.beta_kl + self.gamma_r * 0.5 * self.beta_rec * (
+                                     loss_rec_rec + loss_fake_rec))
+    self.optimizer_d.zero_grad()
+    lossD.backward()
+    self.optimizer_d.step()
+    return {'lossE': lossE.detach(), 'lossD': lossD.detach()}
+
+
+def make_trainer(args, model=None):
+    """ PTrainer with the attributes used by the training step only (no data module, no wandb) """
+    trainer = PTrainer.__new__(PTrainer)
+    trainer.device = torch.device('cpu')
+    trainer.model = model if model is not None else SoftIntroVAE(nc=args.nc, zdim=args.zdim,
+                                                                 channels=tuple(args.channels),
+                                                                 image_size=args.image_size)
+    trainer.optimizer_e = Adam(trainer.model.encoder.parameters(), lr=1e-4)
+    trainer.optimizer_d = Adam(trainer.model.decoder.parameters(), lr=1e-4)
+    trainer.scale = 1 / (args.image_size ** 2)
+    trainer.gamma_r, trainer.beta_kl, trainer.beta_rec, trainer.beta_neg = 1e-8, 1.0, 0.8, 1024.0
+    trainer.reg_loss, trainer.factor, trainer.gather_reg_loss, trainer.reg_tile_size = 0.05, 10.0, True, None
+    trainer.reg_estimator, trainer.reg_memory_bank = None, None
+    trainer.loss_type, trainer.annealing, trainer.annealing_mse = args.loss_type, 100, 0.1
+    trainer.concat_forward = False
+    trainer.device_type, trainer.amp_enabled = 'cpu', args.amp is not None
+    trainer.amp_dtype = getattr(torch, args.amp) if args.amp is not None else torch.bfloat16
+    trainer.scaler_e, trainer.scaler_d = trainer.get_grad_scaler(), trainer.get_grad_scaler()
+    trainer.profiler = StepProfiler(None, 'cpu')
+    if args.loss_type == 'pl':
+        trainer.criterion_PL = PerceptualLoss(device='cpu')
+    return trainer
+
+
+def get_batch(args):
+    return torch.rand(args.batch_size, args.nc, args.image_size, args.image_size), \
+        torch.rand(args.batch_size, 6) * 100
+
+
+def cached_step(trainer):
+    """ _train_step with the perceptual features cached over the step, as in PTrainer.train """
+    def step(real_batch, attributes):
+        if trainer.loss_type != 'pl':
+            return trainer._train_step(real_batch, attributes)
+        with trainer.criterion_PL.cache():
+            return trainer._train_step(real_batch, attributes)
+    return step
+
+
+def run(args):
+    torch.manual_seed(0)
+    trainer = make_trainer(args)
+    trainer.concat_forward = args.mode == 'fused_concat'
+    step = (lambda x, a: legacy_step(trainer, x, a)) if args.mode == 'legacy' else cached_step(trainer)
+    real_batch, attributes = get_batch(args)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(args.nr_warmup):
+        step(real_batch, attributes)
+    start = time()
+    for _ in range(args.nr_steps):
+        step(real_batch, attributes)
+    step_time = (time() - start) / args.nr_steps
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode': args.mode, 'step_ms': 1000 * step_time, 'peak_rss_mb': rss / 1024,
+                      'rss_before_steps_mb': rss_before / 1024}))
+
+
+def check(args):
+    """ Same initial weights and random draws: the weights after a few steps have to be the same """
+    torch.manual_seed(0)
+    model = SoftIntroVAE(nc=args.nc, zdim=args.zdim, channels=tuple(args.channels), image_size=args.image_size)
+    legacy, fused = make_trainer(args, model), make_trainer(args, copy.deepcopy(model))
+    for i in range(3):
+        real_batch, attributes = get_batch(args)
+        torch.manual_seed(i)
+        loss_legacy = legacy_step(legacy, real_batch, attributes)
+        torch.manual_seed(i)
+        loss_fused = fused._train_step(real_batch, attributes)
+        print(f'step {i}: lossE {loss_legacy["lossE"].item():.6f} / {loss_fused["lossE"].item():.6f}, '
+              f'lossD {loss_legacy["lossD"].item():.6f} / {loss_fused["lossD"].item():.6f}')
+    diff = max((p_l - p_f).abs().max().item() for p_l, p_f in zip(legacy.model.parameters(),
+                                                                  fused.model.parameters()))
+    print(f'max parameter difference after 3 steps: {diff:.3e}')
+
+
+def add_args(parser):
+    parser.add_argument('--mode', type=str, default=None, choices=MODES, help='run a single variant')
+    parser.add_argument('--check', action='store_true', help='compare the legacy and fused updates')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--nc', type=int, default=2)
+    parser.add_argument('--zdim', type=int, default=128)
+    parser.add_argument('--channels', type=int, nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('--loss_type', type=str, default='mse', choices=['mse', 'l1', 'pl'])
+    parser.add_argument('--amp', type=str, default=None, choices=['bfloat16'], help='autocast dtype of the fused step')
+    parser.add_argument('--nr_warmup', type=int, default=2)
+    parser.add_argument('--nr_steps', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    return parser
+
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='Soft-Intro VAE training step benchmark')).parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.check:
+        check(args)
+    elif args.mode is not None:
+        run(args)
+    else:
+        argv = [arg for arg in sys.argv[1:]]
+        for mode in MODES:
+            out = subprocess.run([sys.executable, __file__, '--mode', mode] + argv, capture_output=True, text=True,
+                                 check=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{mode:>13}: {result['step_ms']:8.1f} ms/step, peak RSS {result['peak_rss_mb']:7.0f} MB "
+                  f"(+{result['peak_rss_mb'] - result['rss_before_steps_mb']:.0f} MB during the steps)")
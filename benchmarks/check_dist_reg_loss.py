@@ -0,0 +1,111 @@
+"""
+check_dist_reg_loss.py
+
+Check of the attribute regularization gathered over the ranks (compute_reg_loss_distributed, AttriLoss with
+gather=True) in a multi-process gloo group on the CPU. The ranks hold uneven parts of one batch (5 and 3 samples by
+default). On every rank, the gathered loss has to equal compute_reg_loss of the whole batch, and the gradients of a
+linear encoder averaged over the ranks (Trainer.sync_gradients) the gradients of the whole batch, for one batch and
+for the accumulated path (Trainer.get_reg_grads over micro-batches).
+
+python benchmarks/check_dist_reg_loss.py
+python benchmarks/check_dist_reg_loss.py --batch_sizes 4 1 3 --tile_size 2
+"""
+import argparse
+import os
+import sys
+
+import torch
+import torch.multiprocessing as mp
+
+sys.path.insert(0, './')
+from core.Trainer import Trainer
+from dl_utils.dist_utils import cleanup_distributed, init_distributed
+from optim.losses.image_losses import compute_reg_loss, compute_reg_loss_distributed
+from projects.interp_rep.losses_VAE import AttriLoss
+
+
+def get_data(args):
+    generator = torch.Generator().manual_seed(0)
+    nr_samples = sum(args.batch_sizes)
+    return torch.randn(nr_samples, 12, generator=generator), \
+        torch.randint(0, 5, (nr_samples, args.reg_dim), generator=generator).float()
+
+
+def get_encoder(args):
+    torch.manual_seed(0)
+    return torch.nn.Linear(12, args.zdim)
+
+
+def get_losses(args):
+    """ Distributed loss and its single-process reference, by name """
+    return {'compute_reg_loss': (lambda z, attr: compute_reg_loss_distributed(z, attr, args.factor, args.tile_size),
+                                 lambda z, attr: compute_reg_loss(z, attr, args.factor, args.tile_size)),
+            'AttriLoss': (AttriLoss(1.0, args.factor, gather=True, tile_size=args.tile_size).regularization,
+                          AttriLoss(1.0, args.factor, gather=False, tile_size=args.tile_size).regularization)}
+
+
+def get_gradients(encoder, loss):
+    grads = [param.grad.clone() for param in encoder.parameters()]
+    encoder.zero_grad()
+    return loss.detach(), grads
+
+
+def run(rank, args):
+    init_distributed(rank, len(args.batch_sizes), 'gloo')
+    try:
+        x, attr = get_data(args)
+        start = sum(args.batch_sizes[:rank])
+        local = slice(start, start + args.batch_sizes[rank])
+        encoder = get_encoder(args)
+        optimizer = torch.optim.SGD(encoder.parameters(), lr=1.0)
+        for name, (loss_fn, reference_fn) in get_losses(args).items():
+            loss = reference_fn(encoder(x), attr)
+            loss.backward()
+            reference_loss, reference_grads = get_gradients(encoder, loss)
+
+            # one batch
+            loss = loss_fn(encoder(x[local]), attr[local])
+            loss.backward()
+            Trainer.sync_gradients(optimizer)
+            results = {'batch': get_gradients(encoder, loss)}
+
+            # accumulated: loss of the latent codes of two micro-batches, enters through its gradient w.r.t. z
+            z = encoder(x[local])
+            split = max(1, len(z) // 2)
+            loss, reg_grads = Trainer.get_reg_grads([z.detach()[:split], z.detach()[split:]],
+                                                    lambda latents: loss_fn(latents, attr[local]))
+            (z * torch.cat(reg_grads)).sum().backward()
+            Trainer.sync_gradients(optimizer)
+            results['accumulated'] = get_gradients(encoder, loss)
+
+            for path, (loss, grads) in results.items():
+                loss_diff = (loss - reference_loss).abs().item()
+                grad_diff = max((grad - reference_grad).abs().max().item()
+                                for grad, reference_grad in zip(grads, reference_grads))
+                print(f'rank {rank} {name:>16} {path:>11}: loss difference {loss_diff:.2e}, '
+                      f'gradient difference {grad_diff:.2e}', flush=True)
+                assert loss_diff <= args.tolerance, f'[check_dist_reg_loss] {name} {path}: loss differs on rank {rank}'
+                assert grad_diff <= args.tolerance, \
+                    f'[check_dist_reg_loss] {name} {path}: gradients differ on rank {rank}'
+    finally:
+        cleanup_distributed()
+
+
+def add_args(parser):
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[5, 3], help='samples of each rank')
+    parser.add_argument('--reg_dim', type=int, default=3)
+    parser.add_argument('--zdim', type=int, default=6)
+    parser.add_argument('--factor', type=float, default=10.0)
+    parser.add_argument('--tile_size', type=int, default=None)
+    parser.add_argument('--tolerance', type=float, default=1e-5)
+    parser.add_argument('--master_port', type=str, default='29541')
+    return parser
+
+
+if __name__ == '__main__':
+    args = add_args(argparse.ArgumentParser(description='Distributed attribute regularization check')).parse_args()
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = args.master_port
+    torch.set_num_threads(1)
+    mp.spawn(run, args=(args,), nprocs=len(args.batch_sizes))
+    print('distributed attribute regularization: OK')
@@ -0,0 +1,187 @@
+"""
+CheckpointManager.py
+
+Checkpoints of the trainers: asynchronous, atomic writes and retention of the last epochs
+
+"""
+import atexit
+import copy
+import glob
+import logging
+import os
+import queue
+import random
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+
+class CheckpointManager:
+    """
+    Writes the checkpoints of a training run to checkpoint_path:
+    - model_epoch_<epoch>.pt: training state at the end of each epoch, the last keep_last epochs are kept
+    - latest_model.pt: the last of them (a hard link, or a copy if the file system does not support links)
+    - best_model.pt and other files written with save(), e.g., the weights with the best validation loss
+    save() copies the state to host memory, so that the training continues while a background thread serializes it.
+    Every file is written to a temporary file that is renamed once complete: an interrupted run never leaves a
+    truncated checkpoint behind.
+    """
+    def __init__(self, checkpoint_path, keep_last=3, async_save=True, enabled=True):
+        """
+        :param checkpoint_path: str
+            directory of the checkpoints
+        :param keep_last: int
+            number of epoch checkpoints kept, 0: latest_model.pt only
+        :param async_save: bool
+            write on a background thread (synchronous writes otherwise)
+        :param enabled: bool
+            False: nothing is written, e.g., on the ranks > 0 in distributed training
+        """
+        self.checkpoint_path = checkpoint_path
+        self.keep_last = keep_last
+        self.enabled = enabled and checkpoint_path is not None
+        # epoch checkpoints already on disk (resumed run), oldest first
+        self.epoch_files = sorted(glob.glob(os.path.join(checkpoint_path, 'model_epoch_*.pt'))) \
+            if self.enabled else []
+        self._error = None
+        self._queue, self._thread = None, None
+        if self.enabled and async_save:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._worker, name='CheckpointManager', daemon=True)
+            self._thread.start()
+            # pending checkpoints are written before the interpreter exits, also after an error
+            atexit.register(self.close)
+
+    @staticmethod
+    def snapshot(state):
+        """
+        Copy of state with its tensors copied to host memory, unaffected by the next training steps
+        """
+        if torch.is_tensor(state):
+            return state.detach().to('cpu', copy=True)
+        if isinstance(state, dict):
+            # copy of the dict type (e.g., the Counter of the milestones of MultiStepLR), values replaced
+            snapshot = copy.copy(state)
+            for key, value in state.items():
+                snapshot[key] = CheckpointManager.snapshot(value)
+            return snapshot
+        if isinstance(state, (list, tuple)):
+            return type(state)(CheckpointManager.snapshot(value) for value in state)
+        return copy.deepcopy(state)
+
+    def save(self, state, file_name):
+        """
+        Saves state to checkpoint_path/file_name
+        """
+        if not self.enabled:
+            return
+        self._submit(self._write, self.snapshot(state), os.path.join(self.checkpoint_path, file_name))
+
+    def save_epoch(self, state, epoch):
+        """
+        Saves the state of an epoch (model_epoch_<epoch>.pt and latest_model.pt) and deletes the epoch checkpoints
+        older than the last keep_last
+        """
+        if not self.enabled:
+            return
+        self._submit(self._write_epoch, self.snapshot(state), epoch)
+
+    def wait(self):
+        """
+        Blocks until the pending checkpoints are written, raises the error of a failed write
+        """
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Writes the pending checkpoints and stops the background thread (later checkpoints are written synchronously)
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue, self._thread = None, None
+        self._raise_error()
+
+    def _submit(self, fn, *args):
+        self._raise_error()
+        if self._queue is None:
+            fn(*args)
+        else:
+            self._queue.put((fn, args))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('[CheckpointManager::save] ERROR: Checkpoint could not be written') from error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args = item
+                fn(*args)
+            except Exception as e:
+                logging.error('[CheckpointManager::_worker] ERROR: {}'.format(e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(state, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _write_epoch(self, state, epoch):
+        latest_path = os.path.join(self.checkpoint_path, 'latest_model.pt')
+        if self.keep_last <= 0:
+            self._write(state, latest_path)
+            return
+        path = os.path.join(self.checkpoint_path, 'model_epoch_{:04d}.pt'.format(epoch))
+        self._write(state, path)
+        tmp_path = latest_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, latest_path)
+
+        if path in self.epoch_files:
+            self.epoch_files.remove(path)
+        self.epoch_files.append(path)
+        while len(self.epoch_files) > self.keep_last:
+            old_path = self.epoch_files.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    @staticmethod
+    def get_rng_states():
+        """
+        Global random states of the process (torch, CUDA, numpy, random), as plain types and tensors, so that the
+        checkpoint loads with torch.load(weights_only=True)
+        """
+        np_state = np.random.get_state()
+        return {'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+                'numpy': [np_state[0], np_state[1].tolist(), int(np_state[2]), int(np_state[3]), float(np_state[4])],
+                'random': random.getstate()}
+
+    @staticmethod
+    def set_rng_states(states):
+        torch.set_rng_state(states['torch'])
+        if len(states['cuda']) > 0 and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(states['cuda'])
+        name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+        random.setstate(tuple(tuple(item) if isinstance(item, list) else item for item in states['random']))
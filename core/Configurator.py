@@ -9,6 +9,8 @@ import logging
 import torch
 
 from dl_utils.config_utils import check_config_file, import_module, set_seed
+from dl_utils.dist_utils import barrier, get_local_rank, get_rank, get_world_size, is_main_process
+from net_utils.compile import compile_model
 
 class DLConfigurator(object):
     """
@@ -35,10 +37,19 @@ class DLConfigurator(object):
 
         # init model and device
         dev = self.dl_config['device']
-        self.device = torch.device('cuda:' + str(0) if torch.cuda.is_available() else 'cpu') if dev == 'gpu' else 'cpu'
+        # one device per process in distributed training (see core/DistributedMain.py)
+        self.device = torch.device('cuda:' + str(get_local_rank()) if torch.cuda.is_available() else 'cpu') \
+            if dev == 'gpu' else 'cpu'
 
         model_class = import_module(self.dl_config['model']['module_name'], self.dl_config['model']['class_name'])
         self.model = model_class(**(self.dl_config['model']['params']))
+        # optional torch.compile of the encoder / decoder: compile: {enabled: true, mode: default}. Applied before the
+        # trainers and downstream tasks copy the model, so that all of them use the compiled modules.
+        compile_params = self.dl_config['model']['compile'] if 'compile' in self.dl_config['model'].keys() else None
+        self.model = compile_model(self.model, compile_params)
+        # distributed training: the same initial model on all the ranks, but different random draws afterwards
+        if get_world_size() > 1:
+            set_seed(2109 + get_rank())
 
         self.log_wandb = log_wandb
 
@@ -60,14 +71,22 @@ class DLConfigurator(object):
             opt_state = global_model['optimizer_weights']
         if 'epoch' in global_model.keys():
             epoch = global_model['epoch']
+        if 'trainer_state' in global_model.keys():
+            # checkpoint of the end of an epoch (latest_model.pt): resume with the next epoch
+            self.trainer.load_training_state(global_model['trainer_state'])
+            epoch = global_model['epoch'] + 1
+            logging.info("[Configurator::train::INFO]: Training state loaded, resuming at epoch {}!".format(epoch))
 
         logging.info("[Configurator::train]: ################ Starting training ################")
         trained_model_state, trained_opt_state = self.trainer.train(model_state, opt_state, epoch)
         logging.info("[Configurator::train]: ################ Finished training ################")
-        logging.info("[Configurator::train]: ################ Starting testing ################")
-        self.trainer.test(trained_model_state, data.test_dataloader(), task='Test')
-        logging.info("[Configurator::train]: ################ Finished testing ################")
-        self.start_evaluations(trained_model_state)
+        # distributed training: testing and downstream tasks on rank 0 only
+        if is_main_process():
+            logging.info("[Configurator::train]: ################ Starting testing ################")
+            self.trainer.test(trained_model_state, data.test_dataloader(), task='Test')
+            logging.info("[Configurator::train]: ################ Finished testing ################")
+            self.start_evaluations(trained_model_state)
+        barrier()
 
     def start_evaluations(self, global_model):
         # Downstream Tasks
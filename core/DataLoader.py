@@ -6,18 +6,77 @@ Default class for data loaders from:
 - files in directory
 """
 from transforms.preprocessing import AddChannelIfNeeded, AssertChannelFirst, ReadImage, To01
+import torch
 import torchvision.transforms as transforms
 from torch.utils.data import Dataset, DataLoader
 import pytorch_lightning as pl
 from dl_utils.data_utils import *
 from dl_utils.config_utils import *
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 import logging
 import glob
 
+# file lists and decoded images shared by all the datasets of the process, so that the loaders of every epoch or
+# experiment over the same data do not glob and decode the files again. The decoded images are evicted least
+# recently used first beyond the size of the cache; the datasets keep their own references to their images.
+_file_cache = {}
+_image_cache = OrderedDict()
+_image_cache_bytes = [0]
+
+
+def get_files(data_dir, file_type=''):
+    """
+    @param data_dir: list
+        directories or csv files
+    @return: list
+        sorted file names of all the directories (or the rows of the csv files)
+    """
+    key = (tuple(data_dir), file_type)
+    if key not in _file_cache:
+        if 'csv' in data_dir[0]:
+            _file_cache[key] = get_data_from_csv(data_dir)
+        else:
+            _file_cache[key] = [file for data_dir_i in data_dir for file in sorted(glob.glob(data_dir_i + file_type))]
+    return _file_cache[key]
+
+
+def get_nbytes(image):
+    return image.element_size() * image.nelement() if torch.is_tensor(image) else getattr(image, 'nbytes', 0)
+
+
+def decode_files(files, transform, key, num_workers=8, cache_size_mb=4096):
+    """
+    Decodes files with transform in a thread pool (file reading and most image decoders release the GIL)
+    @param key: hashable
+        everything the output of transform depends on besides the file, e.g., the dataset class and the target size
+    @param cache_size_mb: float
+        size of _image_cache, least recently used images are evicted beyond it (None: unbounded)
+    @return: list
+        decoded files, cached in _image_cache
+    """
+    decoded = {}
+    for file in dict.fromkeys(files):
+        if (file, key) in _image_cache:
+            _image_cache.move_to_end((file, key))
+            decoded[file] = _image_cache[(file, key)]
+    missing = [file for file in dict.fromkeys(files) if file not in decoded]
+    if len(missing) > 0:
+        with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+            for file, image in zip(missing, executor.map(transform, missing)):
+                decoded[file] = _image_cache[(file, key)] = image
+                _image_cache_bytes[0] += get_nbytes(image)
+    if cache_size_mb is not None:
+        while len(_image_cache) > 0 and _image_cache_bytes[0] > cache_size_mb * 2 ** 20:
+            _, image = _image_cache.popitem(last=False)
+            _image_cache_bytes[0] -= get_nbytes(image)
+    return [decoded[file] for file in files]
+
 
 class DefaultDataset(Dataset):
 
-    def __init__(self, data_dir, file_type='', label_dir=None, target_size=(64, 64)):
+    def __init__(self, data_dir, file_type='', label_dir=None, target_size=(64, 64), cache_images=False,
+                 decode_workers=8, cache_size_mb=4096):
         """
         @param data_dir: str
             path to directory or csv file containing data
@@ -31,26 +90,36 @@ class DefaultDataset(Dataset):
             label_transform, e.g., loading, resize, etc...
         @param: target_size: tuple (int, int), default: (64, 64)
             the desired output size
+        @param: cache_images: bool, default: False
+            decode all the images (and labels) once, in parallel, and keep them in memory
+        @param: decode_workers: int, default: 8
+            number of threads decoding the images of the cache
+        @param: cache_size_mb: float, default: 4096
+            size of the image cache shared by the datasets of the process (None: unbounded)
         """
         super(DefaultDataset, self).__init__()
         self.label_dir = label_dir
         self.target_size = target_size
-        if 'csv' in data_dir[0]:
-            self.files = get_data_from_csv(data_dir)
-        else:
-            self.files = [glob.glob(data_dir_i + file_type) for data_dir_i in data_dir]
+        self.files = get_files(data_dir, file_type)
         self.nr_items = len(self.files)
 
         logging.info('DefaultDataset::init(): Loading {} files from: {}'.format(self.nr_items, data_dir))
 
         self.im_t = self.get_image_transform()
         if label_dir is not None:
-            if 'csv' in label_dir[0]:
-                self.label_files = get_data_from_csv(label_dir)
-            else:
-                self.label_files = [glob.glob(label_dir_i + file_type) for label_dir_i in label_dir]
+            self.label_files = get_files(label_dir, file_type)
             self.seg_t = self.get_label_transform()
 
+        self.images, self.labels = None, None
+        if cache_images:
+            # the transforms of a subclass (get_image_transform, get_label_transform) may differ
+            dataset_type = type(self).__module__ + '.' + type(self).__qualname__
+            key = ('image', dataset_type, tuple(self.target_size))
+            self.images = decode_files(self.files, self.im_t, key, decode_workers, cache_size_mb)
+            if label_dir is not None:
+                self.labels = decode_files(self.label_files, self.seg_t, ('label', dataset_type,
+                                           tuple(self.target_size)), decode_workers, cache_size_mb)
+
     def get_image_transform(self):
         default_t = transforms.Compose([ReadImage(), To01(), AddChannelIfNeeded(),
                                         AssertChannelFirst(), transforms.Resize(self.target_size)])
@@ -63,11 +132,15 @@ class DefaultDataset(Dataset):
 
     def get_label(self, idx):
         if self.label_dir is not None:
+            if self.labels is not None:
+                return self.labels[idx]
             return self.seg_t(self.label_files[idx])
         else:
             return 0
 
     def __getitem__(self, idx):
+        if self.images is not None:
+            return self.images[idx], self.get_label(idx)
         return self.im_t(self.files[idx]), self.get_label(idx)
 
     def __len__(self):
@@ -84,8 +157,14 @@ class DefaultDataLoader(pl.LightningDataModule):
         self.file_type = args['file_type'] if 'file_type' in akeys else ''
         self.label_dir = args['label_dir'] if 'label_dir' in akeys else {'train': None, 'val': None, 'test': None}
         self.target_size = args['target_size'] if 'target_size' in akeys else (64, 64)
-        self.batch_size = args['batch_size'] if 'batchoz_size' in akeys else 8
+        self.batch_size = args['batch_size'] if 'batch_size' in akeys else 8
         self.num_workers = args['num_workers'] if 'num_workers' in akeys else 2
+        self.persistent_workers = args['persistent_workers'] if 'persistent_workers' in akeys else False
+        self.prefetch_factor = args['prefetch_factor'] if 'prefetch_factor' in akeys else 2
+        self.pin_memory = args['pin_memory'] if 'pin_memory' in akeys else True
+        self.cache_images = args['cache_images'] if 'cache_images' in akeys else False
+        self.decode_workers = args['decode_workers'] if 'decode_workers' in akeys else 8
+        self.cache_size_mb = args['cache_size_mb'] if 'cache_size_mb' in akeys else 4096
         assert type(self.data_dir) is dict, 'DefaultDataset::init():  data_dir variable should be a dictionary'
         if dataset_module is not None:
             assert 'module_name' in dataset_module.keys() and 'class_name' in dataset_module.keys(),\
@@ -93,39 +172,55 @@ class DefaultDataLoader(pl.LightningDataModule):
             self.ds_module = import_module(dataset_module['module_name'], dataset_module['class_name'])
         else:
             self.ds_module = import_module('core.DataLoader', 'DefaultDataset')
+        self.datasets = {}
+
+    def get_dataset(self, split):
+        """
+        Dataset of a split, created once and reused by all the loaders of this split
+        """
+        if split not in self.datasets:
+            kwargs = {}
+            if isinstance(self.ds_module, type) and issubclass(self.ds_module, DefaultDataset):
+                kwargs = {'cache_images': self.cache_images, 'decode_workers': self.decode_workers,
+                          'cache_size_mb': self.cache_size_mb}
+            self.datasets[split] = self.ds_module(self.data_dir[split], self.file_type,
+                                                  self.label_dir[split] if split in self.label_dir.keys() else None,
+                                                  self.target_size, **kwargs)
+        return self.datasets[split]
+
+    def get_loader_kwargs(self):
+        """
+        Worker related DataLoader arguments, prefetch_factor and persistent_workers are only valid with workers
+        """
+        kwargs = {'batch_size': self.batch_size, 'num_workers': self.num_workers, 'pin_memory': self.pin_memory}
+        if self.num_workers > 0:
+            kwargs['prefetch_factor'] = self.prefetch_factor
+            kwargs['persistent_workers'] = self.persistent_workers
+        return kwargs
 
     def train_dataloader(self):
         if 'train' not in self.data_dir.keys():
             return self.test_dataloader()
-        return DataLoader(self.ds_module(self.data_dir['train'], self.file_type, self.label_dir['train'],
-                                         self.target_size),
-                          batch_size=self.batch_size,
-                          num_workers=selvif.num_workers,
+        return DataLoader(self.get_dataset('train'),
                           shuffle=True,
                           drop_last=True,
-                          pin_memory=True,
+                          **self.get_loader_kwargs()
                           )
 
     def val_dataloader(self):
         if 'val' not in self.data_dir.keys():
             return self.test_dataloader()
-        return DataLoader(self.ds_module(self.data_dir['val'], self.file_type, self.label_dir['val'],
-                                         self.target_size),
-                          batch_size=self.batch_size,
-                          num_workers=self.num_workers,
+        return DataLoader(self.get_dataset('val'),
                           shuffle=False,
                           drop_last=False,
-                          pin_memory=True,
+                          **self.get_loader_kwargs()
                           )
 
     def test_dataloader(self):
         assert 'test' in self.data_dir.keys(), \
             'DefaultDatasets::init():  Please use the keywords [test] in the data_dir dictionary'
-        return DataLoader(self.ds_module(self.data_dir['test'], self.file_type, self.label_dir['test'],
-                                         self.target_size),
-                          batch_size=self.batch_size,
-                          num_workers=self.num_workers,
+        return DataLoader(self.get_dataset('test'),
                           shuffle=False,
                           drop_last=False,
-                          pin_memory=True,
+                          **self.get_loader_kwargs()
                           )
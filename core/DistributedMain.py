@@ -0,0 +1,81 @@
+"""
+DistributedMain.py
+- entry point of multi-process (torch.distributed) DL experiments: one process per GPU (nccl) or one process per
+  group of CPU cores (gloo), each training on its part of the training data with synchronized gradients
+
+python core/DistributedMain.py --config_path projects/interp_rep/config/config_SIVAE.yaml --nr_processes 4
+torchrun --nproc_per_node 4 core/DistributedMain.py --config_path ...  (processes started by torchrun)
+
+The batch size of the data loader is the batch size of each process.
+"""
+import argparse
+import logging
+import os
+import sys
+sys.path.insert(0, './')
+import torch
+import torch.multiprocessing as mp
+import yaml
+
+from core.Main import Main, add_args
+from dl_utils.dist_utils import cleanup_distributed, init_distributed
+
+LOG_LEVELS = {'INFO': logging.INFO, 'DEBUG': logging.DEBUG, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR}
+
+
+def run(rank, world_size, config_file, backend, log_level, nr_threads):
+    """
+    Experiment of one process
+    """
+    # rank 0 logs at log_level, the other ranks only report problems
+    logging.basicConfig(level=LOG_LEVELS[log_level] if rank == 0 else logging.WARNING)
+    if nr_threads is not None:
+        torch.set_num_threads(nr_threads)
+    init_distributed(rank, world_size, backend)
+    try:
+        Main(config_file).setup_experiment()
+    finally:
+        cleanup_distributed()
+
+
+def add_distributed_args(parser):
+    parser = add_args(parser)
+    parser.add_argument('--nr_processes', type=int, default=2,
+                        help='number of processes (ignored if started by torchrun)')
+    parser.add_argument('--backend', type=str, default=None, choices=['gloo', 'nccl'],
+                        help='default: nccl if the config device is gpu and CUDA is available, gloo otherwise')
+    parser.add_argument('--master_port', type=str, default='29500')
+    parser.add_argument('--nr_threads', type=int, default=None,
+                        help='torch threads per process, default: CPU cores / processes for the gloo backend')
+    return parser
+
+
+if __name__ == "__main__":
+    args = add_distributed_args(argparse.ArgumentParser(description='IML-DL distributed')).parse_args()
+    try:
+        with open(args.config_path, 'r') as stream_file:
+            config_file = yaml.load(stream_file, Loader=yaml.FullLoader)
+    except Exception:
+        logging.error('[DistributedMain::main] ERROR: Invalid configuration file at: {}, exiting...'
+                      .format(args.config_path))
+        exit()
+
+    backend = args.backend
+    if backend is None:
+        backend = 'nccl' if config_file['device'] == 'gpu' and torch.cuda.is_available() else 'gloo'
+
+    if 'RANK' in os.environ.keys() and 'WORLD_SIZE' in os.environ.keys():
+        # started by torchrun, which also sets MASTER_ADDR and MASTER_PORT
+        world_size = int(os.environ['WORLD_SIZE'])
+        nr_threads = args.nr_threads
+        if nr_threads is None and backend == 'gloo':
+            nr_threads = max(torch.get_num_threads() // int(os.environ.get('LOCAL_WORLD_SIZE', world_size)), 1)
+        run(int(os.environ['RANK']), world_size, config_file, backend, args.log_level, nr_threads)
+    else:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', args.master_port)
+        nr_threads = args.nr_threads
+        if nr_threads is None and backend == 'gloo':
+            nr_threads = max(torch.get_num_threads() // args.nr_processes, 1)
+        mp.spawn(run, args=(args.nr_processes, config_file, backend, args.log_level, nr_threads),
+                 nprocs=args.nr_processes, join=True)
@@ -11,6 +11,7 @@ import sys
 sys.path.insert(0, './')
 sys.path.append('/home/maxime.difolco/anaconda3/envs/iml_py308/lib/python3.8/site-packages')
 from dl_utils.config_utils import *
+from dl_utils.dist_utils import broadcast_object, is_main_process
 import warnings
 import os
 import wandb
@@ -26,7 +27,8 @@ class Main(object):
         warnings.filterwarnings(action='ignore')
         logging.info("[Main::setup_experiment]: ################ Starting setup ################")
         now = datetime.now()
-        date_time = now.strftime("%Y_%m_%d_%H_%M_%S_%f")
+        # same run name (checkpoint folder, wandb id) on all the ranks of distributed training
+        date_time = broadcast_object(now.strftime("%Y_%m_%d_%H_%M_%S_%f"))
         
         self.config_file['trainer']['params']['checkpoint_path'] += date_time
         for idx, dst_name in enumerate(self.config_file['downstream_tasks']):
@@ -34,10 +36,11 @@ class Main(object):
 
         checkpoint_path = f"{self.config_file['trainer']['params']['checkpoint_path']}/"
         if not os.path.exists(checkpoint_path):
-            os.makedirs(checkpoint_path)
+            os.makedirs(checkpoint_path, exist_ok=True)
         path_config = f"{checkpoint_path}/config.yaml"
-        with open(path_config, "w+") as f:
-            yaml.dump(self.config_file, f, sort_keys=False)
+        if is_main_process():
+            with open(path_config, "w+") as f:
+                yaml.dump(self.config_file, f, sort_keys=False)
 
         # Initialize Configurator
         if self.config_file['configurator'] is None:
@@ -55,14 +58,17 @@ class Main(object):
                      "################".format(exp_name, method_name))
 
         config_dict = dict(
-            yaml=config_file,
+            yaml=self.config_file,
             params=configurator.dl_config
         )
 
-        if log_wandb:
+        # distributed training: only rank 0 logs, wandb calls are no-ops on the other ranks
+        if log_wandb and is_main_process():
             wandb.init(project=exp_name, name=method_name, config=config_dict, id=date_time)
+        elif log_wandb:
+            wandb.init(mode='disabled')
 
-        device = 'cuda' if config_file['device'] == 'gpu' else 'cpu'
+        device = 'cuda' if self.config_file['device'] == 'gpu' else 'cpu'
         checkpoint = dict()
         if configurator.dl_config['experiment']['weights'] is not None:
             checkpoint = torch.load(configurator.dl_config['experiment']['weights'], map_location=torch.device(device))
@@ -6,12 +6,21 @@ Default class for running training
 """
 import wandb
 import copy
+import contextlib
+import json
+import logging
+from time import perf_counter
+import torch
 from dl_utils import *
 from torchsummary import summary
 from torch.nn import MSELoss, KLDivLoss
 from torch.optim.adam import Adam
 from torch.optim.lr_scheduler import ExponentialLR, CosineAnnealingLR, ReduceLROnPlateau, MultiStepLR
 from optim.losses import PerceptualLoss
+from data.device_loader import DeviceDataLoader
+from dl_utils.dist_utils import all_gather_array, all_gather_object, all_reduce_gradients, all_reduce_sum, \
+    get_rank, get_world_size, is_distributed, is_main_process
+from core.CheckpointManager import CheckpointManager
 import os
 
 
@@ -51,6 +60,268 @@ class EarlyStopping():
                 print('INFO: Early stopping')
                 return True
 
+    def state_dict(self):
+        return {'counter': self.counter, 'best_loss': None if self.best_loss is None else float(self.best_loss)}
+
+    def load_state_dict(self, state_dict):
+        self.counter = state_dict['counter']
+        self.best_loss = state_dict['best_loss']
+
+
+class RunningStats():
+    """
+    Sums of the per-batch training statistics of an epoch, kept on the device so that the training loop does
+    not wait for the device at every step. The sums are read back once by result().
+    The NaN flag is copied to the host asynchronously and read once the copy has completed, so a NaN is
+    reported a few steps late at most; with sync_every > 0 it is also checked synchronously every sync_every
+    steps (and always by result()).
+    """
+    def __init__(self, keys, device, sync_every=0):
+        """
+        :param keys: list
+            names of the statistics
+        :param sync_every: int
+            number of steps between two synchronous NaN checks, 0 to only check asynchronously
+        """
+        self.keys = keys
+        self.device = torch.device(device)
+        self.sync_every = sync_every
+        self.steps = 0
+        self.sums = torch.zeros(len(keys), device=self.device)
+        self.nan = torch.zeros((), dtype=torch.bool, device=self.device)
+        self._nan_host = torch.zeros((), dtype=torch.bool, pin_memory=self.device.type == 'cuda')
+        self._event = None
+
+    def update(self, values, check_nan=()):
+        """
+        :param values: dict
+            key: scalar tensor (or number) added to the sum of key
+        :param check_nan: tuple
+            tensors whose NaN values set the NaN flag
+        """
+        self.steps += 1
+        self.sums += torch.stack([torch.as_tensor(values[key], device=self.device).float().reshape(())
+                                  for key in self.keys])
+        for value in check_nan:
+            self.nan |= torch.isnan(value.detach()).any()
+
+    def is_nan(self):
+        """
+        :return: bool
+            True if a NaN was seen, as far as is known without waiting for the device
+        """
+        if self.device.type != 'cuda' or (self.sync_every > 0 and self.steps % self.sync_every == 0):
+            return bool(self.nan)
+        nan = False
+        if self._event is not None and self._event.query():
+            nan = bool(self._nan_host)
+            self._event = None
+        if self._event is None:
+            self._nan_host.copy_(self.nan, non_blocking=True)
+            self._event = torch.cuda.Event()
+            self._event.record()
+        return nan
+
+    def result(self):
+        """
+        :return: tuple
+            dict key: sum over the epoch, NaN flag (of all the ranks in distributed training)
+        """
+        sums, nan = dict(zip(self.keys, self.sums.tolist())), bool(self.nan)
+        return all_reduce_sum(sums), bool(all_reduce_sum(float(nan)))
+
+
+class StepProfiler():
+    """
+    Per-step timings of the phases of the training steps (data wait, host-to-device copy, forward, loss, backward,
+    optimizer), reported once per epoch: mean and percentiles per phase, samples/s and peak memory.
+    The time of nested phases counts for the innermost one only, e.g., a backward pass inside a loss phase. Phases
+    in a group (e.g., the E and D updates of Soft-Intro VAE) are reported as group/phase, per group and per phase.
+    Optionally records a torch.profiler trace of the steps [start_step, start_step + nr_steps) of the training.
+    The epoch clock (epoch_s, samples/s) starts with start_epoch (Trainer.set_epoch), or else at the first step of the
+    epoch, so that the validation, checkpointing and setup between two epochs do not count.
+    All the calls are no-ops when disabled.
+    """
+    def __init__(self, params, device, log_path=None):
+        """
+        :param params: dict
+            {enabled: true, output: [wandb, jsonl], sync: true, trace: {start_step: 10, nr_steps: 5}}
+            sync: synchronize CUDA at the phase boundaries, so that the kernels count for their phase (slower)
+        :param log_path: str
+            directory of profile.jsonl and of the traces
+        """
+        params = params if params is not None else {}
+        self.enabled = params['enabled'] if 'enabled' in params.keys() else False
+        self.output = params['output'] if 'output' in params.keys() else ['wandb', 'jsonl']
+        self.device = torch.device(device)
+        self.sync = (params['sync'] if 'sync' in params.keys() else True) and self.device.type == 'cuda'
+        self.trace = params['trace'] if 'trace' in params.keys() else None
+        self.log_path = log_path
+        self._null = contextlib.nullcontext()
+        self._trace_profile = None
+        self.global_step = 0
+        self._reset()
+
+    def _reset(self):
+        self._steps, self._step, self._stack, self._prefix = [], {}, [], ''
+        self._epoch_start = None
+        if self.enabled and self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def start_epoch(self):
+        """
+        Starts the epoch clock and the peak memory of the epoch, before the first batch is requested
+        """
+        if self.enabled:
+            self._reset()
+            self._epoch_start = perf_counter()
+
+    def phase(self, name):
+        """
+        Context of a phase of the current step
+        """
+        return self._phase(name) if self.enabled else self._null
+
+    def group(self, name):
+        """
+        Context of a group of phases, e.g., the encoder update
+        """
+        return self._group(name) if self.enabled else self._null
+
+    def iterate(self, loader):
+        """
+        Iterates over the training batches, one batch per step: the wait for a batch is the data phase
+        """
+        return self._iterate(loader) if self.enabled else loader
+
+    def _iterate(self, loader):
+        iterator = iter(loader)
+        while True:
+            start = perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._step_data_wait = perf_counter() - start
+            self._begin_step()
+            self._step['data'] = self._step_data_wait
+            yield batch
+            self._end_step()
+
+    @contextlib.contextmanager
+    def _group(self, name):
+        prefix = self._prefix
+        self._prefix = prefix + name + '/'
+        try:
+            yield
+        finally:
+            self._prefix = prefix
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        key = self._prefix + name
+        self._add_elapsed()
+        self._stack.append(key)
+        record = torch.profiler.record_function(key) if self._trace_profile is not None else self._null
+        try:
+            with record:
+                yield
+        finally:
+            self._add_elapsed()
+            self._stack.pop()
+
+    def _add_elapsed(self):
+        """
+        Adds the time since the last phase boundary to the current (innermost) phase
+        """
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        now = perf_counter()
+        if len(self._stack) > 0:
+            key = self._stack[-1]
+            self._step[key] = self._step.get(key, 0.0) + now - self._time
+        self._time = now
+
+    def _begin_step(self):
+        if self.trace is not None and self.global_step == self.trace['start_step']:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace_profile = torch.profiler.profile(activities=activities, profile_memory=True)
+            self._trace_profile.__enter__()
+        self._step = {}
+        self._step_start = perf_counter()
+        if self._epoch_start is None:
+            self._epoch_start = self._step_start - self._step_data_wait
+
+    def _end_step(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self._step['step'] = perf_counter() - self._step_start
+        self._steps.append(self._step)
+        self.global_step += 1
+        if self._trace_profile is not None and \
+                self.global_step >= self.trace['start_step'] + self.trace['nr_steps']:
+            self._stop_trace()
+
+    def _stop_trace(self):
+        self._trace_profile.__exit__(None, None, None)
+        if self.log_path is not None:
+            file_name = 'trace_step{}_rank{}.json'.format(self.trace['start_step'], get_rank())
+            self._trace_profile.export_chrome_trace(os.path.join(self.log_path, file_name))
+        self._trace_profile = None
+
+    def end_epoch(self, epoch, nr_samples):
+        """
+        Reports the timings of the steps of the epoch (to wandb and / or log_path/profile.jsonl)
+        :param nr_samples: int
+            number of training samples of the epoch (of all the ranks)
+        :return: dict
+            report, None if disabled
+        """
+        if not self.enabled:
+            return None
+        if self._trace_profile is not None:
+            self._stop_trace()
+        epoch_time = perf_counter() - self._epoch_start if self._epoch_start is not None else 0.0
+        report = {'epoch': epoch, 'nr_steps': len(self._steps), 'epoch_s': epoch_time,
+                  'samples_per_s': nr_samples / epoch_time if epoch_time > 0 else 0.0}
+
+        # per phase, per group (E/...) and per phase over the groups (.../forward)
+        series = {}
+        for key in {key for step in self._steps for key in step.keys()}:
+            names = [key] if '/' not in key else [key, key.split('/')[0], key.split('/')[-1]]
+            for name in names:
+                values = np.array([step.get(key, 0.0) for step in self._steps])
+                series[name] = series[name] + values if name in series.keys() else values
+        for name, values in sorted(series.items()):
+            report[name] = {'mean_ms': 1000 * float(values.mean()), 'p50_ms': 1000 * float(np.percentile(values, 50)),
+                            'p90_ms': 1000 * float(np.percentile(values, 90)),
+                            'p99_ms': 1000 * float(np.percentile(values, 99)),
+                            'share': float(values.sum() / epoch_time) if epoch_time > 0 else 0.0}
+        if self.device.type == 'cuda':
+            report['peak_memory_mb'] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        try:
+            import resource
+            report['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        except ImportError:
+            pass
+
+        if 'wandb' in self.output:
+            log = {}
+            for name, value in report.items():
+                if isinstance(value, dict):
+                    log.update({'Profiler/{}_{}'.format(name, stat): v for stat, v in value.items()})
+                elif name != 'epoch':
+                    log['Profiler/' + name] = value
+            log['_step_'] = epoch
+            wandb.log(log)
+        if 'jsonl' in self.output and self.log_path is not None and is_main_process():
+            with open(os.path.join(self.log_path, 'profile.jsonl'), 'a') as f:
+                f.write(json.dumps(report) + '\n')
+        self._reset()
+        return report
+
 class Trainer:
     def __init__(self, training_params, model, data, device, log_wandb=True):
         """
@@ -70,14 +341,30 @@ class Trainer:
         self.training_params = training_params
 
         self.train_ds, self.val_ds = data.train_dataloader(), data.val_dataloader()
+
+        # Optional device-resident dataset: device_data: {enabled: true, pin_memory: false}
+        device_data = training_params['device_data'] if 'device_data' in training_params.keys() else None
+        if device_data is not None and device_data['enabled']:
+            pin_memory = device_data['pin_memory'] if 'pin_memory' in device_data.keys() else False
+            self.train_ds = DeviceDataLoader(self.train_ds, device, shuffle=True, pin_memory=pin_memory)
+            self.val_ds = DeviceDataLoader(self.val_ds, device, shuffle=False, pin_memory=pin_memory)
         self.num_train_samples = len(self.train_ds) * self.train_ds.batch_size
 
         self.device = device
         self.model = model.train().to(self.device)
+
+        # Mixed precision: amp: {enabled: true, dtype: float16 | bfloat16}. float16 (CUDA only) uses loss scaling,
+        # bfloat16 also runs on CPU.
+        amp = training_params['amp'] if 'amp' in training_params.keys() else None
+        self.amp_enabled = amp is not None and amp['enabled']
+        self.device_type = torch.device(device).type
+        default_dtype = 'float16' if self.device_type == 'cuda' else 'bfloat16'
+        self.amp_dtype = getattr(torch, amp['dtype'] if amp is not None and 'dtype' in amp.keys() else default_dtype)
         self.test_model = copy.deepcopy(model.eval().to(self.device))
 
         patience = training_params['patience'] if 'patience' in training_params.keys() else 25
         self.early_stopping = EarlyStopping(patience=patience)
+        self.early_stop = False
 
         self.log_wandb = log_wandb
         if log_wandb:
@@ -132,18 +419,260 @@ class Trainer:
                 if transform_class is not None else None
 
         self.criterion_MSE = MSELoss().to(device)
-        self.criterion_PL = PerceptualLoss(device=device)
+        # pl_detach_target: no gradient through the perceptual features of the reference images
+        pl_detach_target = training_params['pl_detach_target'] if 'pl_detach_target' in training_params.keys() \
+            else False
+        self.criterion_PL = PerceptualLoss(device=device, detach_target=pl_detach_target)
         #self.criterion_KLD = KLDivLoss().to(device)
 
         self.min_val_loss = np.inf
+        self.epoch_position = 0
+        # steps between two synchronous NaN checks of the training loss (see RunningStats), 0: asynchronous only
+        self.sync_every = training_params['sync_every'] if 'sync_every' in training_params.keys() else 0
+        # gradient accumulation: accumulate_grad_batches loader batches per optimizer step (one logical batch),
+        # processed in micro-batches of micro_batch_size samples (default: the loader batches), see get_logical_batches
+        self.accumulate_grad_batches = training_params['accumulate_grad_batches'] \
+            if 'accumulate_grad_batches' in training_params.keys() else 1
+        self.micro_batch_size = training_params['micro_batch_size'] \
+            if 'micro_batch_size' in training_params.keys() else None
         self.alpha = training_params['alpha'] if 'alpha' in training_params.keys() else 0
 
         self.best_weights = self.model.state_dict()
         self.best_opt_weights = self.optimizer.state_dict()
 
+        # Per-phase step timings: profiler: {enabled: true, output: [wandb, jsonl], trace: {start_step: 10, nr_steps: 5}}
+        self.profiler = StepProfiler(training_params['profiler'] if 'profiler' in training_params.keys() else None,
+                                     device, training_params['checkpoint_path']
+                                     if 'checkpoint_path' in training_params.keys() else None)
+
+        # Checkpoints written on a background thread: checkpoint: {keep_last: 3, async: true}, see CheckpointManager
+        checkpoint = training_params['checkpoint'] if 'checkpoint' in training_params.keys() else {}
+        self.checkpoints = CheckpointManager(
+            training_params['checkpoint_path'] if 'checkpoint_path' in training_params.keys() else None,
+            keep_last=checkpoint['keep_last'] if 'keep_last' in checkpoint.keys() else 3,
+            async_save=checkpoint['async'] if 'async' in checkpoint.keys() else True,
+            enabled=is_main_process())
+
     def get_nr_train_samples(self):
         return self.num_train_samples
 
+    def autocast(self, enabled=True):
+        """
+        Autocast context of the forward passes and losses, a no-op if amp is not enabled.
+        Use enabled=False for the numerically sensitive terms, with inputs cast to float32.
+        """
+        return torch.autocast(device_type=self.device_type, dtype=self.amp_dtype,
+                              enabled=self.amp_enabled and enabled)
+
+    def get_grad_scaler(self):
+        """
+        Loss scaler of one optimizer, only active for float16 autocast on CUDA (a pass-through otherwise)
+        """
+        enabled = self.amp_enabled and self.amp_dtype == torch.float16 and self.device_type == 'cuda'
+        if hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler('cuda', enabled=enabled)
+        return torch.cuda.amp.GradScaler(enabled=enabled)
+
+    @staticmethod
+    def to_float(data):
+        """
+        Casts a tensor (or the tensors of a dict) produced under autocast back to float32
+        """
+        if isinstance(data, dict):
+            return {key: value.float() if torch.is_tensor(value) and value.is_floating_point() else value
+                    for key, value in data.items()}
+        return data.float()
+
+    def get_logical_batches(self, loader):
+        """
+        Groups accumulate_grad_batches consecutive batches of loader into one logical batch (one optimizer step), the
+        last logical batch of the epoch may be smaller.
+        :return: generator of tuples
+            (data of the logical batch, with the tensors of the batches concatenated, list of the micro-batch sizes)
+        """
+        batches = []
+        for data in loader:
+            batches.append(data)
+            if len(batches) == self.accumulate_grad_batches:
+                yield self.merge_batches(batches)
+                batches = []
+        if len(batches) > 0:
+            yield self.merge_batches(batches)
+
+    def merge_batches(self, batches):
+        sizes = [len(data[0]) for data in batches]
+        if len(batches) == 1:
+            data = batches[0]
+        else:
+            data = [torch.cat(fields) if torch.is_tensor(fields[0]) else [v for field in fields for v in field]
+                    for fields in zip(*batches)]
+        if self.micro_batch_size is not None:
+            nr_samples = sum(sizes)
+            sizes = [min(self.micro_batch_size, nr_samples - start)
+                     for start in range(0, nr_samples, self.micro_batch_size)]
+        return data, sizes
+
+    @staticmethod
+    def get_reg_grads(latents, reg_fn):
+        """
+        Loss over all the latent codes of a logical batch (e.g., the attribute regularization, which depends on all
+        the pairs of samples) and its gradient w.r.t. the latent codes of each micro-batch. Back-propagating
+        (z * grad).sum() from each micro-batch gives the gradient of the loss of the logical batch.
+        :param latents: list of torch.Tensor
+            latent codes of the micro-batches (without graph)
+        :param reg_fn: function
+            loss of the concatenated latent codes
+        :return: tuple
+            loss (detached), list of gradients (one per micro-batch)
+        """
+        z = torch.cat(latents).detach().float().requires_grad_(True)
+        with torch.enable_grad():
+            loss = reg_fn(z)
+        if not torch.is_tensor(loss) or not loss.requires_grad:
+            return loss, [torch.zeros_like(latent, dtype=z.dtype) for latent in latents]
+        grad, = torch.autograd.grad(loss, z)
+        return loss.detach(), list(grad.split([len(latent) for latent in latents]))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def preserve_buffers(module):
+        """
+        Restores the buffers of module (e.g., batch-norm running statistics) on exit, for extra forward passes
+        that must not count as training steps
+        """
+        buffers = [buffer.clone() for buffer in module.buffers()]
+        try:
+            yield
+        finally:
+            with torch.no_grad():
+                for buffer, saved in zip(module.buffers(), buffers):
+                    buffer.copy_(saved)
+
+    def get_rng_state(self):
+        """
+        Random state of the host (and of the CUDA device), to replay the random draws of a forward pass
+        """
+        return torch.get_rng_state(), torch.cuda.get_rng_state(self.device) if self.device_type == 'cuda' else None
+
+    def set_rng_state(self, state):
+        torch.set_rng_state(state[0])
+        if state[1] is not None:
+            torch.cuda.set_rng_state(state[1], self.device)
+
+    def set_epoch(self, epoch):
+        """
+        Starts the epoch: starts the epoch clock of the profiler and forwards the epoch to the training dataset if it
+        shuffles itself (e.g. CardiacStreamingDataset) and to the sampler of distributed training (DistributedSampler)
+        """
+        self.profiler.start_epoch()
+        dataset = self.get_streaming_dataset()
+        if dataset is not None:
+            dataset.set_epoch(epoch)
+        if hasattr(self.train_ds, 'sampler') and hasattr(self.train_ds.sampler, 'set_epoch'):
+            self.train_ds.sampler.set_epoch(epoch)
+        # samples of the epoch consumed by this rank (a resumed epoch starts at the loaded position)
+        self.epoch_position = dataset.position if dataset is not None and hasattr(dataset, 'position') else 0
+
+    def get_streaming_dataset(self):
+        """
+        Training dataset that orders its epochs itself (set_epoch, state_dict), e.g. CardiacStreamingDataset
+        """
+        dataset = self.train_ds.dataset if hasattr(self.train_ds, 'dataset') else None
+        return dataset if hasattr(dataset, 'set_epoch') else None
+
+    @staticmethod
+    def sync_gradients(optimizer):
+        """
+        Averages the gradients of the parameters of optimizer over the ranks before its step (distributed training).
+        Each optimizer is synchronized on its own, e.g., the encoder and decoder optimizers of Soft-Intro VAE.
+        """
+        all_reduce_gradients([param for group in optimizer.param_groups for param in group['params']])
+
+    def save_checkpoint(self, state, file_name):
+        """
+        Saves state to client_path/file_name (in the background), on rank 0 only in distributed training
+        """
+        self.checkpoints.save(state, file_name)
+
+    def get_stateful(self):
+        """
+        Objects of the training state (with state_dict / load_state_dict) besides the model, by name.
+        Trainers with other optimizers, schedulers or loss scalers add theirs.
+        """
+        stateful = {'optimizer': self.optimizer, 'early_stopping': self.early_stopping}
+        if self.lr_scheduler is not None:
+            stateful['lr_scheduler'] = self.lr_scheduler
+        return stateful
+
+    def save_training_state(self, epoch):
+        """
+        Checkpoint of the end of an epoch (latest_model.pt), from which the training resumes exactly: weights, state
+        of the optimizers, schedulers, loss scalers and early stopping, the random states of every rank, the
+        samples of the epoch consumed by the streaming dataset and the absolute path of best_model.pt (a resumed run
+        writes to a new checkpoint folder).
+        Called by all the ranks (the random states are gathered), written by rank 0.
+        """
+        trainer_state = {name: obj.state_dict() for name, obj in self.get_stateful().items()}
+        trainer_state.update({'min_val_loss': float(self.min_val_loss), 'early_stop': self.early_stop,
+                              'rng_states': all_gather_object(CheckpointManager.get_rng_states()),
+                              'best_model_path': os.path.abspath(os.path.join(self.client_path, 'best_model.pt'))})
+        dataset = self.get_streaming_dataset()
+        if dataset is not None and hasattr(dataset, 'state_dict'):
+            trainer_state['data_state'] = dataset.state_dict(self.epoch_position)
+        self.checkpoints.save_epoch({'model_weights': self.model.state_dict(), 'epoch': epoch,
+                                     'trainer_state': trainer_state}, epoch)
+
+    def load_training_state(self, trainer_state):
+        """
+        Restores the state saved by save_training_state (the weights are loaded by train()), and the best weights
+        from the best_model.pt of the checkpoint, which is copied to the checkpoint folder of this run. Call it right
+        before train(), which continues with the next epoch.
+        """
+        for name, obj in self.get_stateful().items():
+            # the state of a disabled GradScaler is empty
+            if name in trainer_state.keys() and len(trainer_state[name]) > 0:
+                obj.load_state_dict(trainer_state[name])
+        self.min_val_loss = trainer_state['min_val_loss']
+        self.early_stop = trainer_state['early_stop']
+        dataset = self.get_streaming_dataset()
+        if 'data_state' in trainer_state.keys() and dataset is not None and hasattr(dataset, 'load_state_dict'):
+            dataset.load_state_dict(trainer_state['data_state'])
+        best_paths = [os.path.join(self.client_path, 'best_model.pt')]
+        if 'best_model_path' in trainer_state.keys():
+            best_paths.insert(0, trainer_state['best_model_path'])
+        best_paths = [path for path in best_paths if os.path.exists(path)]
+        if len(best_paths) > 0:
+            best = torch.load(best_paths[0], map_location=self.device)
+            self.best_weights = best['model_weights']
+            self.best_opt_weights = best['optimizer_weights'] if 'optimizer_weights' in best.keys() \
+                else [best['optimizer_e_weights'], best['optimizer_d_weights']]
+            # the best model of the run so far, also if the validation does not improve after resuming
+            self.save_checkpoint(best, 'best_model.pt')
+        elif np.isfinite(self.min_val_loss):
+            logging.warning('[Trainer::load_training_state] WARNING: best_model.pt not found, the best weights are '
+                            'the ones of the next improvement of the validation loss')
+        rng_states = trainer_state['rng_states']
+        if len(rng_states) != get_world_size():
+            logging.warning('[Trainer::load_training_state] WARNING: Random states of {} processes for {} processes, '
+                            'the random draws are not resumed exactly'.format(len(rng_states), get_world_size()))
+        CheckpointManager.set_rng_states(rng_states[get_rank() % len(rng_states)])
+
+    @staticmethod
+    def reduce_validation(metrics, test_total, *arrays):
+        """
+        Validation results of all the ranks, which validate their part of the data in distributed training
+        :param metrics: dict
+            sums over the samples
+        :param arrays: np.ndarray
+            per-sample results, e.g., latent codes and attributes
+        :return: tuple
+            metrics and test_total summed, arrays concatenated over the ranks
+        """
+        if not is_distributed():
+            return (metrics, test_total) + arrays
+        return (all_reduce_sum(metrics), int(all_reduce_sum(test_total))) + \
+            tuple(all_gather_array(array) for array in arrays)
+
     def train(self, model_state=None, opt_state=None, epoch=0):
         """
         Train local client
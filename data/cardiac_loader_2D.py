@@ -1,18 +1,26 @@
 import torch
-from torch.utils.data import (Dataset, DataLoader)
+from torch.utils.data import (Dataset, DataLoader, IterableDataset)
+from torch.utils.data.distributed import DistributedSampler
 import torchvision.transforms as transforms
 import pytorch_lightning as pl
 from monai.transforms import (AddChannel, Compose, RandRotate, RandZoom,
     Resize, RandShiftIntensity, ToTensor, RandFlip, AdjustContrast, ScaleIntensity)
 from pathlib import Path
-from sklearn.model_selection import train_test_split
 import pandas as pd
 import numpy as np
 from PIL import Image
 import h5py
 import json
 import os
+import glob
+import hashlib
 import torchvision.transforms as transforms
+from dl_utils.split_utils import SplitManager
+from dl_utils.dist_utils import get_rank, get_world_size, is_distributed
+try:
+    import hdf5plugin  # registers the lz4 / blosc filters of packed files (dl_utils/repack_h5.py)
+except ImportError:
+    hdf5plugin = None
 
 
 class CardiacLoader(pl.LightningDataModule):
@@ -23,7 +31,7 @@ class CardiacLoader(pl.LightningDataModule):
         self.batch_size = args['batch_size'] if 'batch_size' in args.keys() else 16
         self.attributes_idx = args['attributes_idx']
         self.folder = args['attributes_path']
-        self.patch_file = args['patch_path']
+        self.patch_file = args['patch_path'] if 'patch_path' in args.keys() else None
         self.attributes_path = args['attributes_path'] + f'full_info.csv'
 
         self.win_size = args['win_size']
@@ -32,10 +40,40 @@ class CardiacLoader(pl.LightningDataModule):
 
         self.moment = args['moment'] if 'moment' in args.keys() else None
 
-        patch_name = os.path.split(self.patch_file)[1]
-        patch_root = os.path.split(self.patch_file)[0]
+        self.num_workers = args['num_workers'] if 'num_workers' in args.keys() else 0
+        self.prefetch_factor = args['prefetch_factor'] if 'prefetch_factor' in args.keys() else 2
+        self.persistent_workers = args['persistent_workers'] if 'persistent_workers' in args.keys() else False
+        self.pin_memory = args['pin_memory'] if 'pin_memory' in args.keys() else False
+
+        # memory-mapped cache of the transformed images, rebuilt when its key (see CardiacCustomDataset.build_cache)
+        # changes
+        self.cache_dir = args['cache_dir'] if 'cache_dir' in args.keys() else None
+        self.cache_dtype = args['cache_dtype'] if 'cache_dtype' in args.keys() else 'float16'
+        # whole dataset held in one shared-memory tensor read by all DataLoader workers
+        self.preload = args['preload'] if 'preload' in args.keys() else False
+        self.preload_dtype = args['preload_dtype'] if 'preload_dtype' in args.keys() else 'float32'
+
+        # stratified splits stored as .npy index files (see dl_utils.split_utils.SplitManager), split.json has
+        # precedence if it exists
+        self.split_dir = args['split_dir'] if 'split_dir' in args.keys() else self.folder
+        self.split_seed = args['split_seed'] if 'split_seed' in args.keys() else 2109
+        self.val_size = args['val_size'] if 'val_size' in args.keys() else 0.075
+        self.test_size = args['test_size'] if 'test_size' in args.keys() else 0.075
+        self.n_folds = args['n_folds'] if 'n_folds' in args.keys() else None
+        self.fold = args['fold'] if 'fold' in args.keys() else None
+
+        # map: CardiacCustomDataset over patch_path, streaming: CardiacStreamingDataset over the shards matching
+        # shard_files (glob pattern or list of paths)
+        self.mode = args['mode'] if 'mode' in args.keys() else 'map'
+        self.shard_files = args['shard_files'] if 'shard_files' in args.keys() else None
+        self.shuffle_buffer = args['shuffle_buffer'] if 'shuffle_buffer' in args.keys() else 1024
+        if self.mode not in ['map', 'streaming']:
+            raise ValueError(f'[CardiacLoader::__init__] Unknown mode {self.mode}')
+
+        patch_name = os.path.split(self.patch_file)[1] if self.patch_file is not None else ''
+        patch_root = os.path.split(self.patch_file)[0] if self.patch_file is not None else ''
         testing_path = patch_root + '/testing_' + patch_name
-        if Path(testing_path).is_file() and Path(args['attributes_path'] + f'testing_full_info.csv').is_file():
+        if self.patch_file is not None and Path(testing_path).is_file() and Path(args['attributes_path'] + f'testing_full_info.csv').is_file():
 
             self.testing_patch_file = testing_path
             self.testing_attributes_path = args['attributes_path'] + f'testing_full_info.csv'
@@ -60,45 +98,101 @@ class CardiacLoader(pl.LightningDataModule):
             ]
         )
         #self.val_transforms = self.train_transforms
+        # Vectorised equivalent of the deterministic transforms above, used by CardiacCustomDataset.__getitems__
+        self.batch_transforms = CardiacBatchTransform(self.win_size[0], self.gamma)
         self.setup()
 
     def setup(self):
+        if self.mode == 'streaming':
+            return self.setup_streaming()
 
         dataset = CardiacCustomDataset(self.patch_file, self.attributes_idx, self.attributes_path,
-                                       self.train_transforms, self.binary_label, self.moment)
+                                       self.train_transforms, self.binary_label, self.moment,
+                                       batch_transforms=self.batch_transforms, batch_equivalent=True)
         self.attributes_dict = dataset.attributes_dict
+        if self.cache_dir is not None:
+            dataset.build_cache(self.cache_dir, self.cache_dtype)
+        if self.preload:
+            dataset.preload(self.preload_dtype)
 
-        try:
-            with open(self.folder + 'split.json', 'r') as json_file:
-                data = json.load(json_file)
-            
-            indices_train = data['indices_train']
-            indices_val = data['indices_val']
-            indices_test = data['indices_test']
-
-        except:
-            labels = dataset.csv_attributes['label']
-            indices_train, indices_val = train_test_split(list(range(len(dataset))),
-                                                      stratify=labels, test_size=0.15)
-
+        indices_train, indices_val, indices_test = self.get_split(dataset.pids,
+                                                                  dataset.csv_attributes['label'].to_numpy())
         self.train_set = torch.utils.data.Subset(dataset, indices_train)
         self.val_set = torch.utils.data.Subset(dataset, indices_val)
-
-        if not 'indices_test' in locals():
-            indices = indices_val
-            val_dataset = self.val_set
-            indices_val, indices_test = train_test_split(indices, test_size=0.5)
-            self.val_set = torch.utils.data.Subset(dataset, indices_val)
         self.test_set = torch.utils.data.Subset(dataset, indices_test)
 
+    def setup_streaming(self):
+        shard_files = glob.glob(self.shard_files) if isinstance(self.shard_files, str) else self.shard_files
+        csv_attributes = pd.read_csv(self.attributes_path, dtype={'pid': str})
+        pids = csv_attributes['pid'].to_numpy()
+        indices_train, indices_val, indices_test = self.get_split(pids, csv_attributes['label'].to_numpy())
+
+        rank, world_size = get_rank(), get_world_size()
+        datasets = []
+        # the test set is evaluated by rank 0 only (whole set)
+        for indices, shuffle, distributed in [(indices_train, True, True), (indices_val, True, True),
+                                              (indices_test, False, False)]:
+            datasets.append(CardiacStreamingDataset(shard_files, self.attributes_idx, self.attributes_path,
+                                                    pids=pids[indices], binary_label=self.binary_label,
+                                                    moment=self.moment, batch_transforms=self.batch_transforms,
+                                                    shuffle=shuffle, shuffle_buffer=self.shuffle_buffer,
+                                                    block_size=self.batch_size, seed=self.split_seed,
+                                                    rank=rank if distributed else 0,
+                                                    world_size=world_size if distributed else 1))
+        self.train_set, self.val_set, self.test_set = datasets
+        self.attributes_dict = self.train_set.attributes_dict
+
+    def get_split(self, pids, labels):
+        """
+        :return: tuple of list
+            train, val and test indices (rows of the attributes csv), from split.json if it exists
+        """
+        if Path(self.folder + 'split.json').is_file():
+            with open(self.folder + 'split.json', 'r') as json_file:
+                data = json.load(json_file)
+            return data['indices_train'], data['indices_val'], data['indices_test']
+
+        split_manager = SplitManager(self.split_dir, pids, labels, seed=self.split_seed, val_size=self.val_size,
+                                     test_size=self.test_size, n_folds=self.n_folds)
+        return [indices.tolist() for indices in split_manager.get_split(self.fold)]
+
+    def get_loader_kwargs(self):
+        """
+        Worker related DataLoader arguments. prefetch_factor and persistent_workers are only valid with
+        worker processes, the h5 file is opened lazily in each of them (see CardiacCustomDataset.patch_file).
+        """
+        kwargs = {'num_workers': self.num_workers, 'pin_memory': self.pin_memory}
+        if self.num_workers > 0:
+            kwargs['prefetch_factor'] = self.prefetch_factor
+            # streaming workers have to be recreated to see the epoch set by set_epoch
+            kwargs['persistent_workers'] = self.persistent_workers and self.mode == 'map'
+        return kwargs
+
+    def get_sampler(self, dataset, shuffle):
+        """
+        DistributedSampler of the part of dataset of this rank in distributed training (map mode, the streaming
+        datasets split themselves across the ranks), None otherwise. The trainers call set_epoch on it.
+        """
+        if self.mode != 'map' or not is_distributed():
+            return None
+        return DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle,
+                                  seed=self.split_seed)
+
     def train_dataloader(self):
-        return DataLoader(self.train_set, self.batch_size, shuffle=True)
+        # streaming datasets shuffle themselves
+        shuffle = self.mode == 'map'
+        sampler = self.get_sampler(self.train_set, shuffle)
+        return DataLoader(self.train_set, self.batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                          **self.get_loader_kwargs())
 
     def val_dataloader(self):
-        return DataLoader(self.val_set, self.batch_size, shuffle=True)
+        shuffle = self.mode == 'map'
+        sampler = self.get_sampler(self.val_set, shuffle)
+        return DataLoader(self.val_set, self.batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                          **self.get_loader_kwargs())
 
     def test_dataloader(self):
-        return DataLoader(self.test_set, self.batch_size, shuffle=False)
+        return DataLoader(self.test_set, self.batch_size, shuffle=False, **self.get_loader_kwargs())
 
     def get_attributes_dict(self):
         return self.attributes_dict
@@ -107,58 +201,352 @@ class CardiacLoader(pl.LightningDataModule):
         return self.attributes_idx
 
 
+class CardiacBatchTransform:
+    """
+    Batched version of the CenterCrop -> AdjustContrast -> ScaleIntensity(0, 1) chain of CardiacLoader.
+    The center crop is applied as the hyperslab selection of the h5 read (see crop_window), the contrast
+    adjustment and the min-max scaling are vectorised over a (B, C, H, W) tensor, each image being
+    normalised with its own min and max as in the per-sample transforms.
+    """
+    def __init__(self, crop_size, gamma=1.0):
+        self.crop_size = crop_size
+        self.gamma = gamma
+
+    def crop_window(self, shape):
+        """
+        Center crop of torchvision.transforms.CenterCrop for an image of size shape (H, W)
+        :return: list of (source slice, target slice) for each axis, the target being zero padded
+        """
+        window = []
+        for size in shape:
+            if self.crop_size > size:
+                start = (self.crop_size - size) // 2
+                window.append((slice(0, size), slice(start, start + size)))
+            else:
+                start = int(round((size - self.crop_size) / 2.0))
+                window.append((slice(start, start + self.crop_size), slice(0, self.crop_size)))
+        return window
+
+    def __call__(self, img):
+        img = img.float()
+        # AdjustContrast
+        epsilon = 1e-7
+        img_min = img.amin(dim=(-2, -1), keepdim=True)
+        img_range = img.amax(dim=(-2, -1), keepdim=True) - img_min
+        img = ((img - img_min) / (img_range + epsilon)) ** self.gamma * img_range + img_min
+        # ScaleIntensity(minv=0.0, maxv=1.0)
+        img_min = img.amin(dim=(-2, -1), keepdim=True)
+        img_max = img.amax(dim=(-2, -1), keepdim=True)
+        constant = img_max == img_min
+        norm = (img - img_min) / torch.where(constant, torch.ones_like(img_max), img_max - img_min)
+        return torch.where(constant, img * 0.0, norm)
+
+
+def read_attributes(attributes_path, attributes_idx, binary_label=False):
+    """
+    Reads the attributes csv into arrays indexed by csv row
+    :return: tuple
+        csv, attributes_dict, labels, pids, attributes (N, len(attributes_idx)), full_attributes
+    """
+    csv_attributes = pd.read_csv(attributes_path,  dtype={'pid':str})
+    attributes_dict = list(csv_attributes.drop(['label','pid'], axis=1).columns)
+    missing = [attr for attr in attributes_idx if attr not in csv_attributes.columns]
+    if len(missing) > 0:
+        raise KeyError(f'{missing} not existing in attributes csv file')
+    labels = csv_attributes['label'].to_numpy()
+    if binary_label:
+        labels = np.where(labels > 1, 1, labels)
+    pids = csv_attributes['pid'].to_numpy()
+    attributes = np.ascontiguousarray(csv_attributes[list(attributes_idx)].to_numpy(dtype=np.float32))
+    full_attributes = np.ascontiguousarray(csv_attributes[attributes_dict].to_numpy(dtype=np.float32))
+    return csv_attributes, attributes_dict, labels, pids, attributes, full_attributes
+
+
+def get_moment_channels(moments, moment):
+    """
+    Channels of a packed (N, C, H, W) images array that make up the image of a subject
+    :param moments: list
+        moment of each channel of the packed array
+    """
+    if moment is None:
+        return list(range(len(moments)))
+    elif moment == 'all':
+        return [moments.index('ED'), moments.index('ES')]
+    return [moments.index(moment)]
+
+
+def read_packed_rows(images, rows, channels, batch_transform):
+    """
+    Reads rows of a packed images array (h5 dataset or np.ndarray) in one sorted read restricted to the crop
+    window of batch_transform
+    :return: np.ndarray (len(rows), len(channels), crop_size, crop_size) float32, in the order of rows
+    """
+    size = batch_transform.crop_size
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    (src_h, dst_h), (src_w, dst_w) = batch_transform.crop_window(images.shape[-2:])
+    data = images[unique_rows.tolist(), :, src_h, src_w]
+    batch = np.zeros((len(rows), len(channels), size, size), dtype=np.float32)
+    batch[:, :, dst_h, dst_w] = data[inverse][:, channels]
+    return batch
+
+
 class CardiacCustomDataset(Dataset):
-    def __init__(self, patch_file, attributes_idx, attributes_path, transforms=None, binary_label=False, moment= None):
+    def __init__(self, patch_file, attributes_idx, attributes_path, transforms=None, binary_label=False, moment= None,
+                 batch_transforms=None, batch_equivalent=False):
+        """
+        :param batch_transforms: CardiacBatchTransform
+            batched transforms of the batch fetch (__getitems__), the cache and the preloaded images
+        :param batch_equivalent: bool
+            batch_transforms compute the same images as transforms (as set up by CardiacLoader). Otherwise the
+            batches are fetched per sample with transforms, and the cache and preloading are not available.
+        """
         super().__init__()
 
-        self.patch_file = h5py.File(patch_file, 'r')
+        self.patch_path = patch_file
+        self._patch_file = None
+        self._patch_pid = None
+        self._rows = None
+        self._moments = None
         self.attributes_idx = attributes_idx
-        self.csv_attributes = pd.read_csv(attributes_path,  dtype={'pid':str})
-
-        tmp_dict = self.csv_attributes.drop(['label','pid'], axis=1)
-        self.attributes_dict = list(tmp_dict.columns)
         self.binary_label = binary_label
         self.transform = transforms
 
-        K = list(self.patch_file.keys())[0]
+        # Columnar copy of the csv so that __getitem__ only does integer indexing (no pandas in the hot path)
+        self.csv_attributes, self.attributes_dict, self.labels, self.pids, self.attributes, self.full_attributes = \
+            read_attributes(attributes_path, attributes_idx, binary_label)
 
         self.moment = moment
+        self.batch_transform = batch_transforms
+        self.batch_equivalent = batch_equivalent and batch_transforms is not None
+        self._offsets = {}
+        self.cache_path = None
+        self._cache = None
+        self._cache_pid = None
+        self.images = None
+
+    @property
+    def patch_file(self):
+        """
+        h5 handle opened lazily in the process that reads from it. h5py handles must not be shared across
+        fork, so a handle inherited from the parent (or from a previous worker) is reopened.
+        """
+        if self._patch_file is None or self._patch_pid != os.getpid():
+            self._patch_file = h5py.File(self.patch_path, 'r')
+            self._patch_pid = os.getpid()
+            self._rows, self._moments = None, None
+            if self._patch_file.attrs.get('layout') == 'packed':
+                # single (N, C, H, W) 'images' dataset written by dl_utils/repack_h5.py
+                pids = self._patch_file['pids'].asstr()[()]
+                self._rows = {pid: row for row, pid in enumerate(pids)}
+                self._moments = [str(moment) for moment in self._patch_file.attrs['moments']]
+        return self._patch_file
+
+    @property
+    def packed(self):
+        return self.patch_file.attrs.get('layout') == 'packed'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_patch_file'] = None
+        state['_patch_pid'] = None
+        state['_rows'] = None
+        state['_moments'] = None
+        state['_offsets'] = {}
+        state['_cache'] = None
+        state['_cache_pid'] = None
+        return state
+
+    def iter_images(self, block_size=256):
+        """
+        Transformed images of the whole dataset, in dataset order
+        :return: generator of (start, stop, torch.Tensor (stop - start, C, crop_size, crop_size))
+        """
+        if not self.batch_equivalent:
+            raise ValueError('[CardiacCustomDataset::iter_images] batch_transforms equivalent to transforms are '
+                             'required (batch_equivalent=True)')
+        for start in range(0, len(self), block_size):
+            stop = min(start + block_size, len(self))
+            yield start, stop, self.batch_transform(torch.from_numpy(self.get_cases(self.pids[start:stop])))
+
+    def get_cache_key(self):
+        """
+        Everything the cached images depend on, in two parts:
+        - configuration: transform parameters, moment, source file and subject order
+        - version of the source file: modification time and size
+        :return: tuple
+            configuration key (16 hex digits), source key (8 hex digits)
+        """
+        stat = os.stat(self.patch_path)
+        config = {'win_size': self.batch_transform.crop_size, 'rescale': self.batch_transform.gamma,
+                  'moment': self.moment, 'patch_file': os.path.abspath(self.patch_path),
+                  'pids': hashlib.sha1('\n'.join(self.pids).encode()).hexdigest()}
+        source = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16], \
+            hashlib.sha1(json.dumps(source, sort_keys=True).encode()).hexdigest()[:8]
+
+    def build_cache(self, cache_dir, dtype='float16'):
+        """
+        Materializes the transformed images once into a .npy file read with np.memmap by later epochs and runs.
+        The caches of other configurations (e.g. another win_size or subject list) are kept; a cache of the same
+        configuration built from an older version of the h5 file is deleted and rebuilt.
+        :param dtype: str
+            float16 | uint8 (images in [0, 1] quantized to 256 levels)
+        """
+        if dtype not in ['float16', 'uint8']:
+            raise ValueError(f'[CardiacCustomDataset::build_cache] Unknown cache dtype {dtype}')
+        os.makedirs(cache_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(self.patch_path))[0]
+        config_key, source_key = self.get_cache_key()
+        self.cache_path = os.path.join(cache_dir, f'{stem}_{config_key}_{source_key}_{dtype}.npy')
+        self._cache, self._cache_pid = None, None
+        if os.path.isfile(self.cache_path):
+            return self.cache_path
+
+        for stale in glob.glob(os.path.join(cache_dir, f'{stem}_{config_key}_' + '[0-9a-f]' * 8 + f'_{dtype}.npy')):
+            os.remove(stale)
+        tmp_path = self.cache_path + f'.{os.getpid()}.tmp'
+        cache = None
+        for start, stop, images in self.iter_images():
+            if cache is None:
+                cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                                  shape=(len(self),) + tuple(images.shape[1:]))
+            images = images.numpy()
+            cache[start:stop] = np.round(images * 255) if dtype == 'uint8' else images
+        cache.flush()
+        del cache
+        os.replace(tmp_path, self.cache_path)
+        return self.cache_path
+
+    @property
+    def cache(self):
+        if self.cache_path is None:
+            return None
+        if self._cache is None or self._cache_pid != os.getpid():
+            self._cache = np.load(self.cache_path, mmap_mode='r')
+            self._cache_pid = os.getpid()
+        return self._cache
+
+    def preload(self, dtype='float32'):
+        """
+        Reads the transformed images of the whole dataset (from the cache if there is one) into a single tensor
+        in shared memory. DataLoader workers index into it without copies, with fork as well as spawn.
+        :param dtype: str
+            float32 | float16
+        """
+        images = None
+        for start, stop, block in self.iter_images() if self.cache_path is None else self.iter_cache():
+            if images is None:
+                images = torch.empty((len(self),) + tuple(block.shape[1:]), dtype=getattr(torch, dtype))
+                images.share_memory_()
+            images[start:stop] = block
+        self.images = images
+        return self.images
+
+    def iter_cache(self, block_size=1024):
+        for start in range(0, len(self), block_size):
+            stop = min(start + block_size, len(self))
+            yield start, stop, self.read_cache(np.arange(start, stop))
+
+    def read_images(self, indices):
+        """
+        :return: torch.Tensor (B, C, crop_size, crop_size) float32 from the preloaded images or the cache,
+            None if the images have to be read from the h5 file
+        """
+        if self.images is not None:
+            return self.images[indices].float()
+        if self.cache_path is not None:
+            return self.read_cache(indices)
+        return None
+
+    def read_cache(self, indices):
+        """
+        :return: torch.Tensor (B, C, crop_size, crop_size) float32 from the memory-mapped cache
+        """
+        images = torch.from_numpy(np.asarray(self.cache[indices]))
+        if images.dtype == torch.uint8:
+            return images.float() / 255
+        return images.float()
+
+    def get_keys(self, pid):
+        """
+        h5 datasets that make up the image of a subject, one channel each
+        """
+        if self.moment is None:
+            return [f'{pid}']
+        elif self.moment == 'all':
+            return [f'{pid}/ED', f'{pid}/ES']
+        return [f'{pid}/{self.moment}']
+
+    def get_channels(self):
+        """
+        Channels of the packed 'images' dataset that make up the image of a subject
+        """
+        self.patch_file
+        return get_moment_channels(self._moments, self.moment)
+
+    def get_offset(self, key):
+        """
+        Byte offset of a dataset in the h5 file, used to issue the reads of a batch in file order.
+        Chunked or compact datasets have no single offset and are read last.
+        """
+        if key not in self._offsets:
+            offset = self.patch_file[key].id.get_offset()
+            self._offsets[key] = offset if offset is not None else np.iinfo(np.int64).max
+        return self._offsets[key]
+
+    def get_cases(self, pids):
+        """
+        Reads the center-cropped images of several subjects into one array
+        :return: np.ndarray (B, C, crop_size, crop_size) float32, C being the number of moments
+        """
+        size = self.batch_transform.crop_size
+        if self.packed:
+            # one read of the (sorted, unique) rows of the batch, restricted to the crop window
+            return read_packed_rows(self.patch_file['images'], [self._rows[pid] for pid in pids],
+                                    self.get_channels(), self.batch_transform)
+
+        keys = [self.get_keys(pid) for pid in pids]
+        batch = np.zeros((len(pids), len(keys[0]), size, size), dtype=np.float32)
+
+        reads = [(b, c, key) for b, sample_keys in enumerate(keys) for c, key in enumerate(sample_keys)]
+        reads.sort(key=lambda read: self.get_offset(read[2]))
+        for b, c, key in reads:
+            ds = self.patch_file[key]
+            (src_h, dst_h), (src_w, dst_w) = self.batch_transform.crop_window(ds.shape)
+            batch[b, c, dst_h, dst_w] = ds[src_h, src_w]
+        return batch
 
 
     def get_attributes(self, idx):
-
-        attributes = []
-
-        for attr in self.attributes_idx:
-            try:
-                label = self.csv_attributes.loc[idx][attr]
-            except:
-                print(attr)
-                raise f'{attr} not existing in attributes csv file'
-            attributes.append(label)
-
-        full_attributes = self.csv_attributes.loc[idx, self.attributes_dict].values
-        return torch.Tensor(attributes), torch.Tensor(full_attributes.tolist())
+        return torch.from_numpy(self.attributes[idx]), torch.from_numpy(self.full_attributes[idx])
 
     def get_case(self,idx):
         #with h5py.File(self.patch_file, 'r') as ff:
-        if self.moment is None:
+        if self.packed:
+            row = self.patch_file['images'][self._rows[idx]]
+            if self.moment is None:
+                data = row[0] if len(self._moments) == 1 else row
+            else:
+                data = {moment: row[c] for c, moment in enumerate(self._moments)}
+        elif self.moment is None:
             data = self.patch_file[f'{idx}'][:]
         else:
             data = {'ED':self.patch_file[f'{idx}/ED'][:], 'ES': self.patch_file[f'{idx}/ES'][:]}
         return data
 
     def __len__(self):
-        return len(self.csv_attributes['pid'])
+        return len(self.pids)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        label = self.csv_attributes.loc[idx]['label']
-        if self.binary_label and label > 1:
-            label = 1
-        idx_name = self.csv_attributes.loc[idx]['pid']
+        label = self.labels[idx]
+        idx_name = self.pids[idx]
+
+        if self.images is not None or self.cache_path is not None:
+            attributes, full_attributes = self.get_attributes(idx)
+            return self.read_images([idx])[0], label, attributes, full_attributes
 
         patch = self.get_case(idx_name)
         attributes, full_attributes = self.get_attributes(idx)
@@ -174,4 +562,227 @@ class CardiacCustomDataset(Dataset):
             img_es = self.transform(patch['ES'])
             img = np.concatenate((img_ed, img_es), axis = 0)
 
-        return img, label, attributes, full_attributes
\ No newline at end of file
+        return img, label, attributes, full_attributes
+
+    def __getitems__(self, indices):
+        """
+        Batch fetch used by the DataLoader (torch >= 2.0) in place of one __getitem__ call per index:
+        the images of the batch are read in file order into one array and transformed at once with
+        batch_transforms, if they are equivalent to transforms (batch_equivalent), else one __getitem__ per index.
+        """
+        if self.images is not None or self.cache_path is not None:
+            images = self.read_images(np.asarray(indices))
+        elif self.batch_equivalent and \
+                (self.packed or len(self.patch_file[self.get_keys(self.pids[indices[0]])[0]].shape) == 2):
+            images = self.batch_transform(torch.from_numpy(self.get_cases(self.pids[np.asarray(indices)])))
+        else:
+            return [self[idx] for idx in indices]
+
+        indices = np.asarray(indices)
+        attributes = torch.from_numpy(self.attributes[indices])
+        full_attributes = torch.from_numpy(self.full_attributes[indices])
+        return [(images[i], self.labels[idx], attributes[i], full_attributes[i]) for i, idx in enumerate(indices)]
+
+class CardiacStreamingDataset(IterableDataset):
+    """
+    Iterable version of CardiacCustomDataset for cohorts that do not fit on local disk or in memory. The images
+    are streamed from shards, i.e., packed .h5 files (dl_utils/repack_h5.py) or .npz files with an 'images'
+    (N, C, H, W) array, a 'pids' array and optionally a 'moments' array, of a few thousand subjects each.
+
+    The order of an epoch is computed on the indices only: the shards are permuted, the subjects of each rank
+    go through a shuffle buffer of shuffle_buffer indices, and the images are read block_size subjects at a
+    time, one sorted read per shard. Rank r gets the shards r, r + world_size, ... (or every world_size-th
+    subject if there are fewer shards than ranks), truncated to the same length on all ranks. DataLoader worker
+    w reads the blocks w, w + num_workers, ... so that, with block_size = batch_size, the batches come out in
+    the order of the rank sequence whatever the number of workers, and an epoch can be resumed exactly from
+    the number of samples already consumed (see load_state_dict).
+    """
+    def __init__(self, shard_files, attributes_idx, attributes_path, pids=None, binary_label=False, moment=None,
+                 batch_transforms=None, shuffle=True, shuffle_buffer=1024, block_size=32, seed=2109, rank=0,
+                 world_size=1):
+        """
+        :param shard_files: list
+            paths of the .h5 / .npz shards
+        :param pids: array-like
+            subjects to stream (e.g. the training split), None for all the subjects of the shards that are in
+            the attributes csv
+        :param block_size: int
+            number of subjects read at once, should be the batch size of the DataLoader
+        """
+        super().__init__()
+        if batch_transforms is None:
+            raise ValueError('[CardiacStreamingDataset::__init__] batch_transforms are required')
+        if len(shard_files) == 0:
+            raise ValueError('[CardiacStreamingDataset::__init__] No shard files')
+        self.shard_files = sorted(shard_files)
+        self.attributes_idx = attributes_idx
+        self.moment = moment
+        self.batch_transform = batch_transforms
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.block_size = block_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.position = 0
+        # epoch of a state loaded with load_state_dict, whose position is kept by set_epoch
+        self._loaded_epoch = None
+        self._shards = {}
+
+        self.csv_attributes, self.attributes_dict, self.labels, self.pids, self.attributes, self.full_attributes = \
+            read_attributes(attributes_path, attributes_idx, binary_label)
+        csv_rows = {pid: row for row, pid in enumerate(self.pids)}
+        selected = set(self.pids if pids is None else pids)
+
+        # (shard rows, csv rows) of the selected subjects of each shard
+        self.shard_index = []
+        for path in self.shard_files:
+            shard_pids = self.read_pids(path)
+            rows = [row for row, pid in enumerate(shard_pids) if pid in selected and pid in csv_rows]
+            self.shard_index.append((np.asarray(rows, dtype=np.int64),
+                                     np.asarray([csv_rows[shard_pids[row]] for row in rows], dtype=np.int64)))
+        self.nr_samples = min(len(self.get_rank_shards(rank, 0)[0]) for rank in range(self.world_size))
+
+    @staticmethod
+    def read_pids(path):
+        if path.endswith('.npz'):
+            with np.load(path) as shard:
+                return shard['pids'].astype(str)
+        with h5py.File(path, 'r') as shard:
+            return shard['pids'].asstr()[()]
+
+    def get_shard(self, shard):
+        """
+        Images and moments of a shard, opened lazily in the process that reads from it and closed after its last
+        subject of the epoch (see __iter__)
+        """
+        if shard not in self._shards:
+            path = self.shard_files[shard]
+            if path.endswith('.npz'):
+                with np.load(path) as data:
+                    images = data['images']
+                    moments = [str(m) for m in data['moments']] if 'moments' in data else ['ED', 'ES'][:images.shape[1]]
+            else:
+                data = h5py.File(path, 'r')
+                images, moments = data['images'], [str(moment) for moment in data.attrs['moments']]
+            self._shards[shard] = (images, moments)
+        return self._shards[shard]
+
+    def close_shards(self, shards=None):
+        for shard in [shard for shard in self._shards if shards is None or shard in shards]:
+            images, _ = self._shards.pop(shard)
+            if isinstance(images, h5py.Dataset):
+                images.file.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def get_rank_shards(self, rank, epoch):
+        """
+        Ordered (shard, shard row, csv row) of the subjects streamed by a rank in an epoch
+        :return: tuple of np.ndarray
+        """
+        order = np.arange(len(self.shard_files))
+        if len(self.shard_files) >= self.world_size:
+            rng = np.random.default_rng([self.seed, epoch, rank])
+            order = order[rank::self.world_size]
+        else:
+            # same sequence on all ranks, split by subject below
+            rng = np.random.default_rng([self.seed, epoch])
+        if self.shuffle:
+            order = rng.permutation(order)
+        shards, rows, csv_rows = [], [], []
+        for shard in order:
+            shard_rows, shard_csv_rows = self.shard_index[shard]
+            permutation = rng.permutation(len(shard_rows)) if self.shuffle else np.arange(len(shard_rows))
+            shards.append(np.full(len(shard_rows), shard, dtype=np.int64))
+            rows.append(shard_rows[permutation])
+            csv_rows.append(shard_csv_rows[permutation])
+        shards, rows, csv_rows = np.concatenate(shards), np.concatenate(rows), np.concatenate(csv_rows)
+        if len(self.shard_files) >= self.world_size:
+            return shards, rows, csv_rows
+        selected = np.arange(len(shards)) % self.world_size == rank
+        return shards[selected], rows[selected], csv_rows[selected]
+
+    def get_order(self):
+        """
+        Sequence of (shard, shard row, csv row) of this rank for the current epoch, after the shuffle buffer
+        """
+        shards, rows, csv_rows = self.get_rank_shards(self.rank, self.epoch)
+        shards, rows, csv_rows = shards[:self.nr_samples], rows[:self.nr_samples], csv_rows[:self.nr_samples]
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            return shards, rows, csv_rows
+
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, 1])
+        buffer, order = [], []
+        for i in range(len(shards)):
+            buffer.append(i)
+            if len(buffer) == self.shuffle_buffer:
+                order.append(buffer.pop(rng.integers(len(buffer))))
+        order.extend(np.asarray(buffer)[rng.permutation(len(buffer))].tolist())
+        order = np.asarray(order, dtype=np.int64)
+        return shards[order], rows[order], csv_rows[order]
+
+    def set_epoch(self, epoch):
+        """
+        Starts epoch from its beginning, or from the loaded position if epoch is the one of load_state_dict
+        """
+        if epoch != self._loaded_epoch:
+            self.position = 0
+        self.epoch = epoch
+        self._loaded_epoch = None
+
+    def state_dict(self, position):
+        """
+        :param position: int
+            number of samples of the epoch already consumed by this rank (batches * batch_size)
+        """
+        return {'epoch': self.epoch, 'position': position}
+
+    def load_state_dict(self, state_dict):
+        """
+        The next iteration skips the first state_dict['position'] samples of state_dict['epoch'], also after
+        set_epoch(state_dict['epoch']). A position at the end of the epoch resumes with the next epoch.
+        """
+        self.epoch, self.position = state_dict['epoch'], state_dict['position']
+        if self.position >= self.nr_samples:
+            self.epoch, self.position = self.epoch + 1, 0
+        self._loaded_epoch = self.epoch
+
+    def __len__(self):
+        return self.nr_samples
+
+    def read_block(self, shards, rows):
+        """
+        :return: torch.Tensor (B, C, crop_size, crop_size) float32 transformed images, in the order of rows
+        """
+        batch = None
+        for shard in np.unique(shards):
+            images, moments = self.get_shard(shard)
+            selected = np.flatnonzero(shards == shard)
+            data = read_packed_rows(images, rows[selected], get_moment_channels(moments, self.moment),
+                                    self.batch_transform)
+            if batch is None:
+                batch = np.empty((len(rows),) + data.shape[1:], dtype=np.float32)
+            batch[selected] = data
+        return self.batch_transform(torch.from_numpy(batch))
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        shards, rows, csv_rows = self.get_order()
+        last = np.zeros(len(self.shard_files), dtype=np.int64)
+        np.maximum.at(last, shards, np.arange(len(shards)))
+        blocks = list(range(self.position, len(shards), self.block_size))
+        for start in blocks[worker_id::num_workers]:
+            stop = min(start + self.block_size, len(shards))
+            images = self.read_block(shards[start:stop], rows[start:stop])
+            self.close_shards([shard for shard in self._shards if last[shard] < stop])
+            for i, row in enumerate(csv_rows[start:stop]):
+                yield images[i], self.labels[row], torch.from_numpy(self.attributes[row]), \
+                    torch.from_numpy(self.full_attributes[row])
+        self.close_shards()
@@ -0,0 +1,66 @@
+"""
+device_loader.py
+
+Data loader over a dataset held entirely on the training device
+"""
+import torch
+
+
+class DeviceDataLoader(object):
+    """
+    Materializes all the batches of a DataLoader once, as one tensor per field, on the device (or in pinned
+    host memory). Shuffling and batching are then done with index tensors, which removes the host to device
+    transfer from the critical path. Only meant for datasets that fit in (device) memory and whose transforms
+    are deterministic.
+    """
+    def __init__(self, data_loader, device, shuffle=True, pin_memory=False, drop_last=False):
+        """
+        :param data_loader: torch.utils.data.DataLoader
+            loader returning tuples of tensors, e.g. (images, labels, attributes, full_attributes)
+        :param device: torch.device
+            device the batches are returned on
+        :param pin_memory: bool
+            keep the data in pinned host memory and copy each batch asynchronously instead of storing it on
+            the device. Ignored on CPU.
+        """
+        self.dataset = data_loader.dataset
+        self.batch_size = data_loader.batch_size
+        self.device = torch.device(device)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory and self.device.type == 'cuda'
+        self.storage_device = torch.device('cpu') if self.pin_memory else self.device
+
+        fields = None
+        for data in data_loader:
+            if fields is None:
+                fields = [[] for _ in data]
+            for field, value in zip(fields, data):
+                field.append(torch.as_tensor(value))
+        self.tensors = [torch.cat(field, 0).to(self.storage_device) for field in fields]
+        if self.pin_memory:
+            self.tensors = [tensor.pin_memory() for tensor in self.tensors]
+        self.nr_samples = self.tensors[0].shape[0]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.nr_samples // self.batch_size
+        return (self.nr_samples + self.batch_size - 1) // self.batch_size
+
+    def get_batch(self, indices):
+        if not self.pin_memory:
+            return [tensor.index_select(0, indices) for tensor in self.tensors]
+        batch = []
+        for tensor in self.tensors:
+            buffer = torch.empty((len(indices),) + tensor.shape[1:], dtype=tensor.dtype, pin_memory=True)
+            torch.index_select(tensor, 0, indices, out=buffer)
+            batch.append(buffer.to(self.device, non_blocking=True))
+        return batch
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.nr_samples, device=self.storage_device)
+        else:
+            order = torch.arange(self.nr_samples, device=self.storage_device)
+        for i in range(len(self)):
+            yield self.get_batch(order[i * self.batch_size:(i + 1) * self.batch_size])
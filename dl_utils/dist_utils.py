@@ -0,0 +1,211 @@
+"""
+dist_utils.py
+
+Helpers for multi-process training with torch.distributed (one process per GPU, or per group of CPU cores with
+the gloo backend). All of them are no-ops in a single process, so that the trainers call them unconditionally.
+"""
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    """
+    Index of the process on its node (device index), LOCAL_RANK if set by the launcher (e.g., torchrun)
+    """
+    return int(os.environ['LOCAL_RANK']) if 'LOCAL_RANK' in os.environ.keys() else get_rank()
+
+
+def is_main_process():
+    """
+    Rank 0: the process that logs to wandb and writes the checkpoints
+    """
+    return get_rank() == 0
+
+
+def init_distributed(rank, world_size, backend='gloo', init_method='env://'):
+    """
+    :param backend: str
+        gloo (CPU) or nccl (GPU)
+    :param init_method: str
+        env:// reads MASTER_ADDR and MASTER_PORT
+    """
+    if backend == 'nccl':
+        torch.cuda.set_device(get_local_rank() if 'LOCAL_RANK' in os.environ.keys() else rank)
+    dist.init_process_group(backend=backend, init_method=init_method, rank=rank, world_size=world_size)
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def get_comm_device():
+    """
+    Device of the tensors exchanged by the collectives: nccl only works on CUDA tensors
+    """
+    return torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' \
+        else torch.device('cpu')
+
+
+def coalesced(tensors, collective):
+    """
+    Runs collective (in place) once per flat buffer of the tensors of the same dtype and device, instead of once
+    per tensor, and copies the result back
+    """
+    groups = {}
+    for tensor in tensors:
+        groups.setdefault((tensor.dtype, tensor.device), []).append(tensor)
+    for group in groups.values():
+        flat = torch._utils._flatten_dense_tensors(group)
+        device = flat.device
+        flat = flat.to(get_comm_device())
+        collective(flat)
+        for tensor, synced in zip(group, torch._utils._unflatten_dense_tensors(flat.to(device), group)):
+            tensor.copy_(synced)
+
+
+def broadcast_module(module, src=0, buffers_only=False):
+    """
+    Copies the parameters and buffers (e.g., batch-norm running statistics) of the module of rank src to all ranks
+    """
+    if not is_distributed():
+        return
+    tensors = list(module.buffers()) if buffers_only else list(module.parameters()) + list(module.buffers())
+    with torch.no_grad():
+        coalesced([tensor.data for tensor in tensors], lambda flat: dist.broadcast(flat, src=src))
+
+
+def all_reduce_gradients(parameters):
+    """
+    Averages the gradients of parameters over the ranks, as DistributedDataParallel does during backward.
+    Called before the optimizer step (once per step with gradient accumulation). Missing gradients count as zeros,
+    so that all the ranks exchange the same buffers.
+    """
+    if not is_distributed():
+        return
+    parameters = [param for param in parameters if param.requires_grad]
+    for param in parameters:
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+    world_size = get_world_size()
+
+    def average(flat):
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+
+    with torch.no_grad():
+        coalesced([param.grad for param in parameters], average)
+
+
+def all_reduce_sum(values):
+    """
+    Sums numbers over the ranks, e.g., the loss sums and number of samples of an epoch
+    :param values: number, torch.Tensor or dict
+        scalars (or dict of scalars)
+    :return:
+        same type as values (floats)
+    """
+    if not is_distributed():
+        return values
+    keys = list(values.keys()) if isinstance(values, dict) else None
+    numbers = [values[key] for key in keys] if keys is not None else [values]
+    tensor = torch.tensor([float(number) for number in numbers], dtype=torch.float64, device=get_comm_device())
+    dist.all_reduce(tensor)
+    sums = tensor.tolist()
+    return dict(zip(keys, sums)) if keys is not None else sums[0]
+
+
+def all_gather_array(array):
+    """
+    :return: np.ndarray
+        arrays of all ranks concatenated along the first axis (rank order)
+    """
+    if not is_distributed():
+        return array
+    arrays = [None] * get_world_size()
+    dist.all_gather_object(arrays, np.asarray(array))
+    return np.concatenate(arrays, 0)
+
+
+class _AllGatherLocalGrad(torch.autograd.Function):
+    """
+    all_gather along the first axis (sizes may differ between the ranks), back-propagating to the local part only
+    """
+    @staticmethod
+    def forward(ctx, tensor):
+        device = get_comm_device()
+        size = torch.tensor([tensor.shape[0]], device=device)
+        sizes = [torch.zeros_like(size) for _ in range(get_world_size())]
+        dist.all_gather(sizes, size)
+        sizes = [int(s.item()) for s in sizes]
+        padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]), device=device)
+        padded[:tensor.shape[0]] = tensor.detach()
+        gathered = [torch.empty_like(padded) for _ in sizes]
+        dist.all_gather(gathered, padded)
+        ctx.offset, ctx.size = sum(sizes[:get_rank()]), tensor.shape[0]
+        return torch.cat([part[:s] for part, s in zip(gathered, sizes)]).to(tensor.device)
+
+    @staticmethod
+    def backward(ctx, grad):
+        # each rank computes the same loss of the gathered tensor and the gradients of the parameters are averaged
+        # over the ranks (all_reduce_gradients): scaled by the world size, their average is the gradient of the loss
+        return grad[ctx.offset:ctx.offset + ctx.size] * get_world_size()
+
+
+def all_gather_with_grad(tensor):
+    """
+    Tensors of all ranks concatenated along the first axis (rank order), e.g., the latent codes of a loss that depends
+    on all the pairs of samples (attribute regularization). The gradient flows back to the local entries only, scaled
+    so that, after all_reduce_gradients, it is the gradient of the loss of the whole (gathered) batch.
+    :param tensor: torch.Tensor
+        (N_rank, ...), N_rank may differ between the ranks
+    :return: torch.Tensor
+        (sum of N_rank, ...)
+    """
+    if not is_distributed():
+        return tensor
+    return _AllGatherLocalGrad.apply(tensor)
+
+
+def all_gather_object(obj):
+    """
+    :return: list
+        obj of every rank (picklable), in rank order, e.g., the random states of the ranks
+    """
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def broadcast_object(obj, src=0):
+    """
+    :return:
+        obj of rank src (picklable), e.g., a decision or a name that has to be the same on all ranks
+    """
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
@@ -0,0 +1,137 @@
+"""
+repack_h5.py
+
+Repacks a cardiac patch file with one group per subject ({pid}/ED, {pid}/ES) into a single (N, C, H, W)
+'images' dataset plus a 'pids' dataset giving the subject of each row. CardiacCustomDataset detects the
+packed layout (attribute layout='packed') and reads rows instead of per-subject datasets.
+
+python dl_utils/repack_h5.py --input patches.h5 --output patches_packed.h5 --crop_size 128 --compression lz4
+
+If the images do not all have the same size, --crop_size center crops (zero pads) them like
+torchvision.transforms.CenterCrop; use the win_size of the experiments to keep the loader outputs unchanged.
+lz4 and blosc compression require the hdf5plugin package, also when reading the packed file.
+"""
+import argparse
+import logging
+import sys
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, './')
+from data.cardiac_loader_2D import CardiacBatchTransform
+
+PACKED_LAYOUT = 'packed'
+
+
+def get_compression(name, level=None):
+    """
+    :param name: str
+        none | gzip | lzf | lz4 | blosc
+    :return: dict
+        h5py create_dataset keyword arguments for the compression filter
+    """
+    if name is None or name == 'none':
+        return {}
+    if name == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': level if level is not None else 4}
+    if name == 'lzf':
+        return {'compression': 'lzf'}
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(f'[repack_h5] {name} compression requires the hdf5plugin package')
+    if name == 'lz4':
+        return dict(hdf5plugin.LZ4())
+    if name == 'blosc':
+        clevel = level if level is not None else 5
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=clevel, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError(f'[repack_h5] Unknown compression {name}')
+
+
+def get_moments(src, pid):
+    """
+    :return: list
+        names of the datasets of a subject, [''] if the subject is stored as a single dataset
+    """
+    if isinstance(src[pid], h5py.Dataset):
+        return ['']
+    return [moment for moment in ('ED', 'ES') if moment in src[pid]]
+
+
+def read_case(src, pid, moments, crop):
+    images = []
+    for moment in moments:
+        ds = src[pid] if moment == '' else src[f'{pid}/{moment}']
+        if crop is None:
+            images.append(ds[()])
+        else:
+            img = np.zeros((crop.crop_size, crop.crop_size), dtype=ds.dtype)
+            (src_h, dst_h), (src_w, dst_w) = crop.crop_window(ds.shape)
+            img[dst_h, dst_w] = ds[src_h, src_w]
+            images.append(img)
+    return np.stack(images, 0)
+
+
+def repack(input_path, output_path, crop_size=None, chunk_rows=1, compression=None, compression_level=None,
+           block_size=1024):
+    """
+    :param crop_size: int
+        center crop size, required if the images do not all have the same shape
+    :param chunk_rows: int
+        number of subjects per h5 chunk, 0 for a contiguous dataset (no compression possible)
+    :param block_size: int
+        number of subjects read into memory before being written
+    """
+    crop = CardiacBatchTransform(crop_size) if crop_size is not None else None
+    with h5py.File(input_path, 'r') as src:
+        pids = sorted(src.keys())
+        moments = get_moments(src, pids[0])
+        first = read_case(src, pids[0], moments, crop)
+        shape = (len(pids),) + first.shape
+
+        if crop is None:
+            for pid in pids:
+                sizes = {(src[pid] if m == '' else src[f'{pid}/{m}']).shape for m in moments}
+                if sizes != {first.shape[1:]}:
+                    raise ValueError(f'[repack_h5] {pid} has images of shape {sizes} instead of {first.shape[1:]},'
+                                     f' please set --crop_size')
+
+        create_kwargs = get_compression(compression, compression_level)
+        if chunk_rows > 0:
+            create_kwargs['chunks'] = (min(chunk_rows, len(pids)),) + first.shape
+        elif len(create_kwargs) > 0:
+            raise ValueError('[repack_h5] Compression requires a chunked dataset (chunk_rows > 0)')
+
+        with h5py.File(output_path, 'w') as dst:
+            dst.attrs['layout'] = PACKED_LAYOUT
+            dst.attrs['moments'] = [m if m != '' else 'image' for m in moments]
+            if crop_size is not None:
+                dst.attrs['crop_size'] = crop_size
+            images = dst.create_dataset('images', shape=shape, dtype=first.dtype, **create_kwargs)
+            dst.create_dataset('pids', data=np.array(pids, dtype=object), dtype=h5py.string_dtype())
+
+            for start in range(0, len(pids), block_size):
+                block = [read_case(src, pid, moments, crop) for pid in pids[start:start + block_size]]
+                images[start:start + len(block)] = np.stack(block, 0)
+                logging.info(f'[repack_h5] {start + len(block)}/{len(pids)} subjects written')
+    return shape
+
+
+def add_args(parser):
+    parser.add_argument('--input', type=str, required=True, help='path to the per-subject .h5 patch file')
+    parser.add_argument('--output', type=str, required=True, help='path to the packed .h5 file to write')
+    parser.add_argument('--crop_size', type=int, default=None, help='center crop size (e.g. win_size)')
+    parser.add_argument('--chunk_rows', type=int, default=1, help='subjects per chunk, 0 for contiguous storage')
+    parser.add_argument('--compression', type=str, default='none', choices=['none', 'gzip', 'lzf', 'lz4', 'blosc'])
+    parser.add_argument('--compression_level', type=int, default=None, help='gzip / blosc compression level')
+    parser.add_argument('--block_size', type=int, default=1024, help='subjects held in memory while repacking')
+    return parser
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='Repack cardiac h5 patch files')).parse_args()
+    shape = repack(args.input, args.output, args.crop_size, args.chunk_rows, args.compression,
+                   args.compression_level, args.block_size)
+    logging.info(f'[repack_h5] Wrote images of shape {shape} to {args.output}')
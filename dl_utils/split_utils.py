@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold, train_test_split
+
+
+class SplitManager(object):
+    """
+    Stratified train/val/test and k-fold splits, generated once and stored as .npy index arrays.
+
+    The splits are keyed on the dataset (hash of the subject ids and labels), the seed and the split sizes,
+    so that every run with the same key reuses the same indices instead of regenerating them. The test set is
+    held out first; the remaining subjects are split into train/val or into n_folds stratified folds.
+    """
+    def __init__(self, split_dir, pids, labels, seed=2109, val_size=0.075, test_size=0.075, n_folds=None):
+        """
+        :param split_dir: str
+            folder where the splits/ sub-folder is created, e.g., next to the data
+        :param pids: array-like
+            subject ids, in dataset order
+        :param labels: array-like
+            labels used for the stratification, in dataset order
+        :param val_size: float
+            fraction of the whole dataset used for validation (ignored with n_folds)
+        :param test_size: float
+            fraction of the whole dataset held out for testing
+        :param n_folds: int
+            number of cross-validation folds over the non-test subjects, None for a single train/val split
+        """
+        self.pids = np.asarray(pids).astype(str)
+        self.labels = np.asarray(labels)
+        self.seed = seed
+        self.val_size = val_size
+        self.test_size = test_size
+        self.n_folds = n_folds
+        self.split_path = os.path.join(split_dir, 'splits', self.get_key())
+
+    def get_dataset_hash(self):
+        content = '\n'.join(self.pids) + '\n' + '\n'.join(self.labels.astype(str))
+        return hashlib.sha1(content.encode()).hexdigest()[:12]
+
+    def get_key(self):
+        key = f'{self.get_dataset_hash()}_seed{self.seed}_test{self.test_size}'
+        if self.n_folds is None:
+            return key + f'_val{self.val_size}'
+        return key + f'_{self.n_folds}fold'
+
+    def get_files(self):
+        files = {'test': 'test.npy'}
+        if self.n_folds is None:
+            files.update({'train': 'train.npy', 'val': 'val.npy'})
+        else:
+            for fold in range(self.n_folds):
+                files.update({f'train_{fold}': f'fold{fold}_train.npy', f'val_{fold}': f'fold{fold}_val.npy'})
+        return {name: os.path.join(self.split_path, file) for name, file in files.items()}
+
+    def generate(self):
+        indices = np.arange(len(self.pids))
+        rest, test = train_test_split(indices, test_size=self.test_size, stratify=self.labels,
+                                      random_state=self.seed)
+        splits = {'test': test}
+        if self.n_folds is None:
+            train, val = train_test_split(rest, test_size=self.val_size / (1 - self.test_size),
+                                          stratify=self.labels[rest], random_state=self.seed)
+            splits.update({'train': train, 'val': val})
+        else:
+            k_fold = StratifiedKFold(n_splits=self.n_folds, shuffle=True, random_state=self.seed)
+            for fold, (train, val) in enumerate(k_fold.split(rest, self.labels[rest])):
+                splits.update({f'train_{fold}': rest[train], f'val_{fold}': rest[val]})
+        return {name: np.sort(split).astype(np.int64) for name, split in splits.items()}
+
+    def save(self, splits):
+        os.makedirs(self.split_path, exist_ok=True)
+        for name, path in self.get_files().items():
+            # write then rename, so that concurrent jobs never read a partially written file
+            tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+            np.save(tmp_path, splits[name])
+            os.replace(tmp_path, path)
+
+    def load(self):
+        files = self.get_files()
+        if not all(os.path.isfile(path) for path in files.values()):
+            return None
+        return {name: np.load(path) for name, path in files.items()}
+
+    def get_split(self, fold=None):
+        """
+        :param fold: int
+            cross-validation fold, required if n_folds is set
+        :return: tuple of np.ndarray
+            train, val, test indices
+        """
+        splits = self.load()
+        if splits is None:
+            logging.info(f'[SplitManager::get_split] Generating splits in {self.split_path}')
+            splits = self.generate()
+            self.save(splits)
+        if self.n_folds is None:
+            return splits['train'], splits['val'], splits['test']
+        if fold is None or not 0 <= fold < self.n_folds:
+            raise ValueError(f'[SplitManager::get_split] fold should be in [0, {self.n_folds - 1}], got {fold}')
+        return splits[f'train_{fold}'], splits[f'val_{fold}'], splits['test']
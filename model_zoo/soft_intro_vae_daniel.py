@@ -12,6 +12,7 @@ In Proceedings of the IEEE/CVF Conference on Computer Vision and Pattern Recogni
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 # standard
 import matplotlib
@@ -48,6 +49,15 @@ class ResidualBlock(nn.Module):
                                bias=False)
         self.bn2 = nn.BatchNorm2d(outc)
         self.relu2 = nn.LeakyReLU(0.2, inplace=True)
+        self.inplace_add = False
+
+    def fuse_conv_bn(self):
+        """
+        Folds bn1 / bn2 (running statistics) into conv1 / conv2 for inference, see SoftIntroVAE.optimize_for_inference
+        """
+        self.conv1, self.bn1 = fuse_conv_bn_eval(self.conv1, self.bn1), nn.Identity()
+        self.conv2, self.bn2 = fuse_conv_bn_eval(self.conv2, self.bn2), nn.Identity()
+        self.inplace_add = True
 
     def forward(self, x):
         if self.conv_expand is not None:
@@ -58,7 +68,10 @@ class ResidualBlock(nn.Module):
         output = self.relu1(self.bn1(self.conv1(x)))
         output = self.conv2(output)
         output = self.bn2(output)
-        output = self.relu2(torch.add(output, identity_data))
+        if self.inplace_add:
+            output = self.relu2(output.add_(identity_data))
+        else:
+            output = self.relu2(torch.add(output, identity_data))
         return output
 
 
@@ -72,6 +85,7 @@ class Encoder(nn.Module):
         self.image_size = image_size
         self.conditional = conditional
         self.cond_dim = cond_dim
+        self.memory_format = torch.contiguous_format
         cc = channels[0]
         self.main = nn.Sequential(
             nn.Conv2d(nc, cc, 5, 1, 2, bias=False),
@@ -103,8 +117,19 @@ class Encoder(nn.Module):
         dummy_input = self.main(dummy_input)
         return dummy_input[0].shape
 
+    def fuse_conv_bn(self):
+        """
+        Folds the BatchNorm layers into the preceding convolutions for inference, see SoftIntroVAE.optimize_for_inference
+        """
+        self.main[0], self.main[1] = fuse_conv_bn_eval(self.main[0], self.main[1]), nn.Identity()
+        self.main[2].inplace = True
+        for module in self.main:
+            if isinstance(module, ResidualBlock):
+                module.fuse_conv_bn()
+
     def forward(self, x, o_cond=None):
-        y = self.main(x).view(x.size(0), -1)
+        x = x.contiguous(memory_format=self.memory_format)
+        y = self.main(x).reshape(x.size(0), -1)
         if self.conditional and o_cond is not None:
             y = torch.cat([y, o_cond], dim=1)
         y = self.fc(y)
@@ -133,6 +158,7 @@ class Decoder(nn.Module):
         self.nc = nc
         self.image_size = image_size
         self.conditional = conditional
+        self.memory_format = torch.contiguous_format
         cc = channels[-1]
         self.conv_input_size = conv_input_size
         if conv_input_size is None:
@@ -175,15 +201,23 @@ class Decoder(nn.Module):
                 if 'bn' not in name:
                     nn.init.xavier_normal_(param)
 
+    def fuse_conv_bn(self):
+        """
+        Folds the BatchNorm layers into the preceding convolutions for inference, see SoftIntroVAE.optimize_for_inference
+        """
+        for module in self.main:
+            if isinstance(module, ResidualBlock):
+                module.fuse_conv_bn()
+
     def forward(self, z, y_cond=None):
         z = z.view(z.size(0), -1)
         if self.conditional and y_cond is not None:
             y_cond = y_cond.view(y_cond.size(0), -1)
             z = torch.cat([z, y_cond], dim=1)
         y = self.fc(z)
-        y = y.view(z.size(0), *self.conv_input_size)
+        y = y.view(z.size(0), *self.conv_input_size).contiguous(memory_format=self.memory_format)
         y = self.main(y)
-        return y
+        return y.contiguous()
 
 
 class SoftIntroVAE(nn.Module):
@@ -240,6 +274,29 @@ class SoftIntroVAE(nn.Module):
             y = self.decoder(z)
         return y
 
+    def optimize_for_inference(self, channels_last=True):
+        """
+        Converts the model, in place, for evaluation and latent export:
+        - the BatchNorm layers are folded into the preceding convolutions (with their running statistics)
+        - the convolutions run in channels_last memory format (outputs of decode are returned contiguous)
+        - in-place activations and residual additions, no gradients for the parameters
+        The model cannot be trained afterwards and its state_dict keys change, load the weights before and use a copy:
+        inference_model = copy.deepcopy(model).optimize_for_inference()
+        :param channels_last: bool
+            channels_last memory format of the convolutions
+        :return: SoftIntroVAE
+            self
+        """
+        self.eval()
+        with torch.no_grad():
+            self.encoder.fuse_conv_bn()
+            self.decoder.fuse_conv_bn()
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+            self.encoder.memory_format = self.decoder.memory_format = torch.channels_last
+        self.requires_grad_(False)
+        return self
+
 """
 Helpers
 """
@@ -0,0 +1,80 @@
+"""
+compile.py
+
+torch.compile of the sub-networks of a model, with a fallback to eager mode
+"""
+import logging
+import types
+
+import torch
+
+
+class CompiledForward(object):
+    """
+    Compiled forward installed on a module instance (module.forward), so that the module keeps its class,
+    parameters and state_dict keys (checkpoints stay interchangeable with eager models). If compilation or the
+    compiled call fails, the module falls back to its eager forward for good.
+    Deep copies of the module (e.g., the test model of the trainers) get their own CompiledForward.
+    """
+    def __init__(self, module, **compile_kwargs):
+        """
+        :param module: torch.nn.Module
+        :param compile_kwargs: dict
+            arguments of torch.compile, e.g., mode, backend, dynamic
+        """
+        self.module = module
+        self.compile_kwargs = compile_kwargs
+        self.eager = types.MethodType(type(module).forward, module)
+        self.compiled = None
+        if hasattr(torch, 'compile'):
+            try:
+                self.compiled = torch.compile(self.eager, **compile_kwargs)
+            except Exception as e:
+                logging.warning(f'[CompiledForward::init] Cannot compile {type(module).__name__}, using eager mode: {e}')
+        else:
+            logging.warning('[CompiledForward::init] torch.compile is not available (torch < 2.0), using eager mode')
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                logging.warning(f'[CompiledForward::call] Compiled {type(self.module).__name__} failed, falling back to '
+                                f'eager mode: {e}')
+                self.compiled = None
+        return self.eager(*args, **kwargs)
+
+    def __deepcopy__(self, memo):
+        # the module is being copied (and is already in memo): compile the forward of the copy
+        module = memo.get(id(self.module))
+        if module is None:
+            return self
+        return CompiledForward(module, **self.compile_kwargs)
+
+    def __getstate__(self):
+        raise TypeError('[CompiledForward] Compiled modules cannot be pickled, save their state_dict instead')
+
+
+def compile_model(model, compile_params):
+    """
+    Compiles sub-networks of a model in place. The sub-networks are compiled separately since they are also called
+    on their own (e.g., model.encode / model.decode in the Soft-Intro VAE step).
+    :param model: torch.nn.Module
+    :param compile_params: dict
+        {enabled: bool, modules: list of attribute names (default: encoder and decoder if they exist, else the whole
+        model), mode: str, backend: str, dynamic: bool}
+    :return: torch.nn.Module
+        the same model
+    """
+    if compile_params is None or not compile_params['enabled']:
+        return model
+    module_names = compile_params['modules'] if 'modules' in compile_params.keys() else \
+        [name for name in ['encoder', 'decoder'] if isinstance(getattr(model, name, None), torch.nn.Module)]
+    compile_kwargs = {key: compile_params[key] for key in ['mode', 'backend', 'dynamic'] if key in compile_params.keys()}
+
+    modules = [getattr(model, name) for name in module_names] if len(module_names) > 0 else [model]
+    for module in modules:
+        module.forward = CompiledForward(module, **compile_kwargs)
+    logging.info(f'[compile_model] Compiled {module_names if len(module_names) > 0 else type(model).__name__} '
+                 f'with {compile_kwargs}')
+    return model
@@ -1,2 +1,3 @@
 from .ln_losses import *
 from .image_losses import *
+from .memory_bank import *
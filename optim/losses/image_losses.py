@@ -1,3 +1,4 @@
+import contextlib
 import torch
 import torch.nn.functional as F
 from torch.nn import BCELoss
@@ -6,6 +7,7 @@ import math
 from model_zoo import VGGEncoder
 from torch.nn.modules.loss import _Loss
 from optim.losses.ln_losses import L2
+from dl_utils.dist_utils import all_gather_with_grad, is_distributed
 
 
 class KLDLoss:
@@ -189,12 +191,17 @@ class DisplacementRegularizer2D(torch.nn.Module):
 
 class PerceptualLoss(_Loss):
     """
+    Sum over the channels and the VGG layers of the mean squared error between the VGG features of input and target.
+    The channels of both images are folded into the batch of a single VGG forward (the VGG weights are frozen).
+    Within cache(), the features of each tensor are computed once, e.g., for the targets used by several losses of a
+    training step.
     """
 
     def __init__(
         self,
         reduction: str = 'mean',
-        device: str = 'gpu') -> None:
+        device: str = 'gpu',
+        detach_target: bool = False) -> None:
         """
         Args
             reduction: str, {'none', 'mean', 'sum}
@@ -202,11 +209,74 @@ class PerceptualLoss(_Loss):
                 - 'none': no reduction will be applied.
                 - 'mean': the sum of the output will be divided by the number of elements in the output.
                 - 'sum': the output will be summed.
+            detach_target: bool
+                no gradient through the features of target (computed without graph)
         """
         super().__init__()
         self.device = device
         self.reduction = reduction
+        self.detach_target = detach_target
         self.loss_network = VGGEncoder().eval().to(self.device)
+        self.loss_network.requires_grad_(False)
+        self._cache = None
+
+    @contextlib.contextmanager
+    def cache(self):
+        """
+        Features cached by tensor (storage, shape and version, i.e., not after in-place changes) until exit, e.g.,
+        for one training step. The cached tensors are kept alive, so that their memory is not reused by other tensors.
+        """
+        outer = self._cache is not None
+        if not outer:
+            self._cache = {}
+        try:
+            yield
+        finally:
+            if not outer:
+                self._cache = None
+
+    @staticmethod
+    def _needs_grad(x, detach):
+        return x.requires_grad and torch.is_grad_enabled() and not detach
+
+    def _cache_key(self, x, detach):
+        return (x.data_ptr(), tuple(x.shape), x.stride(), x._version, x.dtype, self._needs_grad(x, detach),
+                torch.is_autocast_enabled())
+
+    def _features(self, images):
+        """
+        VGG features of (N, C, H, W) images, each channel as a 3-channel image: list of (N, C, C_l, H_l, W_l)
+        """
+        n, nc = images.shape[:2]
+        features = self.loss_network(images.reshape(n * nc, 1, *images.shape[2:]).repeat(1, 3, 1, 1))
+        return [feature.reshape(n, nc, *feature.shape[1:]) for feature in features]
+
+    def get_features(self, tensors, detach):
+        """
+        Features of each tensor (from the cache if available). The tensors that are not cached are computed in one
+        forward for those with gradient and one forward without graph for the others (e.g., the targets), so that
+        the backward pass does not run over the latter.
+        :param detach: list of bool, no gradient through the features of the tensor
+        """
+        features = [None] * len(tensors)
+        keys = [self._cache_key(x, detach_x) for x, detach_x in zip(tensors, detach)]
+        if self._cache is not None:
+            for idx, key in enumerate(keys):
+                if key in self._cache.keys():
+                    features[idx] = self._cache[key][1]
+        for needs_grad in (True, False):
+            missing = [idx for idx in range(len(tensors))
+                       if features[idx] is None and self._needs_grad(tensors[idx], detach[idx]) == needs_grad]
+            if len(missing) == 0:
+                continue
+            with torch.set_grad_enabled(needs_grad):
+                batch_features = self._features(torch.cat([tensors[idx] for idx in missing]))
+            sizes = [tensors[idx].shape[0] for idx in missing]
+            for idx, split_features in zip(missing, zip(*[feature.split(sizes) for feature in batch_features])):
+                features[idx] = list(split_features)
+                if self._cache is not None:
+                    self._cache[keys[idx]] = (tensors[idx], features[idx])
+        return features
 
     def forward(self, input: torch.Tensor, target: torch.Tensor):
         """
@@ -214,7 +284,7 @@ class PerceptualLoss(_Loss):
             input: (N,*),
                 where N is the batch size and * is any number of additional dimensions.
             target (N,*),
-                same shape as input.
+                same shape as input, e.g., the reference images of a reconstruction
 
         Comment:
             When the number of channels is superior to 1, the loss is computed for each channel
@@ -223,25 +293,171 @@ class PerceptualLoss(_Loss):
         """
 
         nc = input.size(1) # if 2 channels
+        input_features, output_features = self.get_features([input, target], detach=[False, self.detach_target])
+
         loss_pl = 0
+        for output_feature, input_feature in zip(output_features, input_features):
+            # sum over the channels of the means over the features of each channel
+            loss_pl += nc * F.mse_loss(output_feature, input_feature)
 
-        for i in range(nc):
-            input_features = self.loss_network(input[:,i:i+1,:,:].repeat(1, 3, 1, 1))
-            output_features = self.loss_network(target[:,i:i+1,:,:].repeat(1, 3, 1, 1))
+        return loss_pl
 
-            for output_feature, input_feature in zip(output_features, input_features):
-                loss_pl += F.mse_loss(output_feature, input_feature)
+_upper_triangles = {}
 
-        return loss_pl
 
-def compute_reg_loss(z, attr,factor):
-    reg_loss = 0.0
-    reg_dim_real = attr.size()[1]
-    for dim in range(reg_dim_real):
-        x_ = z[:, dim]
-        reg_loss += reg_loss_sign(x_, attr[:, dim], factor)
+def upper_triangle_indices(n, device):
+    """
+    Indices (i, j) of the pairs i < j of n samples, cached per size and device
+    """
+    key = (n, str(device))
+    if key not in _upper_triangles.keys():
+        _upper_triangles[key] = torch.triu_indices(n, n, offset=1, device=device).unbind(0)
+    return _upper_triangles[key]
 
-    return reg_loss
+def compute_reg_loss(z, attr, factor, tile_size=None, estimator=None):
+    """
+    Attribute regularization: sum over the regularized dimensions d < attr.size()[1] of reg_loss_sign(z[:, d],
+    attr[:, d], factor), for all the dimensions at once on the device of z.
+    The loss of a pair (i, j) is the one of (j, i) and is 0 for i = j, so only the pairs i < j are computed
+    (counted twice in the mean over the N x N pairs).
+    Args:
+        z: torch.Tensor, (N, zdim)
+        attr: torch.Tensor, (N, reg_dim)
+        factor: parameter for scaling the loss
+        tile_size: rows per block of TiledRegLoss for N > tile_size (memory O(N * tile_size)), None: all the pairs
+            at once (memory O(N^2))
+        estimator: dict, approximation of the loss with O(N log N) cost, see estimate_reg_loss, e.g.,
+            {mode: sampled, nr_pairs: 32} or {mode: window, window: 16}. None: exact loss
+    Returns
+        scalar, loss
+    """
+    n, reg_dim = attr.size()
+    latent_code = z[:, :reg_dim]
+    attribute = attr.to(z.device)
+    if estimator is not None:
+        return estimate_reg_loss(latent_code, attribute, factor, **estimator)
+    if tile_size is not None and n > tile_size:
+        return TiledRegLoss.apply(latent_code, attribute, factor, tile_size)
+    i, j = upper_triangle_indices(n, z.device)
+    lc_tanh = torch.tanh((latent_code[i] - latent_code[j]) * factor)
+    attribute_sign = torch.sign(attribute[i] - attribute[j]).float()
+    return 2 * (lc_tanh - attribute_sign).abs().sum() / (n * n)
+
+def estimate_reg_loss(latent_code, attribute, factor, mode='sampled', nr_pairs=32, window=16):
+    """
+    Approximation of compute_reg_loss L (exact: sum over the D dimensions of the mean over the N x N pairs of the
+    pair losses l in [0, 2]) from O(N) pairs, for batches or memory banks where the N^2 pairs are too many.
+    - sampled: nr_pairs partners per anchor, drawn uniformly (with replacement) from the N samples and shared by the
+      dimensions. Unbiased, and by Hoeffding's inequality (N * nr_pairs independent terms in [0, 2] per dimension,
+      union bound over the dimensions), with probability at least 1 - delta:
+          |L_sampled - L| <= D * sqrt(2 * ln(2 * D / delta) / (N * nr_pairs))
+      e.g., 0.062 for N = 4096, nr_pairs = 32, D = 6, delta = 0.01. Cost O(N * nr_pairs * D).
+    - window: the samples are sorted by each attribute once, and each sample is paired with its next window
+      neighbours in this order, i.e., the pairs with the closest attribute values, where the sign is the hardest to
+      satisfy. Deterministic, but biased towards these pairs; with the P_w = sum_{k <= window} (N - k) pairs of the
+      window out of the P = N * (N - 1) / 2 pairs:
+          |L_window - L| <= 2 * D * (1 - 1 / N) * (1 - P_w / P)
+      and exact for window >= N - 1. Cost O(D * N * log(N) + N * window * D).
+    Args:
+        latent_code: torch.Tensor, (N, D), latent codes of the regularized dimensions
+        attribute: torch.Tensor, (N, D)
+        factor: parameter for scaling the loss
+        mode: str, sampled | window
+        nr_pairs: int, partners per anchor (sampled)
+        window: int, neighbours per sample in the attribute order (window)
+    Returns
+        scalar, loss
+    """
+    n = latent_code.shape[0]
+    if mode == 'sampled':
+        anchors = torch.arange(n, device=latent_code.device).repeat_interleave(nr_pairs)
+        partners = torch.randint(0, n, (n * nr_pairs,), device=latent_code.device)
+        lc_tanh = torch.tanh((latent_code[anchors] - latent_code[partners]) * factor)
+        attribute_sign = torch.sign(attribute[anchors] - attribute[partners]).to(lc_tanh.dtype)
+        return (lc_tanh - attribute_sign).abs().sum() / (n * nr_pairs)
+    if mode == 'window':
+        window = min(window, n - 1)
+        if window < 1:
+            return latent_code.sum() * 0.0
+        # each column sorted by its attribute
+        order = torch.argsort(attribute, dim=0)
+        lc_sorted, attribute_sorted = latent_code.gather(0, order), attribute.gather(0, order)
+        loss = 0.0
+        for k in range(1, window + 1):
+            lc_tanh = torch.tanh((lc_sorted[:-k] - lc_sorted[k:]) * factor)
+            attribute_sign = torch.sign(attribute_sorted[:-k] - attribute_sorted[k:]).to(lc_tanh.dtype)
+            loss = loss + (lc_tanh - attribute_sign).abs().sum()
+        nr_window_pairs = window * n - window * (window + 1) // 2
+        # mean over the window pairs for the mean over the pairs i < j, scaled to the mean over the N x N pairs
+        return loss * (n - 1) / (n * nr_window_pairs)
+    raise ValueError('[estimate_reg_loss] ERROR: Unknown mode {}, use sampled or window'.format(mode))
+
+class TiledRegLoss(torch.autograd.Function):
+    """
+    compute_reg_loss over blocks of tile_size rows of the pairs i < j, so that no N x N tensor is materialized.
+    The backward pass recomputes the blocks instead of storing them: only z and attr are saved.
+    d|tanh(f u) - s| / du = sign(tanh(f u) - s) * f * (1 - tanh(f u)^2) for u = z_i - z_j, as autograd of the dense
+    loss (with sign(0) = 0).
+    """
+    @staticmethod
+    def _blocks(latent_code, attribute, factor, tile_size):
+        n = latent_code.shape[0]
+        for start in range(0, n, tile_size):
+            end = min(start + tile_size, n)
+            # rows [start, end) against the columns [start, n), pairs j > i only
+            mask = (torch.arange(start, n, device=latent_code.device)[None, :] >
+                    torch.arange(start, end, device=latent_code.device)[:, None]).unsqueeze(-1)
+            lc_tanh = torch.tanh((latent_code[start:end, None] - latent_code[None, start:]) * factor)
+            attribute_sign = torch.sign(attribute[start:end, None] - attribute[None, start:]).to(lc_tanh.dtype)
+            yield start, end, mask, lc_tanh, attribute_sign
+
+    @staticmethod
+    def forward(ctx, latent_code, attribute, factor, tile_size):
+        ctx.save_for_backward(latent_code, attribute)
+        ctx.factor, ctx.tile_size = factor, tile_size
+        loss = latent_code.new_zeros(())
+        for _, _, mask, lc_tanh, attribute_sign in TiledRegLoss._blocks(latent_code, attribute, factor, tile_size):
+            loss += ((lc_tanh - attribute_sign).abs() * mask).sum()
+        n = latent_code.shape[0]
+        return 2 * loss / (n * n)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        latent_code, attribute = ctx.saved_tensors
+        n = latent_code.shape[0]
+        grad = torch.zeros_like(latent_code)
+        for start, end, mask, lc_tanh, attribute_sign in TiledRegLoss._blocks(latent_code, attribute, ctx.factor,
+                                                                              ctx.tile_size):
+            grad_pair = torch.sign(lc_tanh - attribute_sign) * ctx.factor * (1 - lc_tanh ** 2) * mask
+            grad[start:end] += grad_pair.sum(1)
+            grad[start:] -= grad_pair.sum(0)
+        return grad * (2 * grad_output / (n * n)), None, None, None
+
+def gather_reg_inputs(z, attr):
+    """
+    Latent codes of the regularized dimensions and attributes of all the ranks (distributed training), so that the
+    attribute regularization compares the pairs across the ranks, as for one batch. The gradient flows back to the
+    local latent codes only.
+    :param z: torch.Tensor
+        (N_rank, zdim) latent codes of the local batch
+    :param attr: torch.Tensor
+        (N_rank, reg_dim) attributes of the local batch
+    :return: tuple
+        (N, reg_dim) latent codes, (N, reg_dim) attributes
+    """
+    if not is_distributed():
+        return z, attr
+    reg_dim = attr.size()[1]
+    return all_gather_with_grad(z[:, :reg_dim]), all_gather_with_grad(attr.to(z.device))
+
+def compute_reg_loss_distributed(z, attr, factor, tile_size=None, estimator=None):
+    """
+    compute_reg_loss over the latent codes of all the ranks, equal to compute_reg_loss of one batch made of the
+    batches of the ranks (in rank order). Same as compute_reg_loss in a single process.
+    """
+    z, attr = gather_reg_inputs(z, attr)
+    return compute_reg_loss(z, attr, factor, tile_size, estimator)
 
 def reg_loss_sign(latent_code, attribute, factor):
     """
@@ -258,12 +474,12 @@ def reg_loss_sign(latent_code, attribute, factor):
     lc_dist_mat = (latent_code - latent_code.transpose(1, 0)).view(-1, 1)
 
     # compute attribute distance matrix
-    attribute = attribute.view(-1, 1).repeat(1, attribute.shape[0])
+    attribute = attribute.to(latent_code.device).view(-1, 1).repeat(1, attribute.shape[0])
     attribute_dist_mat = (attribute - attribute.transpose(1, 0)).view(-1, 1)
 
     # compute regularization loss
     loss_fn = torch.nn.L1Loss()
-    lc_tanh = torch.tanh(lc_dist_mat * factor).cpu()
+    lc_tanh = torch.tanh(lc_dist_mat * factor)
     attribute_sign = torch.sign(attribute_dist_mat)
     sign_loss = loss_fn(lc_tanh, attribute_sign.float())
 
@@ -272,12 +488,14 @@ def reg_loss_sign(latent_code, attribute, factor):
 
 class AR_VAEPatiLoss:
 
-    def __init__(self, beta, gamma, factor, reg_dim):
+    def __init__(self, beta, gamma, factor, reg_dim, tile_size=None, estimator=None):
         super(AR_VAEPatiLoss, self).__init__()
         self.beta = beta
         self.gamma = gamma
         self.factor = factor
         self.reg_dim = reg_dim
+        self.tile_size = tile_size
+        self.estimator = estimator
 
     def __call__(self, x_recon, x, z, attr, all= False):
 
@@ -297,11 +515,7 @@ class AR_VAEPatiLoss:
         beta_loss = self.beta * kld_weight * (kld_loss - c).abs()
 
         # Reg loss
-        reg_loss = 0.0
-        reg_dim_real = attr.size()[1]
-        for dim in range(reg_dim_real):
-            x_ = z['z'][:, dim]
-            reg_loss += self.reg_loss_sign(x_, attr[:,dim], self.factor)
+        reg_loss = compute_reg_loss(z['z'], attr, self.factor, self.tile_size, self.estimator)
 
         global_loss = recons_loss + beta_loss + self.gamma * reg_loss #
 
@@ -328,12 +542,12 @@ class AR_VAEPatiLoss:
         lc_dist_mat = (latent_code - latent_code.transpose(1, 0)).view(-1, 1)
 
         # compute attribute distance matrix
-        attribute = attribute.view(-1, 1).repeat(1, attribute.shape[0])
+        attribute = attribute.to(latent_code.device).view(-1, 1).repeat(1, attribute.shape[0])
         attribute_dist_mat = (attribute - attribute.transpose(1, 0)).view(-1, 1)
 
         # compute regularization loss
         loss_fn = torch.nn.L1Loss()
-        lc_tanh = torch.tanh(lc_dist_mat * factor).cpu()
+        lc_tanh = torch.tanh(lc_dist_mat * factor)
         attribute_sign = torch.sign(attribute_dist_mat)
         sign_loss = loss_fn(lc_tanh, attribute_sign.float())
 
@@ -0,0 +1,150 @@
+"""
+memory_bank.py
+
+FIFO memory bank of the latent codes and attributes of the last training steps, for the attribute regularization
+beyond the current batch
+
+"""
+import torch
+
+from .image_losses import compute_reg_loss
+
+
+def compute_cross_reg_loss(latent_code, attribute, bank_latent_code, bank_attribute, factor, nr_pairs=None):
+    """
+    Attribute regularization between the samples of a batch and the samples of a memory bank: sum over the
+    dimensions of the mean over the N x M pairs (i, m) of |tanh(factor * (z_i - z_m)) - sign(a_i - a_m)|.
+    Args:
+        latent_code: torch.Tensor, (N, D), latent codes of the regularized dimensions
+        attribute: torch.Tensor, (N, D)
+        bank_latent_code: torch.Tensor, (M, D), without gradient
+        bank_attribute: torch.Tensor, (M, D)
+        factor: parameter for scaling the loss
+        nr_pairs: int, bank samples drawn uniformly per sample of the batch (unbiased, see estimate_reg_loss),
+            None: all the N x M pairs (memory O(N * M * D))
+    Returns
+        scalar, loss
+    """
+    n, m = latent_code.shape[0], bank_latent_code.shape[0]
+    if nr_pairs is None:
+        lc_tanh = torch.tanh((latent_code[:, None] - bank_latent_code[None]) * factor)
+        attribute_sign = torch.sign(attribute[:, None] - bank_attribute[None]).to(lc_tanh.dtype)
+        return (lc_tanh - attribute_sign).abs().sum() / (n * m)
+    anchors = torch.arange(n, device=latent_code.device).repeat_interleave(nr_pairs)
+    partners = torch.randint(0, m, (n * nr_pairs,), device=latent_code.device)
+    lc_tanh = torch.tanh((latent_code[anchors] - bank_latent_code[partners]) * factor)
+    attribute_sign = torch.sign(attribute[anchors] - bank_attribute[partners]).to(lc_tanh.dtype)
+    return (lc_tanh - attribute_sign).abs().sum() / (n * nr_pairs)
+
+
+class LatentMemoryBank:
+    """
+    Ring buffer of the (detached) latent codes of the regularized dimensions and the attributes of the last
+    capacity training samples, on the device of the latent codes. reg_loss compares the current batch with itself
+    and with the bank, i.e., many more pairs per step at small batch sizes, without activations for the bank samples.
+    The bank is only used and updated when gradients are enabled: the validation passes (torch.no_grad) compute the
+    loss of the batch alone and leave the bank unchanged.
+    """
+    def __init__(self, capacity=1024, max_age=None):
+        """
+        :param capacity: int
+            number of samples kept, the oldest are overwritten first
+        :param max_age: int
+            staleness: samples pushed more than max_age steps ago are not used (the encoder has changed since),
+            None: all the samples of the bank
+        """
+        self.capacity = capacity
+        self.max_age = max_age
+        self.latent_codes, self.attributes, self.steps = None, None, None
+        self.pointer, self.size, self.step = 0, 0, 0
+
+    def __len__(self):
+        return len(self.get()[0]) if self.size > 0 else 0
+
+    def reset(self):
+        self.latent_codes, self.attributes, self.steps = None, None, None
+        self.pointer, self.size, self.step = 0, 0, 0
+
+    def _allocate(self, latent_code, attribute):
+        reg_dim = attribute.shape[1]
+        self.latent_codes = torch.zeros(self.capacity, reg_dim, device=latent_code.device)
+        self.attributes = torch.zeros(self.capacity, reg_dim, device=latent_code.device)
+        self.steps = torch.zeros(self.capacity, dtype=torch.long, device=latent_code.device)
+
+    def to(self, device):
+        if self.latent_codes is not None:
+            self.latent_codes, self.attributes = self.latent_codes.to(device), self.attributes.to(device)
+            self.steps = self.steps.to(device)
+        return self
+
+    @torch.no_grad()
+    def push(self, latent_code, attribute):
+        """
+        Adds the samples of a training step (the last capacity of them for larger batches)
+        :param latent_code: torch.Tensor, (N, D)
+        :param attribute: torch.Tensor, (N, D)
+        """
+        if self.latent_codes is None:
+            self._allocate(latent_code, attribute)
+        latent_code, attribute = latent_code[-self.capacity:], attribute[-self.capacity:]
+        indices = (self.pointer + torch.arange(len(latent_code), device=self.latent_codes.device)) % self.capacity
+        self.latent_codes[indices] = latent_code.detach().to(self.latent_codes)
+        self.attributes[indices] = attribute.detach().to(self.attributes)
+        self.steps[indices] = self.step
+        self.pointer = (self.pointer + len(latent_code)) % self.capacity
+        self.size = min(self.size + len(latent_code), self.capacity)
+        self.step += 1
+
+    def get(self):
+        """
+        :return: tuple
+            latent codes and attributes of the bank, without the samples older than max_age steps
+        """
+        if self.size == 0:
+            return None, None
+        latent_codes, attributes = self.latent_codes[:self.size], self.attributes[:self.size]
+        if self.max_age is None:
+            return latent_codes, attributes
+        fresh = self.step - self.steps[:self.size] <= self.max_age
+        return latent_codes[fresh], attributes[fresh]
+
+    def reg_loss(self, z, attr, factor, tile_size=None, estimator=None):
+        """
+        Attribute regularization of the batch and the bank: mean over the samples i of the batch of the mean pair loss
+        of i with the N samples of the batch and the M samples of the bank,
+            (N * compute_reg_loss(batch) + M * compute_cross_reg_loss(batch, bank)) / (N + M),
+        compute_reg_loss of the batch for an empty bank. The batch is pushed to the bank afterwards.
+        :param tile_size: int
+            see compute_reg_loss (pairs of the batch)
+        :param estimator: dict
+            see compute_reg_loss (pairs of the batch). With mode sampled, the pairs with the bank are sampled as well
+            (nr_pairs per sample of the batch)
+        """
+        loss = compute_reg_loss(z, attr, factor, tile_size, estimator)
+        if not torch.is_grad_enabled():
+            return loss
+        # e.g., bank of a checkpoint loaded on another device
+        self.to(z.device)
+        n, reg_dim = attr.size()
+        latent_code, attribute = z[:, :reg_dim], attr.to(z.device)
+        bank_latent_code, bank_attribute = self.get()
+        if bank_latent_code is not None and len(bank_latent_code) > 0:
+            m = len(bank_latent_code)
+            nr_pairs = estimator['nr_pairs'] if estimator is not None and estimator.get('mode') == 'sampled' \
+                else None
+            cross_loss = compute_cross_reg_loss(latent_code, attribute, bank_latent_code.to(latent_code.dtype),
+                                                bank_attribute, factor, nr_pairs)
+            loss = (n * loss + m * cross_loss) / (n + m)
+        self.push(latent_code, attribute)
+        return loss
+
+    def state_dict(self):
+        if self.latent_codes is None:
+            return {}
+        return {'latent_codes': self.latent_codes, 'attributes': self.attributes, 'steps': self.steps,
+                'pointer': self.pointer, 'size': self.size, 'step': self.step}
+
+    def load_state_dict(self, state_dict):
+        self.latent_codes, self.attributes = state_dict['latent_codes'], state_dict['attributes']
+        self.steps = state_dict['steps']
+        self.pointer, self.size, self.step = state_dict['pointer'], state_dict['size'], state_dict['step']
@@ -7,6 +7,7 @@ logging.getLogger("matplotlib").setLevel(logging.WARNING)
 import wandb
 import torch
 import json
+import copy
 from torch.nn import L1Loss, MSELoss
 #
 from skimage.metrics import structural_similarity as ssim
@@ -27,8 +28,15 @@ class PDownstreamEvaluator(DownstreamEvaluator):
     Downstream Tasks
         - run tasks training_end, e.g. anomaly detection, reconstruction fidelity, disease classification, etc..
     """
-    def __init__(self, name, model, device, test_data_dict, checkpoint_path, mlp_config=None):
+    def __init__(self, name, model, device, test_data_dict, checkpoint_path, mlp_config=None, optimize_inference=True):
+        """
+        :param optimize_inference: bool
+            run the tasks on a copy of the model prepared by model.optimize_for_inference() (BatchNorm folding,
+            channels_last), if the model has this method
+        """
         super(PDownstreamEvaluator, self).__init__(name, model, device, test_data_dict, checkpoint_path)
+        self.optimize_inference = optimize_inference
+        self.inference_model = self.model
 
         self.criterion_rec = L1Loss().to(self.device)
         self.attributes_dict = test_data_dict.dataset.dataset.attributes_dict
@@ -65,6 +73,7 @@ class PDownstreamEvaluator(DownstreamEvaluator):
         """
         self.model.load_state_dict(global_model)
         self.model.eval()
+        self.inference_model = self.get_inference_model()
 
         latent_codes, full_attributes, predictions, labels, rec_error = self.compute_latent_representations()
         rl_metrics = compute_rl_metrics(self.checkpoint_path, latent_codes.detach().cpu().numpy(), full_attributes, self.attributes_idx)
@@ -103,9 +112,18 @@ class PDownstreamEvaluator(DownstreamEvaluator):
         if self.mlp_model is not None:
             self.prediction_task()
 
+    def get_inference_model(self):
+        """
+        Model used by the tasks (no gradients w.r.t. the model): an optimized copy of the evaluated model, which keeps
+        its original modules and state_dict
+        """
+        if self.optimize_inference and hasattr(self.model, 'optimize_for_inference'):
+            return copy.deepcopy(self.model).optimize_for_inference()
+        return self.model
+
     def show_latent_space(self, latent_codes, dim_list = [0,1,2], dim_plot_2d = [0,1]):
 
-        fig = plot_latent_reconstructions(self.model, self.test_data_dict, self.device, num_points=8)
+        fig = plot_latent_reconstructions(self.inference_model, self.test_data_dict, self.device, num_points=8)
         buf = io.BytesIO()
         plt.savefig(buf, format='png')
         buf.seek(0)
@@ -114,7 +132,7 @@ class PDownstreamEvaluator(DownstreamEvaluator):
             wandb.Image(Image.open(buf), caption=f'Test_reconstruction')]})
 
         range_value = 13.0
-        fig = plot_latent_interpolations(self.model,latent_codes[:1,:], dim_list=dim_list,
+        fig = plot_latent_interpolations(self.inference_model,latent_codes[:1,:], dim_list=dim_list,
                                          num_points=4, range_value=range_value)
 
         buf = io.BytesIO()
@@ -157,7 +175,7 @@ class PDownstreamEvaluator(DownstreamEvaluator):
                 x = data.view(nr_slices, c, width, height)
 
                 x = x.to(self.device)
-                rec, f_result = self.model(x)
+                rec, f_result = self.inference_model(x)
 
                 MSE = self.criterion_MSE(rec,x)
                 save_MSE = self.save_MSE(rec,x)
@@ -241,7 +259,7 @@ class PDownstreamEvaluator(DownstreamEvaluator):
 
         index = 1
         labels_name = list(self.dict_classes.keys())
-        attribution = AttributionLatentY(self.test_data_dict, labels_name, self.model,
+        attribution = AttributionLatentY(self.test_data_dict, labels_name, self.inference_model,
                                          self.mlp_model, index, self.results_folder, self.device)
 
         fig_global, fig_local = attribution.visualization()
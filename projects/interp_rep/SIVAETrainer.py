@@ -1,6 +1,7 @@
+import copy
 import pandas as pd
 import numpy as np
-from core.Trainer import Trainer
+from core.Trainer import Trainer, RunningStats
 from torch.optim.adam import Adam
 from torch.optim.lr_scheduler import MultiStepLR
 
@@ -11,11 +12,13 @@ import logging
 from model_zoo.soft_intro_vae_daniel import *
 import matplotlib.pyplot as plt
 
-from optim.losses.image_losses import compute_reg_loss
+from optim.losses.image_losses import compute_reg_loss, compute_reg_loss_distributed, gather_reg_inputs
+from optim.losses.memory_bank import LatentMemoryBank
 from optim.metrics.rl_metrics import *
 import io
 from PIL import Image
 from dl_utils.vizu_utils import plot_training_samples
+from dl_utils.dist_utils import all_reduce_sum, broadcast_module
 import yaml
 import torch
 from torchmetrics.functional import confusion_matrix, accuracy
@@ -46,9 +49,29 @@ class PTrainer(Trainer):
 
         self.reg_loss = training_params['reg_loss'] if 'reg_loss' in training_params.keys() else 0
         self.factor = training_params['factor'] if 'factor' in training_params.keys() else 10.0
+        # distributed training: attribute regularization over the pairs of the batches of all the ranks instead of
+        # the pairs of the local batch only
+        self.gather_reg_loss = training_params['gather_reg_loss'] if 'gather_reg_loss' in training_params.keys() \
+            else True
+        # rows per block of the pairs of the attribute regularization (memory O(N * reg_tile_size) instead of
+        # O(N^2) for large or gathered batches), None: all the pairs at once
+        self.reg_tile_size = training_params['reg_tile_size'] if 'reg_tile_size' in training_params.keys() else None
+        # approximation of the attribute regularization from O(N) pairs for very large batches, e.g.,
+        # reg_estimator: {mode: sampled, nr_pairs: 32}, see estimate_reg_loss. None: exact
+        self.reg_estimator = training_params['reg_estimator'] if 'reg_estimator' in training_params.keys() else None
+        # attribute regularization against the latent codes of the last training steps as well, e.g.,
+        # reg_memory_bank: {capacity: 1024, max_age: 20}, see LatentMemoryBank. None: pairs of the batch only
+        bank_params = training_params['reg_memory_bank'] if 'reg_memory_bank' in training_params.keys() else None
+        self.reg_memory_bank = LatentMemoryBank(**bank_params) if bank_params is not None else None
         self.loss_type = training_params['loss_type'] if 'loss_type' in training_params.keys() else 'mse'
         self.annealing = training_params['annealing'] if 'annealing' in training_params.keys() else 1
         self.annealing_mse = training_params['annealing_mse'] if 'annealing_mse' in training_params.keys() else 1
+        # one encoder / decoder forward over the concatenated rec and fake batches instead of one each. Changes the
+        # batch-norm statistics of these passes, hence off by default.
+        self.concat_forward = training_params['concat_forward'] if 'concat_forward' in training_params.keys() \
+            else False
+        self.scaler_e = self.get_grad_scaler()
+        self.scaler_d = self.get_grad_scaler()
 
         mlp_params = training_params['mlp'] if 'mlp' in training_params.keys() else None
         if mlp_params is not None:
@@ -83,9 +106,10 @@ class PTrainer(Trainer):
         """
         if model_state is not None:
             self.model.load_state_dict(model_state)  # load weights
+        # distributed training: all the ranks start from the weights of rank 0
+        broadcast_module(self.model)
 
         epoch_losses = []
-        self.early_stop = False
 
         for epoch in range(self.training_params['nr_epochs']):
             if start_epoch > epoch:
@@ -94,167 +118,68 @@ class PTrainer(Trainer):
                 logging.info("[Trainer::test]: ################ Finished training (early stopping) ################")
                 break
             start_time = time()
+            self.set_epoch(epoch)
 
-            diff_kls, batch_kls_real, batch_kls_fake, batch_kls_rec, batch_rec_errs, batch_exp_elbo_f,\
-            batch_exp_elbo_r, count_images = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0
+            # epoch sums accumulated on the device, read back once at the end of the epoch
+            stats = RunningStats(['DKLS', 'REAL', 'FAKE', 'REC', 'REC_ERRS', 'EXP_F', 'EXP_R', 'REG'], self.device,
+                                 self.sync_every)
+            count_images = 0
 
-            batch_loss_reg, batch_loss_mlp = 0.0, 0.0
-
-            for data in self.train_ds:
+            for data, micro_batch_sizes in self.profiler.iterate(self.get_logical_batches(self.train_ds)):
                 # Input
-                images = data[0].to(self.device)
-                transformed_images = self.transform(images) if self.transform is not None else images
+                with self.profiler.phase('h2d'):
+                    images = data[0].to(self.device)
+                    attributes = data[2].to(self.device)
+                    transformed_images = self.transform(images) if self.transform is not None else images
 
                 b, c, w, h = images.shape
 
                 count_images += b
-                noise_batch = torch.randn(size=(b, self.model.zdim)).to(self.device)
-                #noise_batch = torch.randn(size=(b, 128)).to(self.device)
+                self.epoch_position += b
                 real_batch = transformed_images.to(self.device)
 
-                # =========== Update E ================
-                for param in self.model.encoder.parameters():
-                    param.requires_grad = True
-                for param in self.model.decoder.parameters():
-                    param.requires_grad = False
-
-                fake = self.model.sample(noise_batch)
-
-                real_mu, real_logvar = self.model.encode(real_batch)
-                z = reparameterize(real_mu, real_logvar)
-                rec = self.model.decoder(z)
-
-                #annealing = epoch / self.training_params['nr_epochs'] if epoch > 0 else 0 # annealing applied only if loss_type = pl
-
-                #loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type= 'mse', reduction="mean")
-                if self.loss_type == 'pl':
-                    loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type='mse', reduction="mean")
-                    pl_error = self.criterion_PL(real_batch, rec)
-                    loss_rec = self.annealing_mse * loss_rec + self.annealing * pl_error
+                if len(micro_batch_sizes) > 1:
+                    step = self._train_step_accumulated(real_batch, attributes, micro_batch_sizes)
                 else:
-                    loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type=self.loss_type, reduction="mean")
-
-                lossE_real_kl = calc_kl(real_logvar, real_mu, reduce="mean")
-
-                rec_rec, z_dict = self.model(rec.detach(), deterministic=False)
-                rec_mu, rec_logvar, z_rec = z_dict['z_mu'], z_dict['z_logvar'], z_dict['z']
-                rec_fake, z_dict_fake = self.model(fake.detach(), deterministic=False)
-                fake_mu, fake_logvar, z_fake = z_dict_fake['z_mu'], z_dict_fake['z_logvar'], z_dict_fake['z']
-
-                kl_rec = calc_kl(rec_logvar, rec_mu, reduce="none")
-                kl_fake = calc_kl(fake_logvar, fake_mu, reduce="none")
-
-
-                loss_rec_rec_e = calc_reconstruction_loss(rec, rec_rec, loss_type= self.loss_type, reduction="none")
-                while len(loss_rec_rec_e.shape) > 1:
-                    loss_rec_rec_e = loss_rec_rec_e.sum(-1)
-
-                # PL loss
-                if self.loss_type == 'pl':
-                    pl_error = self.criterion_PL(rec, rec_rec)
-                    loss_rec_rec_e = self.annealing_mse * loss_rec_rec_e + self.annealing * pl_error
-
-                loss_rec_fake_e = calc_reconstruction_loss(fake, rec_fake, loss_type= self.loss_type, reduction="none")
-                while len(loss_rec_fake_e.shape) > 1:
-                    loss_rec_fake_e = loss_rec_fake_e.sum(-1)
-                # PL loss
-                if self.loss_type == 'pl':
-                    pl_error = self.criterion_PL(fake, rec_fake)
-                    loss_rec_fake_e = self.annealing_mse * loss_rec_fake_e + self.annealing * pl_error
-
-                expelbo_rec = (-2 * self.scale * (self.beta_rec * loss_rec_rec_e + self.beta_neg * kl_rec)).exp().mean()
-                expelbo_fake = (-2 * self.scale * (self.beta_rec * loss_rec_fake_e + self.beta_neg * kl_fake)).exp().mean()
-
-                lossE_fake = 0.25 * (expelbo_rec + expelbo_fake)
-                lossE_real = self.scale * (self.beta_rec * loss_rec + self.beta_kl * lossE_real_kl)
-                loss_reg = self.reg_loss * compute_reg_loss(z, data[2], self.factor)
-
-                lossE = lossE_real + lossE_fake + loss_reg
-
-                self.optimizer_e.zero_grad()
-                lossE.backward() # propagate all of the losses in the encoder
-                self.optimizer_e.step()
-
-                # ========= Update D ==================
-
-                for param in self.model.encoder.parameters():
-                    param.requires_grad = False
-                for param in self.model.decoder.parameters():
-                    param.requires_grad = True
-
-                fake = self.model.sample(noise_batch)
-                rec = self.model.decoder(z.detach())
-
-                loss_rec = calc_reconstruction_loss(real_batch, rec,  loss_type= self.loss_type, reduction="mean")
-                if self.loss_type == 'pl':
-                    pl_error = self.criterion_PL(real_batch, rec)
-                    loss_rec = self.annealing_mse * loss_rec + self.annealing * pl_error
-
-                rec_mu, rec_logvar = self.model.encode(rec)
-                z_rec = reparameterize(rec_mu, rec_logvar)
-
-                fake_mu, fake_logvar = self.model.encode(fake)
-                z_fake = reparameterize(fake_mu, fake_logvar)
-
-                rec_rec = self.model.decode(z_rec.detach())
-                rec_fake = self.model.decode(z_fake.detach())
-
-                loss_rec_rec = calc_reconstruction_loss(rec.detach(), rec_rec,  loss_type= self.loss_type, reduction="mean")
-                if self.loss_type == 'pl':
-                    pl_error = self.criterion_PL(rec, rec_rec)
-                    loss_rec_rec = self.annealing_mse * loss_rec_rec + self.annealing * pl_error
-
-                loss_fake_rec = calc_reconstruction_loss(fake.detach(), rec_fake,  loss_type= self.loss_type, reduction="mean")
-                if self.loss_type == 'pl':
-                    pl_error = self.criterion_PL(fake, rec_fake)
-                    loss_fake_rec = self.annealing_mse * loss_fake_rec + self.annealing * pl_error
-
-                lossD_rec_kl = calc_kl(rec_logvar, rec_mu, reduce="mean")
-                lossD_fake_kl = calc_kl(fake_logvar, fake_mu, reduce="mean")
-
-                lossD = self.scale * (loss_rec * self.beta_rec + (
-                        lossD_rec_kl + lossD_fake_kl) * 0.5 * self.beta_kl + self.gamma_r * 0.5 * self.beta_rec * (
-                                         loss_rec_rec + loss_fake_rec))
-
-                self.optimizer_d.zero_grad()
-                lossD.backward()
-                self.optimizer_d.step()
-                if torch.isnan(lossD) or torch.isnan(lossE):
-                    print('is non for D')
-                    raise SystemError
-                if torch.isnan(lossE):
-                    print('is non for E')
+                    # perceptual features of the images used by several losses of the step (rec, fake) computed once
+                    with self.criterion_PL.cache():
+                        step = self._train_step(real_batch, attributes)
+                rec = step['rec']
+
+                stats.update({'DKLS': -step['lossE_real_kl'] + step['lossD_fake_kl'] * images.shape[0],
+                              'REAL': step['lossE_real_kl'] * images.shape[0],
+                              'FAKE': step['lossD_fake_kl'] * images.shape[0],
+                              'REC': step['lossD_rec_kl'] * images.shape[0],
+                              'REC_ERRS': step['loss_rec'] * images.shape[0],
+                              'EXP_F': step['expelbo_fake'] * images.shape[0],
+                              'EXP_R': step['expelbo_rec'] * images.shape[0],
+                              'REG': step['loss_reg'] * images.shape[0]},
+                             check_nan=(step['lossE'], step['lossD']))
+                if stats.is_nan():
+                    print('is nan for E or D')
                     raise SystemError
 
-
-                diff_kls += -lossE_real_kl.data.cpu().item() + lossD_fake_kl.data.cpu().item() * images.shape[0]
-                batch_kls_real += lossE_real_kl.data.cpu().item() * images.shape[0]
-                batch_kls_fake += lossD_fake_kl.cpu().item() * images.shape[0]
-                batch_kls_rec += lossD_rec_kl.data.cpu().item() * images.shape[0]
-                batch_rec_errs += loss_rec.data.cpu().item() * images.shape[0]
-
-                batch_exp_elbo_f += expelbo_fake.data.cpu() * images.shape[0]
-                batch_exp_elbo_r += expelbo_rec.data.cpu() * images.shape[0]
-                batch_loss_reg += loss_reg * images.shape[0]
-
-                #if self.mlp_model is not None:
-                #    batch_loss_mlp += loss_mlp * images.shape[0]
-
-            epoch_loss_d_kls = diff_kls / count_images if count_images > 0 else diff_kls
-            epoch_loss_kls_real = batch_kls_real / count_images if count_images > 0 else batch_kls_real
-            epoch_loss_kls_fake = batch_kls_fake / count_images if count_images > 0 else batch_kls_fake
-            epoch_loss_kls_rec = batch_kls_rec / count_images if count_images > 0 else batch_kls_rec
-            epoch_loss_rec_errs = batch_rec_errs / count_images if count_images > 0 else batch_rec_errs
-            epoch_loss_exp_f = batch_exp_elbo_f / count_images if count_images > 0 else batch_exp_elbo_f
-            epoch_loss_exp_r = batch_exp_elbo_r / count_images if count_images > 0 else batch_exp_elbo_r
-            epoch_loss_reg = batch_loss_reg / count_images if count_images > 0 else batch_loss_reg
-            #epoch_loss_mlp = batch_loss_mlp / count_images if count_images > 0 else batch_loss_mlp
+            sums, nan = stats.result()
+            count_images = int(all_reduce_sum(count_images))
+            if nan:
+                print('is nan for E or D')
+                raise SystemError
+            epoch_stats = {key: value / count_images if count_images > 0 else value for key, value in sums.items()}
+            epoch_loss_d_kls = epoch_stats['DKLS']
+            epoch_loss_kls_real = epoch_stats['REAL']
+            epoch_loss_kls_fake = epoch_stats['FAKE']
+            epoch_loss_kls_rec = epoch_stats['REC']
+            epoch_loss_rec_errs = epoch_stats['REC_ERRS']
+            epoch_loss_exp_f = epoch_stats['EXP_F']
+            epoch_loss_exp_r = epoch_stats['EXP_R']
+            epoch_loss_reg = epoch_stats['REG']
 
             epoch_losses.append(epoch_loss_rec_errs)
 
             end_time = time()
             print('Epoch: {} \tTraining Loss: {:.6f} , computed in {} seconds for {} samples'.format(
                 epoch, epoch_loss_rec_errs, end_time - start_time, count_images))
+            self.profiler.end_epoch(epoch, count_images)
             wandb.log({"Train/Loss_DKLS": epoch_loss_d_kls, '_step_': epoch})
             wandb.log({"Train/Loss_REAL": epoch_loss_kls_real, '_step_': epoch})
             wandb.log({"Train/Loss_FAKE": epoch_loss_kls_fake, '_step_': epoch})
@@ -265,9 +190,8 @@ class PTrainer(Trainer):
             wandb.log({"Train/Loss_REG": epoch_loss_reg, '_step_': epoch})
             #wandb.log({"Train/Loss_MLP": epoch_loss_mlp, '_step_': epoch})
 
-            # Save latest model
-            torch.save({'model_weights': self.model.state_dict(), 'optimizer_weights': self.optimizer.state_dict()
-                           , 'epoch': epoch}, self.client_path + '/latest_model.pt')
+            # batch-norm statistics of rank 0 on all the ranks (distributed training), as DistributedDataParallel
+            broadcast_module(self.model, buffers_only=True)
 
             #if self.mlp_model is not None:
             #    torch.save(
@@ -285,9 +209,303 @@ class PTrainer(Trainer):
 
             self.test(self.model.state_dict(), self.val_ds, 'Val', [self.optimizer_e.state_dict(),
                                                                     self.optimizer_d.state_dict()], epoch)
+            # Save latest model, with the state of the validation (early stopping, schedulers)
+            self.save_training_state(epoch)
 
+        self.checkpoints.wait()
         return self.best_weights, self.best_opt_weights
 
+    def get_stateful(self):
+        """
+        Encoder and decoder optimizers, schedulers and loss scalers (the optimizer of Trainer is not used), and the
+        memory bank of the attribute regularization
+        """
+        stateful = {'optimizer_e': self.optimizer_e, 'optimizer_d': self.optimizer_d,
+                    'e_scheduler': self.e_scheduler, 'd_scheduler': self.d_scheduler, 'scaler_e': self.scaler_e,
+                    'scaler_d': self.scaler_d, 'early_stopping': self.early_stopping}
+        if self.reg_memory_bank is not None:
+            stateful['reg_memory_bank'] = self.reg_memory_bank
+        return stateful
+
+    @staticmethod
+    def get_params(optimizer):
+        return [param for group in optimizer.param_groups for param in group['params']]
+
+    def _train_step(self, real_batch, attributes):
+        """
+        One encoder and one decoder update of Soft-Intro VAE.
+        The decoder outputs fake = D(noise) and rec = D(z) do not depend on the encoder update, so they are
+        computed once with their graph and shared by both phases (as is loss_rec, which has the same weight in
+        lossE and lossD). Each backward pass only accumulates into the parameters of its optimizer (inputs=),
+        instead of switching requires_grad on and off. The encoder passes of the decoder phase run after the
+        encoder step, as in the original two-phase update.
+        :return: dict
+            losses of the step and the reconstruction of real_batch
+        """
+        b = real_batch.shape[0]
+        noise_batch = torch.randn(size=(b, self.model.zdim)).to(self.device)
+
+        self.optimizer_e.zero_grad()
+        self.optimizer_d.zero_grad()
+        # =========== Update E ================
+        with self.profiler.group('E'):
+            with self.profiler.phase('forward'), self.autocast():
+                fake = self.model.sample(noise_batch)
+                real_mu, real_logvar = self.model.encode(real_batch)
+                z = reparameterize(real_mu, real_logvar)
+                rec = self.model.decoder(z)
+            # the encoder passes over rec and fake are interleaved with the losses: they count as loss
+            with self.profiler.phase('loss'):
+                stats, loss_rec = self._encoder_losses(real_batch, fake, rec, z, real_mu, real_logvar, attributes)
+            with self.profiler.phase('optimizer'):
+                self.sync_gradients(self.optimizer_e)
+                self.scaler_e.step(self.optimizer_e)
+                self.scaler_e.update()
+
+        # ========= Update D ==================
+        with self.profiler.group('D'):
+            with self.profiler.phase('loss'):
+                lossD, stats_d = self._decoder_losses(rec, fake, loss_rec)
+
+            # loss_rec reaches the encoder through z, whose graph is not traversed for the decoder parameters
+            with self.profiler.phase('backward'):
+                self.scaler_d.scale(lossD).backward(inputs=self.get_params(self.optimizer_d))
+            with self.profiler.phase('optimizer'):
+                self.sync_gradients(self.optimizer_d)
+                self.scaler_d.step(self.optimizer_d)
+                self.scaler_d.update()
+
+        stats.update(stats_d)
+        stats.update({'loss_rec': loss_rec.detach(), 'rec': rec.detach().float()})
+        return stats
+
+    def _train_step_accumulated(self, real_batch, attributes, micro_batch_sizes):
+        """
+        _train_step on a logical batch, with the gradients of both phases accumulated over its micro-batches.
+        The losses are means over the samples and are weighted by the size of each micro-batch, except the attribute
+        regularization, which depends on all the pairs of the logical batch: it is computed on the latent codes of a
+        first encoder pass without gradients and enters each micro-batch through its gradient w.r.t. z
+        (get_reg_grads). The random draws of the reparameterization are replayed, so that z is the same in both
+        passes. The decoder outputs are recomputed in the decoder phase instead of keeping their graphs.
+        The step is equivalent to _train_step on the logical batch, up to the batch statistics of the batch-norm
+        layers (computed per micro-batch) and the random draws.
+        :return: dict
+            losses of the step (means over the logical batch) and the reconstruction of real_batch
+        """
+        b = real_batch.shape[0]
+        noise_batch = torch.randn(size=(b, self.model.zdim)).to(self.device)
+        micro_batches = list(zip(real_batch.split(micro_batch_sizes), attributes.split(micro_batch_sizes),
+                                 noise_batch.split(micro_batch_sizes)))
+
+        rng_states, latents = [], []
+        with self.profiler.phase('reg_loss'):
+            with torch.no_grad(), self.autocast(), self.preserve_buffers(self.model):
+                for real, _, _ in micro_batches:
+                    rng_states.append(self.get_rng_state())
+                    latents.append(reparameterize(*self.model.encode(real)))
+            loss_reg, reg_grads = self.get_reg_grads(
+                latents, lambda z: self.reg_loss * self.compute_reg_loss(z, attributes))
+
+        self.optimizer_e.zero_grad()
+        self.optimizer_d.zero_grad()
+        stats = {}
+        # =========== Update E ================
+        with self.profiler.group('E'):
+            for (real, attr, noise), reg_grad, rng_state in zip(micro_batches, reg_grads, rng_states):
+                self.set_rng_state(rng_state)
+                with self.profiler.phase('forward'), self.autocast():
+                    fake = self.model.sample(noise)
+                    real_mu, real_logvar = self.model.encode(real)
+                    z = reparameterize(real_mu, real_logvar)
+                    rec = self.model.decoder(z)
+                # perceptual features cached per micro-batch only, whose graph is freed after its backward
+                with self.profiler.phase('loss'), self.criterion_PL.cache():
+                    micro_stats, _ = self._encoder_losses(real, fake, rec, z, real_mu, real_logvar, attr,
+                                                          weight=len(real) / b, reg_grad=reg_grad,
+                                                          retain_graph=False)
+                self.add_weighted(stats, micro_stats, len(real) / b)
+            with self.profiler.phase('optimizer'):
+                self.sync_gradients(self.optimizer_e)
+                self.scaler_e.step(self.optimizer_e)
+                self.scaler_e.update()
+
+        # ========= Update D ==================
+        recs = []
+        with self.profiler.group('D'):
+            for (real, _, noise), z in zip(micro_batches, latents):
+                with self.profiler.phase('forward'), self.autocast():
+                    fake = self.model.sample(noise)
+                    rec = self.model.decoder(z)
+                    loss_rec = self._reconstruction_loss(real, rec)
+                with self.profiler.phase('loss'):
+                    lossD, micro_stats = self._decoder_losses(rec, fake, loss_rec.float())
+                with self.profiler.phase('backward'):
+                    self.scaler_d.scale(len(real) / b * lossD).backward(inputs=self.get_params(self.optimizer_d))
+                micro_stats['loss_rec'] = loss_rec.detach().float()
+                self.add_weighted(stats, micro_stats, len(real) / b)
+                recs.append(rec.detach().float())
+            with self.profiler.phase('optimizer'):
+                self.sync_gradients(self.optimizer_d)
+                self.scaler_d.step(self.optimizer_d)
+                self.scaler_d.update()
+
+        stats.update({'lossE': stats['lossE'] + loss_reg, 'loss_reg': loss_reg, 'rec': torch.cat(recs)})
+        return stats
+
+    @staticmethod
+    def add_weighted(stats, micro_stats, weight):
+        for key, value in micro_stats.items():
+            stats[key] = stats[key] + weight * value if key in stats.keys() else weight * value
+
+    def compute_reg_loss(self, z, attributes):
+        """
+        Attribute regularization of the latent codes z, over the batches of all the ranks in distributed training
+        (gather_reg_loss), and against the memory bank (reg_memory_bank)
+        """
+        if self.reg_memory_bank is not None:
+            if self.gather_reg_loss:
+                z, attributes = gather_reg_inputs(z, attributes)
+            return self.reg_memory_bank.reg_loss(z, attributes, self.factor, self.reg_tile_size, self.reg_estimator)
+        if self.gather_reg_loss:
+            return compute_reg_loss_distributed(z, attributes, self.factor, self.reg_tile_size,
+                                                self.reg_estimator)
+        return compute_reg_loss(z, attributes, self.factor, self.reg_tile_size, self.reg_estimator)
+
+    def _reconstruction_loss(self, real_batch, rec):
+        #loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type= 'mse', reduction="mean")
+        if self.loss_type == 'pl':
+            loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type='mse', reduction="mean")
+            pl_error = self.criterion_PL(rec, real_batch)
+            loss_rec = self.annealing_mse * loss_rec + self.annealing * pl_error
+        else:
+            loss_rec = calc_reconstruction_loss(real_batch, rec, loss_type=self.loss_type, reduction="mean")
+        return loss_rec
+
+    def _decoder_losses(self, rec, fake, loss_rec):
+        """
+        Decoder loss of Soft-Intro VAE, from encoder passes over rec and fake (run after the encoder step)
+        :param loss_rec: torch.Tensor
+            reconstruction loss of rec (float32)
+        :return: tuple
+            lossD (float32, with its graph), dict of detached losses
+        """
+        b = rec.shape[0]
+        with self.autocast():
+            if self.concat_forward:
+                mu, logvar = self.model.encode(torch.cat([rec, fake], 0))
+                z_both = reparameterize(mu, logvar)
+                rec_rec, rec_fake = self.model.decode(z_both.detach()).split(b)
+                (rec_mu, fake_mu), (rec_logvar, fake_logvar) = mu.split(b), logvar.split(b)
+            else:
+                rec_mu, rec_logvar = self.model.encode(rec)
+                z_rec = reparameterize(rec_mu, rec_logvar)
+
+                fake_mu, fake_logvar = self.model.encode(fake)
+                z_fake = reparameterize(fake_mu, fake_logvar)
+
+                rec_rec = self.model.decode(z_rec.detach())
+                rec_fake = self.model.decode(z_fake.detach())
+
+            loss_rec_rec = calc_reconstruction_loss(rec.detach(), rec_rec,  loss_type= self.loss_type, reduction="mean")
+            if self.loss_type == 'pl':
+                pl_error = self.criterion_PL(rec_rec, rec)
+                loss_rec_rec = self.annealing_mse * loss_rec_rec + self.annealing * pl_error
+
+            loss_fake_rec = calc_reconstruction_loss(fake.detach(), rec_fake,  loss_type= self.loss_type, reduction="mean")
+            if self.loss_type == 'pl':
+                pl_error = self.criterion_PL(rec_fake, fake)
+                loss_fake_rec = self.annealing_mse * loss_fake_rec + self.annealing * pl_error
+
+        with self.autocast(enabled=False):
+            lossD_rec_kl = calc_kl(rec_logvar.float(), rec_mu.float(), reduce="mean")
+            lossD_fake_kl = calc_kl(fake_logvar.float(), fake_mu.float(), reduce="mean")
+
+            lossD = self.scale * (loss_rec * self.beta_rec + (
+                    lossD_rec_kl + lossD_fake_kl) * 0.5 * self.beta_kl + self.gamma_r * 0.5 * self.beta_rec * (
+                                     loss_rec_rec.float() + loss_fake_rec.float()))
+
+        return lossD, {'lossD': lossD.detach(), 'lossD_fake_kl': lossD_fake_kl.detach(),
+                       'lossD_rec_kl': lossD_rec_kl.detach()}
+
+    def _encoder_losses(self, real_batch, fake, rec, z, real_mu, real_logvar, attributes, weight=1.0, reg_grad=None,
+                        retain_graph=True):
+        """
+        Encoder loss of Soft-Intro VAE, back-propagated into the encoder parameters only. The graph is kept for
+        the decoder update, the passes that are only needed by the encoder are freed when returning.
+        The KL divergences and the exponentials of the ELBOs are computed in float32 under amp.
+        :param weight: float
+            weight of the loss in the gradient (micro-batch of a logical batch, see _train_step_accumulated)
+        :param reg_grad: torch.Tensor
+            gradient of the attribute regularization of the logical batch w.r.t. z, replaces the regularization of
+            the batch (which is then not included in lossE)
+        :param retain_graph: bool
+            keep the graph of rec and fake for the decoder update
+        :return: tuple
+            dict of detached losses, loss_rec (float32, with its graph)
+        """
+        b = real_batch.shape[0]
+        with self.autocast():
+            loss_rec = self._reconstruction_loss(real_batch, rec)
+
+            if self.concat_forward:
+                rec_both, z_dict = self.model(torch.cat([rec.detach(), fake.detach()], 0), deterministic=False)
+                rec_rec, rec_fake = rec_both.split(b)
+                rec_mu, fake_mu = z_dict['z_mu'].split(b)
+                rec_logvar, fake_logvar = z_dict['z_logvar'].split(b)
+            else:
+                rec_rec, z_dict = self.model(rec.detach(), deterministic=False)
+                rec_mu, rec_logvar = z_dict['z_mu'], z_dict['z_logvar']
+                rec_fake, z_dict_fake = self.model(fake.detach(), deterministic=False)
+                fake_mu, fake_logvar = z_dict_fake['z_mu'], z_dict_fake['z_logvar']
+
+            loss_rec_rec_e = calc_reconstruction_loss(rec, rec_rec, loss_type= self.loss_type, reduction="none")
+            while len(loss_rec_rec_e.shape) > 1:
+                loss_rec_rec_e = loss_rec_rec_e.sum(-1)
+
+            # PL loss
+            if self.loss_type == 'pl':
+                pl_error = self.criterion_PL(rec_rec, rec)
+                loss_rec_rec_e = self.annealing_mse * loss_rec_rec_e + self.annealing * pl_error
+
+            loss_rec_fake_e = calc_reconstruction_loss(fake.detach(), rec_fake, loss_type= self.loss_type,
+                                                       reduction="none")
+            while len(loss_rec_fake_e.shape) > 1:
+                loss_rec_fake_e = loss_rec_fake_e.sum(-1)
+            # PL loss
+            if self.loss_type == 'pl':
+                pl_error = self.criterion_PL(rec_fake, fake.detach())
+                loss_rec_fake_e = self.annealing_mse * loss_rec_fake_e + self.annealing * pl_error
+
+        with self.autocast(enabled=False):
+            loss_rec = loss_rec.float()
+            lossE_real_kl = calc_kl(real_logvar.float(), real_mu.float(), reduce="mean")
+            kl_rec = calc_kl(rec_logvar.float(), rec_mu.float(), reduce="none")
+            kl_fake = calc_kl(fake_logvar.float(), fake_mu.float(), reduce="none")
+
+            expelbo_rec = (-2 * self.scale * (self.beta_rec * loss_rec_rec_e.float() + self.beta_neg * kl_rec)).exp().mean()
+            expelbo_fake = (-2 * self.scale * (self.beta_rec * loss_rec_fake_e.float() + self.beta_neg * kl_fake)).exp().mean()
+
+            lossE_fake = 0.25 * (expelbo_rec + expelbo_fake)
+            lossE_real = self.scale * (self.beta_rec * loss_rec + self.beta_kl * lossE_real_kl)
+            if reg_grad is None:
+                loss_reg = self.reg_loss * self.compute_reg_loss(z.float(), attributes)
+                lossE = lossE_real + lossE_fake + loss_reg
+                loss_backward = lossE
+            else:
+                loss_reg = 0.0
+                lossE = lossE_real + lossE_fake
+                loss_backward = weight * lossE + (z.float() * reg_grad).sum()
+
+        # propagate all of the losses in the encoder
+        with self.profiler.phase('backward'):
+            self.scaler_e.scale(loss_backward).backward(inputs=self.get_params(self.optimizer_e),
+                                                        retain_graph=retain_graph)
+
+        stats = {'lossE': lossE.detach(), 'lossE_real_kl': lossE_real_kl.detach(),
+                 'expelbo_rec': expelbo_rec.detach(), 'expelbo_fake': expelbo_fake.detach(),
+                 'loss_reg': loss_reg.detach() if torch.is_tensor(loss_reg) else loss_reg}
+        return stats, loss_rec
+
     def test(self, model_weights, test_data, task='Val', opt_weights=None, epoch=0):
         """
         :param model_weights: weights of the global model
@@ -328,13 +546,14 @@ class PTrainer(Trainer):
 
                 # Forward pass
                 x_, z_rec = self.test_model(x)
-                loss_rec = calc_reconstruction_loss(x_, x, loss_type=self.loss_type)
-                if self.loss_type == 'pl':
-                    pl_error = self.criterion_PL(x_, x)
-                    loss_rec = self.annealing_mse * loss_rec + self.annealing * pl_error
+                with self.criterion_PL.cache():
+                    loss_rec = calc_reconstruction_loss(x_, x, loss_type=self.loss_type)
+                    if self.loss_type == 'pl':
+                        pl_error = self.criterion_PL(x_, x)
+                        loss_rec = self.annealing_mse * loss_rec + self.annealing * pl_error
 
-                loss_mse = self.criterion_MSE(x_, x)
-                loss_pl = self.criterion_PL(x_, x)
+                    loss_mse = self.criterion_MSE(x_, x)
+                    loss_pl = self.criterion_PL(x_, x)
 
                 metrics[task + '_loss_rec'] += loss_rec.item() * x.size(0)
                 metrics[task + '_loss_mse'] += loss_mse.item() * x.size(0)
@@ -359,6 +578,9 @@ class PTrainer(Trainer):
         if self.mlp_model is not None:
             labels = np.concatenate(labels, 0)
             predictions = np.concatenate(predictions, 0)
+        if task == 'Val':
+            metrics, test_total, latent_codes, attributes, labels, predictions = self.reduce_validation(
+                metrics, test_total, latent_codes, attributes, labels, predictions)
 
         if task == 'Val':
 
@@ -396,14 +618,14 @@ class PTrainer(Trainer):
         #if task == 'Val':
             if epoch_val_loss < self.min_val_loss:
                 self.min_val_loss = epoch_val_loss
-                self.best_weights = model_weights
-                self.best_opt_weights = opt_weights
-                torch.save({'model_weights': model_weights, 'optimizer_e_weights': opt_weights[0],
-                            'optimizer_d_weights': opt_weights[1], 'epoch': epoch},
-                           self.client_path + '/best_model.pt')
+                # copies: model_weights is the state_dict of the model, updated by the next training steps
+                self.best_weights = copy.deepcopy(model_weights)
+                self.best_opt_weights = copy.deepcopy(opt_weights)
+                self.save_checkpoint({'model_weights': model_weights, 'optimizer_e_weights': opt_weights[0],
+                                      'optimizer_d_weights': opt_weights[1], 'epoch': epoch}, 'best_model.pt')
                 if self.mlp_model is not None:
-                    torch.save({'model_weights': self.mlp_model.state_dict(), 'optimizer_weights': self.optimizer_e.state_dict()
-                               , 'epoch': epoch}, self.client_path + '/best_model_head.pt')
+                    self.save_checkpoint({'model_weights': self.mlp_model.state_dict(), 'optimizer_weights': self.optimizer_e.state_dict()
+                                          , 'epoch': epoch}, 'best_model_head.pt')
             self.early_stop = self.early_stopping(epoch_val_loss)
             self.e_scheduler.step(epoch_val_loss)
             self.d_scheduler.step(epoch_val_loss)
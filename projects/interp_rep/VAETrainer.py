@@ -2,6 +2,7 @@ import numpy as np
 import torch
 
 from core.Trainer import Trainer
+from dl_utils.dist_utils import all_reduce_sum, broadcast_module
 from time import time
 import wandb
 import logging
@@ -36,6 +37,7 @@ class PTrainer(Trainer):
 
         self.loss_type = training_params['loss_type'] if 'loss_type' in training_params.keys() else 'mse'
         self.annealing = training_params['annealing'] if 'annealing' in training_params.keys() else 1
+        self.scaler = self.get_grad_scaler()
 
     def train(self, model_state=None, opt_state=None, start_epoch=0):
         """
@@ -54,13 +56,14 @@ class PTrainer(Trainer):
         if opt_state is not None:
             self.optimizer.load_state_dict(opt_state)  # load optimizer
 
-        self.model.apply(initialize_weights)
+        if model_state is None:
+            self.model.apply(initialize_weights)
+        # distributed training: all the ranks start from the weights of rank 0
+        broadcast_module(self.model)
         epoch_losses = []
         epoch_losses_pl = []
         epoch_losses_rec = []
 
-        self.early_stop = False
-
         for epoch in range(self.training_params['nr_epochs']):
             if start_epoch > epoch:
                 continue
@@ -70,44 +73,35 @@ class PTrainer(Trainer):
                 break
 
             start_time = time()
+            self.set_epoch(epoch)
             batch_loss, batch_loss_reg, batch_loss_rec,count_images = 1.0, 1.0, 1.0, 0
             batch_loss_pl = 1.0
 
             z_save = []
-            for data in self.train_ds:
+            for data, micro_batch_sizes in self.profiler.iterate(self.get_logical_batches(self.train_ds)):
                 # Input
-                images = data[0].to(self.device)
-                labels = data[1].to(self.device)
-                attributes = data[2].to(self.device)
-                transformed_images = self.transform(images) if self.transform is not None else images
+                with self.profiler.phase('h2d'):
+                    images = data[0].to(self.device)
+                    labels = data[1].to(self.device)
+                    attributes = data[2].to(self.device)
+                    transformed_images = self.transform(images) if self.transform is not None else images
                 b, c, w, h = images.shape
                 count_images += b
+                self.epoch_position += b
 
-                # Forward Pass
-                self.optimizer.zero_grad()
-                reconstructed_images, f_result = self.model(transformed_images)
-
-                # Reconstruction Loss
-                loss = self.criterion_rec(reconstructed_images,transformed_images,f_result, labels, attributes)
-                if self.loss_type == 'pl':
-                    pl_error = self.criterion_PL(transformed_images, reconstructed_images)
-                    loss  = loss + self.annealing * pl_error
+                if len(micro_batch_sizes) > 1:
+                    loss, pl_error, reconstructed_images, z = self._train_step_accumulated(
+                        transformed_images, labels, attributes, micro_batch_sizes)
                 else:
-                    weight_reg_loss = 0
-                    for param in self.model.parameters():
-                        weight_reg_loss += self.l1_crit(param, target=torch.zeros_like(param))
-                    loss += self.fctr * weight_reg_loss
-
-                    pl_error = loss
-                # Backward Pass
-                loss.backward()
-                # torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.5)  # to avoid nan loss
-                self.optimizer.step()
+                    loss, pl_error, reconstructed_images, z = self._train_step(transformed_images, labels, attributes)
                 batch_loss += loss.item() * images.size(0)
                 batch_loss_pl += pl_error.item() * images.size(0)
                 #batch_loss_rec += loss_rec.item() * images.size(0)
-                z_save.append(f_result['z'])
+                z_save.append(z)
 
+            # sums of all the ranks in distributed training
+            sums = all_reduce_sum({'loss': batch_loss, 'loss_pl': batch_loss_pl, 'count': count_images})
+            batch_loss, batch_loss_pl, count_images = sums['loss'], sums['loss_pl'], int(sums['count'])
             epoch_loss = batch_loss / count_images if count_images > 0 else batch_loss
             epoch_loss_pl = batch_loss_pl / count_images if count_images > 0 else batch_loss_reg
             #epoch_loss_rec = batch_loss_rec / count_images if count_images > 0 else batch_loss_rec
@@ -129,18 +123,135 @@ class PTrainer(Trainer):
             end_time = time()
             print('Epoch: {} \tTraining Loss: {:.6f} , computed in {} seconds for {} samples'.format(
                 epoch, epoch_loss, end_time - start_time, count_images))
+            self.profiler.end_epoch(epoch, count_images)
             wandb.log({"Train/Loss_": epoch_loss, '_step_': epoch})
             wandb.log({"Train/Loss_pl_": epoch_loss_pl, '_step_': epoch})
             #wandb.log({"Train/Loss_Rec_": epoch_loss_rec, '_step_': epoch})
 
-            # Save latest model
-            torch.save({'model_weights': self.model.state_dict(), 'optimizer_weights': self.optimizer.state_dict()
-                           ,'epoch': epoch}, self.client_path + '/latest_model.pt')
+            # batch-norm statistics of rank 0 on all the ranks (distributed training)
+            broadcast_module(self.model, buffers_only=True)
 
             # Run validation
             self.test(self.model.state_dict(), self.val_ds, 'Val', self.optimizer.state_dict(), epoch)
+            # Save latest model, with the state of the validation (early stopping, scheduler)
+            self.save_training_state(epoch)
+
+        self.checkpoints.wait()
         return self.best_weights, self.best_opt_weights
 
+    def get_stateful(self):
+        stateful = super(PTrainer, self).get_stateful()
+        stateful['scaler'] = self.scaler
+        # memory bank of the attribute regularization (VAE_loss, AttriLoss)
+        if getattr(self.criterion_rec, 'memory_bank', None) is not None:
+            stateful['reg_memory_bank'] = self.criterion_rec.memory_bank
+        return stateful
+
+    def _train_step(self, transformed_images, labels, attributes):
+        """
+        One optimizer step on a batch
+        :return: tuple
+            loss, perceptual loss (or loss), reconstructed images, latent codes
+        """
+        # Forward Pass
+        self.optimizer.zero_grad()
+        with self.profiler.phase('forward'), self.autocast():
+            reconstructed_images, f_result = self.model(transformed_images)
+            if self.loss_type == 'pl':
+                with self.profiler.phase('loss'):
+                    pl_error = self.criterion_PL(reconstructed_images, transformed_images).float()
+
+        # Reconstruction Loss (with the KL and attribute terms) in float32
+        with self.profiler.phase('loss'):
+            reconstructed_images, f_result = self.to_float(reconstructed_images), self.to_float(f_result)
+            loss = self.criterion_rec(reconstructed_images,transformed_images,f_result, labels, attributes)
+            if self.loss_type == 'pl':
+                loss  = loss + self.annealing * pl_error
+            else:
+                loss += self.fctr * self.get_weight_reg_loss()
+
+                pl_error = loss
+        # Backward Pass
+        with self.profiler.phase('backward'):
+            self.scaler.scale(loss).backward()
+        # torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.5)  # to avoid nan loss
+        with self.profiler.phase('optimizer'):
+            self.sync_gradients(self.optimizer)
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        return loss, pl_error, reconstructed_images, f_result['z']
+
+    def _train_step_accumulated(self, transformed_images, labels, attributes, micro_batch_sizes):
+        """
+        One optimizer step on a logical batch, with the gradients accumulated over its micro-batches.
+        The reconstruction, KL and perceptual losses are means over the samples and are weighted by the size of each
+        micro-batch. The attribute regularization depends on all the pairs of the logical batch: it is computed on
+        the latent codes of a first forward pass without gradients and enters each micro-batch through its gradient
+        w.r.t. the latent codes (get_reg_grads). The random draws of the first pass are replayed in the second one,
+        so that the latent codes are the same. The step is then equivalent to one step on the logical batch (up to
+        the batch statistics of batch-norm layers, computed per micro-batch).
+        :return: tuple
+            loss, perceptual loss (or loss), reconstructed images, latent codes of the logical batch
+        """
+        assert hasattr(self.criterion_rec, 'regularization'), \
+            '[PTrainer::train] Gradient accumulation needs a loss with a regularization(z, attr) method'
+        nr_samples = transformed_images.shape[0]
+        micro_batches = list(zip(transformed_images.split(micro_batch_sizes), labels.split(micro_batch_sizes),
+                                 attributes.split(micro_batch_sizes)))
+
+        rng_states, latents = [], []
+        with self.profiler.phase('reg_loss'):
+            with torch.no_grad(), self.autocast(), self.preserve_buffers(self.model):
+                for x, _, _ in micro_batches:
+                    rng_states.append(self.get_rng_state())
+                    latents.append(self.criterion_rec.get_latent(self.model(x)[1]))
+            rng_state = self.get_rng_state()
+            loss_reg, reg_grads = self.get_reg_grads(latents,
+                                                     lambda z: self.criterion_rec.regularization(z, attributes))
+
+        self.optimizer.zero_grad()
+        loss, pl_loss, reconstructions, latents = 0.0, 0.0, [], []
+        for (x, y, attr), reg_grad, micro_rng_state in zip(micro_batches, reg_grads, rng_states):
+            weight = x.shape[0] / nr_samples
+            self.set_rng_state(micro_rng_state)
+            with self.profiler.phase('forward'), self.autocast():
+                reconstructed_images, f_result = self.model(x)
+                if self.loss_type == 'pl':
+                    with self.profiler.phase('loss'):
+                        pl_error = self.criterion_PL(reconstructed_images, x).float()
+            with self.profiler.phase('loss'):
+                reconstructed_images, f_result = self.to_float(reconstructed_images), self.to_float(f_result)
+                micro_loss = self.criterion_rec(reconstructed_images, x, f_result, y, attr, reg=False)
+                if self.loss_type == 'pl':
+                    micro_loss = micro_loss + self.annealing * pl_error
+                    pl_loss += weight * pl_error.detach()
+                z = self.criterion_rec.get_latent(f_result)
+            with self.profiler.phase('backward'):
+                self.scaler.scale(weight * micro_loss + (z * reg_grad).sum()).backward()
+            loss += weight * micro_loss.detach() if torch.is_tensor(micro_loss) else weight * micro_loss
+            reconstructions.append(reconstructed_images.detach())
+            latents.append(f_result['z'].detach())
+        self.set_rng_state(rng_state)
+
+        loss = loss + loss_reg
+        if self.loss_type != 'pl':
+            # the weight regularization does not depend on the batch, it is added once
+            weight_reg_loss = self.fctr * self.get_weight_reg_loss()
+            self.scaler.scale(weight_reg_loss).backward()
+            loss = loss + weight_reg_loss.detach()
+            pl_loss = loss
+        with self.profiler.phase('optimizer'):
+            self.sync_gradients(self.optimizer)
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        return torch.as_tensor(loss), torch.as_tensor(pl_loss), torch.cat(reconstructions), torch.cat(latents)
+
+    def get_weight_reg_loss(self):
+        weight_reg_loss = 0
+        for param in self.model.parameters():
+            weight_reg_loss += self.l1_crit(param, target=torch.zeros_like(param))
+        return weight_reg_loss
+
     def test(self, model_weights, test_data, task='Val', opt_weights=None, epoch=0):
         """
         :param model_weights: weights of the global model
@@ -193,6 +304,9 @@ class PTrainer(Trainer):
 
         latent_codes = np.concatenate(latent_codes, 0)
         attributes = np.concatenate(attributes, 0)
+        if task == 'Val':
+            metrics, test_total, latent_codes, attributes = self.reduce_validation(metrics, test_total, latent_codes,
+                                                                                   attributes)
 
         if epoch % 50 == 0:
             rl_metrics = compute_rl_metrics('',latent_codes,attributes,test_data.dataset.dataset.attributes_idx)
@@ -233,8 +347,8 @@ class PTrainer(Trainer):
         if task == 'Val':
             if epoch_val_loss < self.min_val_loss:
                 self.min_val_loss = epoch_val_loss
-                torch.save({'model_weights': model_weights, 'optimizer_weights': opt_weights, 'epoch': epoch},
-                           self.client_path + '/best_model.pt')
+                self.save_checkpoint({'model_weights': model_weights, 'optimizer_weights': opt_weights, 'epoch': epoch},
+                                     'best_model.pt')
                 self.best_weights = copy.deepcopy(model_weights)
                 self.best_opt_weights = copy.deepcopy(opt_weights)
 
@@ -1,42 +1,104 @@
 import torch
 from torch.nn import functional as F
 from sklearn.metrics import roc_auc_score
+from optim.losses.image_losses import compute_reg_loss, gather_reg_inputs
+from optim.losses.memory_bank import LatentMemoryBank
 
 class VAE_loss:
-    def __init__(self, beta, gamma, factor, alpha_mlp=1.0):
+    def __init__(self, beta, gamma, factor, alpha_mlp=1.0, gather=True, tile_size=None, estimator=None,
+                 memory_bank=None):
+        """
+        :param gather: bool
+            distributed training: regularization over the pairs of the batches of all the ranks
+        :param tile_size: int
+            rows per block of the pairs of the regularization (see compute_reg_loss), None: all the pairs at once
+        :param estimator: dict
+            approximation of the regularization from O(N) pairs (see estimate_reg_loss), None: exact
+        :param memory_bank: dict
+            regularization against the latent codes of the last training steps as well, e.g., {capacity: 1024,
+            max_age: 20} (see LatentMemoryBank), None: pairs of the batch only
+        """
         super(VAE_loss,self).__init__()
         self.beta = beta
         self.gamma = gamma
         self.factor = factor
         self.alpha = alpha_mlp
-
-    def __call__(self, x_recon, x, f_results, labels, attr):
-
+        self.gather = gather
+        self.tile_size = tile_size
+        self.estimator = estimator
+        self.memory_bank = LatentMemoryBank(**memory_bank) if memory_bank is not None else None
+
+    def __call__(self, x_recon, x, f_results, labels, attr, reg=True):
+        """
+        :param reg: bool
+            add the attribute regularization, which depends on all the pairs of the batch. Without it, the loss is a
+            mean over the samples (see regularization for micro-batches)
+        """
         recon_loss = reconstruction_loss(x_recon, x, 1.0, dist='gaussian')
 
         log_var = f_results['z_logvar']
         mu = f_results['z_mu']
         kld_loss = torch.mean(-0.5 * torch.sum(1 + log_var - mu ** 2 - log_var.exp(), dim=1), dim=0)
-        reg_loss = regularization_loss(f_results['z'], attr, x_recon.size()[0], self.gamma, self.factor)
-        loss = recon_loss + self.beta * kld_loss + reg_loss
+        loss = recon_loss + self.beta * kld_loss
+        if reg:
+            loss = loss + self.regularization(self.get_latent(f_results), attr)
 
         return loss
 
+    @staticmethod
+    def get_latent(f_results):
+        return f_results['z']
+
+    def regularization(self, z, attr):
+        if self.gather:
+            z, attr = gather_reg_inputs(z, attr)
+        if self.memory_bank is not None:
+            return self.gamma * self.memory_bank.reg_loss(z, attr, self.factor, self.tile_size, self.estimator)
+        return regularization_loss(z, attr, z.size()[0], self.gamma, self.factor, self.tile_size,
+                                   self.estimator)
+
 
 class AttriLoss:
-    def __init__(self, gamma, factor):
+    def __init__(self, gamma, factor, gather=True, tile_size=None, estimator=None, memory_bank=None):
+        """
+        :param gather: bool
+            distributed training: regularization over the pairs of the batches of all the ranks
+        :param tile_size: int
+            rows per block of the pairs of the regularization (see compute_reg_loss), None: all the pairs at once
+        :param estimator: dict
+            approximation of the regularization from O(N) pairs (see estimate_reg_loss), None: exact
+        :param memory_bank: dict
+            regularization against the latent codes of the last training steps as well, e.g., {capacity: 1024,
+            max_age: 20} (see LatentMemoryBank), None: pairs of the batch only
+        """
         super(AttriLoss, self).__init__()
         self.gamma = gamma
         self.factor = factor
+        self.gather = gather
+        self.tile_size = tile_size
+        self.estimator = estimator
+        self.memory_bank = LatentMemoryBank(**memory_bank) if memory_bank is not None else None
 
-    def __call__(self, x_recon, x, f_results, labels, attr):
+    def __call__(self, x_recon, x, f_results, labels, attr, reg=True):
 
-        z = f_results['z_tilde'] if 'z_tilde' in f_results.keys() else f_results['z']
-        reg_loss = regularization_loss(z, attr, x_recon.size()[0], self.gamma, self.factor)
-        loss = reg_loss
+        if not reg:
+            return 0.0
+        loss = self.regularization(self.get_latent(f_results), attr)
 
         return loss
 
+    @staticmethod
+    def get_latent(f_results):
+        return f_results['z_tilde'] if 'z_tilde' in f_results.keys() else f_results['z']
+
+    def regularization(self, z, attr):
+        if self.gather:
+            z, attr = gather_reg_inputs(z, attr)
+        if self.memory_bank is not None:
+            return self.gamma * self.memory_bank.reg_loss(z, attr, self.factor, self.tile_size, self.estimator)
+        return regularization_loss(z, attr, z.size()[0], self.gamma, self.factor, self.tile_size,
+                                   self.estimator)
+
 def reconstruction_loss(recon_x, x, recon_param , dist):
     BCE = torch.nn.BCELoss(reduction="sum") 
     batch_size = recon_x.shape[0]
@@ -93,13 +155,10 @@ def reg_loss_sign(latent_code, attribute, factor=1.0):
         return sign_loss
 
 
-def regularization_loss(latent_code, radiomics_, mini_batch_size, gamma = 1.0, factor = 1.0):
-    AR_loss = 0.0
-    for dim in range(radiomics_.size()[1]):
-        x = latent_code[:, dim]
-        radiomics_dim = radiomics_[:, dim]    
-        AR_loss += reg_loss_sign(x, radiomics_dim, factor=factor)
-    return gamma * AR_loss
+def regularization_loss(latent_code, radiomics_, mini_batch_size, gamma = 1.0, factor = 1.0, tile_size=None,
+                        estimator=None):
+    # reg_loss_sign of every attribute dimension, computed at once
+    return gamma * compute_reg_loss(latent_code, radiomics_, factor, tile_size, estimator)
 
 def mean_accuracy(pred, targets ):
     """